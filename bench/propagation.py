@@ -0,0 +1,586 @@
+#!/usr/bin/env python
+"""End to end propagation benchmark.
+
+Builds a synthetic tree, starts a local rsync daemon configured like
+extras/rsyncd/rsyncd.conf, a SyncMaster watching the tree and one or more
+SyncSlave processes, replays scripted workloads on the tree and measures
+how long the changes take to show up on every slave.
+
+Slaves sync the same absolute paths the master watches, so each one runs
+in its own mount namespace (unshare) with its target directory bind
+mounted over the tree. Requires rsync, unshare and mount (and unprivileged
+user namespaces when not run as root).
+
+  bench/propagation.py --files 5000 --slaves 2 --output new.json
+  bench/propagation.py --compare old.json new.json
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import random
+import shutil
+import signal
+import socket
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LIB = os.path.join(ROOT, 'bin', 'lib')
+sys.path.insert(0, LIB)
+
+from metrics import read_samples
+
+WORKLOADS = ['storm', 'checkout', 'renames', 'deletes', 'large']
+RSYNC_USER = 'ackstorm-sync'
+RSYNC_PASSWORD = 'bench'
+POLL_INTERVAL = 0.05
+SLEEP = 5   # tick of the daemons (the shortest they accept)
+BLOCK = 'ackstorm-sync benchmark filler\n' * 128
+
+RUNNER = """
+import os, sys
+sys.path.insert(0, %(lib)r)
+os.chdir(%(instance)r)
+import %(module)s as role
+role.%(cls)s().run('./var/bench.pid')
+"""
+
+
+def parse_sizes(spec):
+  """'1k:90,64k:9,4m:1' -> [(bytes, weight)]"""
+  units = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+  sizes = []
+  for item in spec.split(','):
+    size, weight = item.split(':')
+    size = size.strip().lower()
+    unit = size[-1] if size[-1] in units else ''
+    sizes.append((int(float(size[:len(size) - len(unit)]) * units[unit]), float(weight)))
+
+  return sizes
+
+
+def percentile(values, percent):
+  if not values: return None
+  values = sorted(values)
+  return values[min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))]
+
+
+def free_port():
+  sock = socket.socket()
+  sock.bind(('127.0.0.1', 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+
+class Tree():
+  """Synthetic tree and the content every file is expected to have.
+
+  Every file starts with a unique token line, so a slave copy is current
+  when its first line is the token of the last write.
+  """
+
+  def __init__(self, root, rng, sizes):
+    self.root = root
+    self.rng = rng
+    self.sizes = sizes
+    self.files = {}   # path -> token
+    self.dirs = [root]
+    self.counter = 0
+
+  def size(self):
+    pick = self.rng.random() * sum([weight for size, weight in self.sizes])
+    for size, weight in self.sizes:
+      pick -= weight
+      if pick <= 0: break
+
+    return size
+
+  def generate(self, count, depth):
+    os.makedirs(self.root)
+    levels = {self.root: 0}
+    for i in range(depth and max(1, count / 20) or 0):
+      parents = [path for path in self.dirs if levels[path] < depth]
+      parent = self.rng.choice(parents)
+      path = self.mkdir(parent)
+      levels[path] = levels[parent] + 1
+
+    for i in range(count):
+      self.write(self.new_path())
+
+  def new_path(self, dirname=None):
+    self.counter += 1
+    return os.path.join(dirname or self.rng.choice(self.dirs), 'f%06d.txt' % self.counter)
+
+  def mkdir(self, parent):
+    self.counter += 1
+    path = os.path.join(parent, 'd%06d' % self.counter)
+    os.mkdir(path)
+    self.dirs.append(path)
+    return path
+
+  def write(self, path, size=None):
+    if size is None: size = self.size()
+    self.counter += 1
+    token = 'bench:%d\n' % self.counter
+    with open(path + '.tmp', 'w') as file:
+      file.write(token)
+      size -= len(token)
+      while size > 0:
+        file.write(BLOCK[:size])
+        size -= len(BLOCK)
+
+    os.rename(path + '.tmp', path)
+    self.files[path] = token
+    return [(path, token)]
+
+  def append(self, path):
+    # In place, like an editor saving or a log growing
+    with open(path, 'r+') as file:
+      token = file.readline()
+      file.seek(0, 2)
+      file.write(BLOCK[:self.rng.randint(1, 256)])
+
+    return [(path, token)]
+
+  def remove(self, path):
+    os.remove(path)
+    del self.files[path]
+    return [(path, None)]
+
+  def remove_dir(self, path):
+    changes = [(name, None) for name in self.files if name.startswith(path + '/')]
+    shutil.rmtree(path)
+    for name, token in changes:
+      del self.files[name]
+
+    self.dirs = [name for name in self.dirs if name != path and not name.startswith(path + '/')]
+    return changes
+
+  def rename(self, src, dst):
+    os.rename(src, dst)
+    changes = []
+    for name in [name for name in self.files if name == src or name.startswith(src + '/')]:
+      token = self.files.pop(name)
+      self.files[dst + name[len(src):]] = token
+      changes.extend([(name, None), (dst + name[len(src):], token)])
+
+    if os.path.isdir(dst):
+      self.dirs = [dst + name[len(src):] if name == src or name.startswith(src + '/') else name
+        for name in self.dirs]
+
+    return changes
+
+  def sample(self, count):
+    return self.rng.sample(sorted(self.files), min(count, len(self.files)))
+
+
+# Workloads: each one changes the tree and yields (path, token or None when
+# the path must be gone) as the changes are made
+
+def storm(tree, scale, options):
+  # The same set of files rewritten over and over
+  paths = tree.sample(max(1, scale / 10))
+  for i in range(scale):
+    path = tree.rng.choice(paths)
+    if tree.rng.random() < 0.5:
+      changes = tree.write(path)
+    else:
+      changes = tree.append(path)
+    for change in changes: yield change
+
+
+def checkout(tree, scale, options):
+  # A branch switch: new directories and files, rewrites and deletes at once
+  for i in range(max(1, scale / 50)):
+    tree.mkdir(tree.rng.choice(tree.dirs))
+
+  for path in tree.sample(scale / 4):
+    for change in tree.remove(path): yield change
+
+  for path in tree.sample(scale / 4):
+    for change in tree.write(path): yield change
+
+  for i in range(scale / 2):
+    for change in tree.write(tree.new_path()): yield change
+
+
+def renames(tree, scale, options):
+  # Files renamed in place and whole directories moved around
+  for path in tree.sample(scale):
+    for change in tree.rename(path, path + '.renamed'): yield change
+
+  candidates = [path for path in tree.dirs if path != tree.root]
+  for src in tree.rng.sample(candidates, min(len(candidates), max(1, scale / 100))):
+    parents = [path for path in tree.dirs if path != src and not path.startswith(src + '/')]
+    if not os.path.isdir(src) or not parents: continue
+    dst = os.path.join(tree.rng.choice(parents), os.path.basename(src) + '-moved')
+    for change in tree.rename(src, dst): yield change
+
+
+def deletes(tree, scale, options):
+  for path in tree.sample(scale):
+    for change in tree.remove(path): yield change
+
+  candidates = [path for path in tree.dirs if path != tree.root]
+  if candidates:
+    for change in tree.remove_dir(tree.rng.choice(candidates)): yield change
+
+
+def large(tree, scale, options):
+  for i in range(max(1, scale / 250)):
+    for change in tree.write(tree.new_path(), options.large_size): yield change
+
+
+class Bench():
+
+  def __init__(self, options):
+    self.options = options
+    self.workdir = options.dir or tempfile.mkdtemp(prefix='ackstorm-bench-')
+    self.tree_root = os.path.join(self.workdir, 'tree')
+    self.processes = []
+    self.rsync_port = free_port()
+    self.notify_port = free_port()
+
+  # Setup
+
+  def instance(self, name):
+    path = os.path.join(self.workdir, name)
+    for subdir in ('etc', 'var', 'var/log', 'data'):
+      if not os.path.isdir(os.path.join(path, subdir)):
+        os.makedirs(os.path.join(path, subdir))
+
+    return path
+
+  def write_master_conf(self, instance):
+    with open(os.path.join(instance, 'etc', 'master_conf.py'), 'w') as file:
+      file.write("\n".join([
+        "verbose = False",
+        "daemonize = False",
+        "sleep = %d" % SLEEP,
+        "inotify_backend = %r" % self.options.backend,
+        "watch_paths = [%r]" % self.tree_root,
+        "excludes = []",
+        "notify_address = '127.0.0.1:%d'" % self.notify_port,
+        "metrics_address = None",
+        "actions = []",
+      ]) + "\n")
+
+  def write_slave_conf(self, instance):
+    secret = os.path.join(instance, 'etc', 'rsync.secret')
+    with open(secret, 'w') as file:
+      file.write(RSYNC_PASSWORD + '\n')
+    os.chmod(secret, 0600)
+
+    with open(os.path.join(instance, 'etc', 'slave_conf.py'), 'w') as file:
+      file.write("\n".join([
+        "dry_run = False",
+        "verbose = False",
+        "daemonize = False",
+        "sleep = %d" % SLEEP,
+        "initial_fullsync = True",
+        "fullsync_interval = 0",
+        "master = '127.0.0.1'",
+        "notify_address = '127.0.0.1:%d'" % self.notify_port,
+        "metrics_address = None",
+        "rsync_cmd = %r" % self.options.rsync,
+        "rsync_user = %r" % RSYNC_USER,
+        "rsync_password = %r" % RSYNC_PASSWORD,
+        "rsync_secret_file = %r" % secret,
+        "rsync_opts = ['-av', '-x', '-r', '--delete', '--timeout=20', '--force', "
+          "'--ignore-errors', '--port=%d']" % self.rsync_port,
+        "actions = []",
+      ]) + "\n")
+
+  def write_rsyncd_conf(self, master):
+    # extras/rsyncd/rsyncd.conf without the settings that need root
+    secrets = os.path.join(self.workdir, 'rsyncd.secrets')
+    with open(secrets, 'w') as file:
+      file.write('%s:%s\n' % (RSYNC_USER, RSYNC_PASSWORD))
+    os.chmod(secrets, 0600)
+
+    lines, section = [], None
+    with open(os.path.join(ROOT, 'extras', 'rsyncd', 'rsyncd.conf')) as file:
+      for line in file:
+        if line.strip().startswith('['):
+          section = line.strip()[1:-1]
+
+        key = line.split('=')[0].strip()
+        if key in ('uid', 'gid', 'use chroot', 'log file', 'secrets file'):
+          continue
+
+        # The journal of the benchmark master
+        if key == 'path' and section == 'updates':
+          line = '\tpath = %s\n' % os.path.join(master, 'data')
+
+        lines.append(line)
+
+    conf = os.path.join(self.workdir, 'rsyncd.conf')
+    with open(conf, 'w') as file:
+      file.write("use chroot = false\n")
+      file.write("log file = %s\n" % os.path.join(self.workdir, 'rsyncd.log'))
+      file.write("secrets file = %s\n" % secrets)
+      file.write("pid file = %s\n" % os.path.join(self.workdir, 'rsyncd.pid'))
+      file.write(''.join(lines))
+
+    return conf
+
+  def spawn(self, command, log):
+    process = subprocess.Popen(command, stdout=open(log, 'a'), stderr=subprocess.STDOUT,
+      preexec_fn=os.setsid, close_fds=True)
+    self.processes.append(process)
+    return process
+
+  def start(self):
+    options = self.options
+    rng = random.Random(options.seed)
+    self.tree = Tree(self.tree_root, rng, parse_sizes(options.sizes))
+
+    print >> sys.stderr, "Generating %d files in %s" % (options.files, self.tree_root)
+    self.tree.generate(options.files, options.depth)
+
+    master = self.instance('master')
+    self.write_master_conf(master)
+    conf = self.write_rsyncd_conf(master)
+    self.spawn([options.rsync, '--daemon', '--no-detach', '--config=' + conf,
+      '--port=%d' % self.rsync_port], os.path.join(self.workdir, 'rsyncd.out'))
+
+    started = time.time()
+    self.spawn(self.runner(master, 'master', 'SyncMaster'), os.path.join(master, 'var', 'out.log'))
+    self.master_metrics = os.path.join(master, 'var', 'ackstorm-sync-master.prom')
+    self.wait_for(lambda: 'startup_seconds{phase="watches"}' in self.master_samples(),
+      "master watches")
+    self.master_head = os.path.join(master, 'data', 'journal.head')
+    master_ready = time.time() - started
+
+    self.slaves = []
+    for i in range(options.slaves):
+      instance = self.instance('slave%d' % i)
+      self.write_slave_conf(instance)
+      target = os.path.join(self.workdir, 'slave%d-tree' % i)
+      os.mkdir(target)
+
+      # The slave sees its target where the master tree is
+      unshare = ['unshare', '--mount', '--propagation', 'private']
+      if os.geteuid(): unshare[1:1] = ['--user', '--map-root-user']
+      script = 'mount --bind "$1" "$2" && shift 2 && exec "$@"'
+      self.spawn(unshare + ['sh', '-c', script, 'sh', target, self.tree_root] +
+        self.runner(instance, 'slave', 'SyncSlave'), os.path.join(instance, 'var', 'out.log'))
+      self.slaves.append({'instance': instance, 'target': target})
+
+    # Ready once the initial fullsync is done and the main loop runs
+    started = time.time()
+    for slave in self.slaves:
+      metrics = os.path.join(slave['instance'], 'var', 'ackstorm-sync-slave.prom')
+      self.wait_for(lambda: os.path.exists(metrics), "slave initial sync", options.timeout)
+
+    return {'master_startup': round(master_ready, 3),
+      'slave_initial_sync': round(time.time() - started, 3)}
+
+  def runner(self, instance, module, cls):
+    return [sys.executable, '-c', RUNNER % {'lib': LIB, 'instance': instance,
+      'module': module, 'cls': cls}]
+
+  def wait_for(self, check, what, timeout=60):
+    deadline = time.time() + timeout
+    while not check():
+      for process in self.processes:
+        if process.poll() is not None:
+          raise RuntimeError, "Process exited while waiting for %s: %s" % (what, process.pid)
+      if time.time() > deadline:
+        raise RuntimeError, "Timeout waiting for %s" % what
+      time.sleep(0.2)
+
+  def stop(self):
+    for process in reversed(self.processes):
+      try:
+        os.killpg(process.pid, signal.SIGTERM)
+      except OSError:
+        pass
+
+    for process in self.processes:
+      process.wait()
+
+    if not self.options.keep and not self.options.dir:
+      shutil.rmtree(self.workdir, True)
+
+  # Measures
+
+  def master_samples(self):
+    try:
+      return read_samples(self.master_metrics)
+    except (IOError, OSError, ValueError):
+      return {}
+
+  def metrics_written(self):
+    try:
+      return os.path.getmtime(self.master_metrics)
+    except OSError:
+      return 0
+
+  def head_settled(self, quiet=2.0):
+    # mtime of journal.head once it stops changing (the last flush)
+    deadline = time.time() + self.options.timeout
+    while True:
+      try:
+        mtime = os.path.getmtime(self.master_head)
+      except OSError:
+        mtime = None
+
+      if mtime is not None and time.time() - mtime >= quiet or time.time() > deadline:
+        return mtime or time.time()
+      time.sleep(0.2)
+
+  def local(self, slave, path):
+    return slave['target'] + path[len(self.tree_root):]
+
+  def applied(self, slave, path, token):
+    local = self.local(slave, path)
+    if token is None:
+      return not os.path.lexists(local)
+
+    try:
+      with open(local) as file:
+        return file.readline() == token
+    except IOError, e:
+      if e.errno in (errno.ENOENT, errno.EISDIR): return False
+      raise
+
+  def run_workload(self, name):
+    options = self.options
+    before = self.master_samples()
+    expected = {}   # path -> (token, time of the last change)
+
+    started = time.time()
+    for path, token in globals()[name](self.tree, options.scale, options):
+      expected[path] = (token, time.time())
+    written = time.time()
+
+    # Every slave until it has every change or the timeout expires
+    pending = [dict(expected) for slave in self.slaves]
+    latencies = [[] for slave in self.slaves]
+    caught_up = [None] * len(self.slaves)
+    deadline = written + options.timeout
+    while time.time() < deadline and [p for p in pending if p]:
+      for i, slave in enumerate(self.slaves):
+        now = time.time()
+        for path, (token, changed) in pending[i].items():
+          if self.applied(slave, path, token):
+            latencies[i].append(now - changed)
+            del pending[i][path]
+
+        if not pending[i] and caught_up[i] is None:
+          caught_up[i] = now - written
+
+      time.sleep(POLL_INTERVAL)
+
+    # The master writes its metrics on each tick, wait for one after the
+    # last flush so they count every record
+    flushed = self.head_settled()
+    self.wait_for(lambda: self.metrics_written() > flushed, "master metrics", SLEEP * 3)
+    after = self.master_samples()
+
+    def delta(name):
+      return after.get(name, 0) - before.get(name, 0)
+
+    events = delta('events_total')
+    result = {
+      'changes': len(expected),
+      'write_seconds': round(written - started, 3),
+      'master': {
+        'events': int(events),
+        'events_per_second': round(events / max(flushed - started, 0.001), 1),
+        'journal_records': int(delta('journal_records_total')),
+        'journal_bytes': int(delta('journal_bytes')),
+        'journal_seconds': round(flushed - started, 3),
+      },
+      'slaves': [],
+    }
+
+    for i, slave in enumerate(self.slaves):
+      result['slaves'].append({
+        'catch_up_seconds': caught_up[i] is not None and round(caught_up[i], 3) or None,
+        'p50_ms': latencies[i] and round(percentile(latencies[i], 50) * 1000, 1) or None,
+        'p99_ms': latencies[i] and round(percentile(latencies[i], 99) * 1000, 1) or None,
+        'missing': len(pending[i]),
+      })
+
+    return result
+
+
+def compare(old, new):
+  # Relative change of every numeric result found in both files
+  def flatten(data, prefix=''):
+    if isinstance(data, dict):
+      for key in sorted(data):
+        for item in flatten(data[key], prefix + '.' + key if prefix else key): yield item
+    elif isinstance(data, list):
+      for i, value in enumerate(data):
+        for item in flatten(value, '%s[%d]' % (prefix, i)): yield item
+    elif isinstance(data, (int, float)) and not isinstance(data, bool):
+      yield prefix, data
+
+  old = dict(flatten(old))
+  for name, value in flatten(new):
+    if name not in old: continue
+    change = old[name] and '%+.1f%%' % ((value - old[name]) * 100.0 / old[name]) or '-'
+    print '%-60s %12s %12s %9s' % (name, old[name], value, change)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--files', type=int, default=2000, help='files in the synthetic tree')
+  parser.add_argument('--depth', type=int, default=4, help='depth of the synthetic tree')
+  parser.add_argument('--sizes', default='1k:90,64k:9,1m:1',
+    help='file size distribution as size:weight pairs')
+  parser.add_argument('--large-size', type=int, default=64 * 1024 * 1024,
+    help='bytes of the files of the large workload')
+  parser.add_argument('--slaves', type=int, default=1)
+  parser.add_argument('--workloads', default=','.join(WORKLOADS),
+    help='comma separated: %s' % ', '.join(WORKLOADS))
+  parser.add_argument('--scale', type=int, default=500, help='changes per workload')
+  parser.add_argument('--backend', default='native', help='inotify backend of the master')
+  parser.add_argument('--timeout', type=int, default=300, help='seconds to wait for slaves')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--rsync', default='rsync')
+  parser.add_argument('--dir', help='work directory (kept; a temporary one by default)')
+  parser.add_argument('--keep', action='store_true', help='keep the temporary work directory')
+  parser.add_argument('--output', help='write the results as JSON here (default stdout)')
+  parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+    help='compare two result files and exit')
+  options = parser.parse_args()
+
+  if options.compare:
+    compare(*[json.load(open(name)) for name in options.compare])
+    return
+
+  workloads = [name.strip() for name in options.workloads.split(',') if name.strip()]
+  for name in workloads:
+    if name not in WORKLOADS:
+      parser.error("unknown workload: %s" % name)
+
+  bench = Bench(options)
+  results = {'options': vars(options), 'workloads': {}}
+  try:
+    results['startup'] = bench.start()
+    for name in workloads:
+      print >> sys.stderr, "Running workload: %s" % name
+      results['workloads'][name] = bench.run_workload(name)
+
+  finally:
+    bench.stop()
+
+  data = json.dumps(results, indent=2, sort_keys=True)
+  if options.output:
+    with open(options.output, 'w') as file:
+      file.write(data + '\n')
+  else:
+    print data
+
+
+if __name__ == '__main__':
+  main()
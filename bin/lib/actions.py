@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+import os
+import shlex
+import signal
+import logging
+import threading
+import Queue
+
+from time import time
+from subprocess import Popen, STDOUT
+
+ACTIONS_LOG = './var/log/ackstorm-sync-actions.log'
+
+
+class ActionScheduler():
+  """Run the commands of the matched actions in the background.
+
+  A command is run once delay seconds have passed without it being
+  scheduled again (but no later than max_delay seconds after the first
+  request), so a burst of changes triggers a single run. At most workers
+  commands run at the same time and a command never overlaps with itself:
+  requests arriving while it runs are queued for another run afterwards.
+  Commands are killed after their timeout and their output goes to
+  ACTIONS_LOG.
+  """
+
+  def __init__(self, workers=2, delay=5, max_delay=60, timeout=300, metrics=None):
+    self.delay = delay
+    self.max_delay = max(delay, max_delay)
+    self.timeout = timeout
+    self.pending = {}     # command -> [due time, first request, timeout]
+    self.running = set()
+    self.queue = Queue.Queue()
+    self.cond = threading.Condition()
+    self.log = os.path.abspath(ACTIONS_LOG)
+    self.metrics = metrics
+
+    threads = [threading.Thread(target=self.dispatcher)]
+    threads.extend([threading.Thread(target=self.worker) for i in range(max(1, int(workers)))])
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+
+  def __len__(self):
+    with self.cond:
+      return len(self.pending) + len(self.running)
+
+  def schedule(self, command, timeout=None):
+    now = time()
+    with self.cond:
+      item = self.pending.get(command)
+      if item is None:
+        self.pending[command] = [now + self.delay, now, timeout or self.timeout]
+      else:
+        item[0] = min(now + self.delay, item[1] + self.max_delay)
+
+      self.cond.notify_all()
+
+  def dispatcher(self):
+    with self.cond:
+      while True:
+        now = time()
+        waiting = []
+        for command, item in self.pending.items():
+          if command in self.running: continue
+          if item[0] > now:
+            waiting.append(item[0])
+            continue
+
+          del self.pending[command]
+          self.running.add(command)
+          self.queue.put((command, item[2]))
+
+        # Woken up by schedule() and by finished commands
+        if waiting:
+          self.cond.wait(min(waiting) - now)
+        else:
+          self.cond.wait()
+
+  def worker(self):
+    while True:
+      command, timeout = self.queue.get()
+      try:
+        self.execute(command, timeout)
+
+      except Exception, e:
+        logging.info("ACTION FAILED: %s (%s)" % (command, e))
+
+      finally:
+        with self.cond:
+          self.running.discard(command)
+          self.cond.notify_all()
+
+  def execute(self, command, timeout):
+    logging.info("RUNNING ACTION: %s" % command)
+    started = time()
+
+    # Split processes ';'
+    for cmd in command.split(';'):
+      if not cmd.strip(): continue
+
+      with open(self.log, 'a') as log:
+        log.write("# %s\n" % cmd.strip())
+        log.flush()
+
+        # Own session so it outlives us (actions may restart this process)
+        # and a timeout kills everything it started
+        p = Popen(shlex.split(cmd), stdin=open(os.devnull), stdout=log, stderr=STDOUT,
+          cwd='/', close_fds=True, preexec_fn=os.setsid)
+
+      timer = threading.Timer(timeout, self.kill, [p, cmd])
+      timer.daemon = True
+      timer.start()
+      try:
+        retval = p.wait()
+      finally:
+        timer.cancel()
+
+      if retval:
+        logging.info("ACTION FAILED (%d): %s" % (retval, cmd))
+        if self.metrics: self.metrics.inc('action_failures_total', action=command)
+
+    elapsed = time() - started
+    logging.info("ACTION DONE in %.1fs: %s" % (elapsed, command))
+    if self.metrics: self.metrics.observe('action_seconds', elapsed, action=command)
+
+  @staticmethod
+  def kill(process, cmd):
+    logging.info("ACTION TIMED OUT: %s" % cmd)
+    try:
+      os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+      pass # already finished
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import os
+import pwd
+import grp
+import stat
+import shutil
+import tarfile
+import logging
+
+from cStringIO import StringIO
+
+BUNDLE_PREFIX = 'bundle-'
+BUNDLE_SUFFIX = '.tgz'
+MAX_BUNDLE_BYTES = 32 * 1024 * 1024   # content of a single bundle
+
+
+def bundle_name(first_seq):
+  return '%s%016d%s' % (BUNDLE_PREFIX, first_seq, BUNDLE_SUFFIX)
+
+
+def is_bundle(name):
+  return name.startswith(BUNDLE_PREFIX) and name.endswith(BUNDLE_SUFFIX)
+
+
+def write_bundle(filename, paths, max_size):
+  """Pack the regular files in paths of up to max_size bytes into a gzip
+  tar; returns the files packed (nothing is written when there are none)"""
+  tmp = filename + '.tmp'
+  tar = None
+  count = total = 0
+  for path in paths:
+    try:
+      st = os.lstat(path)
+      if not stat.S_ISREG(st.st_mode) or st.st_size > max_size:
+        continue
+
+      # Read first so a file changing meanwhile never breaks the archive
+      with open(path, 'rb') as file:
+        data = file.read(max_size + 1)
+        if len(data) > max_size: continue
+        if tar is None: tar = tarfile.open(tmp, 'w:gz')
+        info = tar.gettarinfo(arcname=path.lstrip('/'), fileobj=file)
+
+    except (IOError, OSError):
+      continue # vanished
+
+    info.size = len(data)
+    tar.addfile(info, StringIO(data))
+    count += 1
+    total += len(data)
+    if total >= MAX_BUNDLE_BYTES: break
+
+  if tar is None:
+    return 0
+
+  tar.close()
+  if not count:
+    os.remove(tmp)
+    return 0
+
+  os.rename(tmp, filename)
+  return count
+
+
+def bundle_members(filename):
+  """Paths of the files in a bundle"""
+  try:
+    with tarfile.open(filename, 'r:gz') as tar:
+      return ['/' + member.name for member in tar if member.isreg()]
+
+  except (IOError, OSError, tarfile.TarError), e:
+    logging.info("Unable to read bundle %s: %s" % (filename, e))
+    return []
+
+
+def owner(member):
+  # Names like rsync does, ids when they are unknown here
+  try:
+    uid = pwd.getpwnam(member.uname).pw_uid
+  except KeyError:
+    uid = member.uid
+
+  try:
+    gid = grp.getgrnam(member.gname).gr_gid
+  except KeyError:
+    gid = member.gid
+
+  return uid, gid
+
+
+def extract_bundle(filename, paths):
+  """Put the files of a bundle that are in paths into place, each one
+  written aside and renamed over the old one; returns the paths extracted"""
+  extracted = []
+  try:
+    with tarfile.open(filename, 'r:gz') as tar:
+      for member in tar:
+        path = '/' + member.name
+        if path not in paths or not member.isreg():
+          continue
+
+        # Anything but a file (or a missing parent) is left to rsync
+        dirname = os.path.dirname(path)
+        if os.path.isdir(path) or not os.path.isdir(dirname):
+          continue
+
+        tmp = os.path.join(dirname, '.%s.bundle' % os.path.basename(path))
+        try:
+          with open(tmp, 'wb') as file:
+            shutil.copyfileobj(tar.extractfile(member), file)
+
+          try:
+            os.lchown(tmp, *owner(member))
+          except OSError:
+            pass # not root
+
+          os.chmod(tmp, member.mode)
+          os.utime(tmp, (member.mtime, member.mtime))
+          os.rename(tmp, path)
+
+        except (IOError, OSError), e:
+          logging.info("Unable to extract %s from bundle: %s" % (path, e))
+          if os.path.exists(tmp): os.remove(tmp)
+          continue
+
+        extracted.append(path)
+
+  except (IOError, OSError, tarfile.TarError), e:
+    logging.info("Unable to read bundle %s: %s" % (filename, e))
+
+  return extracted
@@ -3,6 +3,7 @@
 import os
 import sys
 import shlex
+import threading
 from subprocess import Popen, PIPE
 
 WORKDIRS = ['./var','./var/log','./data']
@@ -39,6 +40,14 @@ def pid_file_del(filename):
     os.remove(filename)
   
 
+def file_mtime(filename):
+  # None when it does not exist
+  try:
+    return os.path.getmtime(filename)
+  except OSError:
+    return None
+    
+
 def run(command, detached=False):
   if detached:
     if fork():
@@ -60,28 +69,73 @@ def run(command, detached=False):
     
   return p.wait(), output, error
   
-def run_multi(commands, detached=False):
-  # collect output in parallel
-  def _get_lines(process):
-    return process.communicate()[0].splitlines()
+def run_stream(command, on_line=None):
+  """Run command calling on_line() with every line of its output as soon as
+  it arrives (nothing is kept); returns (retval, error) with the whole
+  stderr apart"""
+  p = Popen(
+    command,
+    bufsize=1,
+    stdin=PIPE, stdout=PIPE, stderr=PIPE,
+    universal_newlines=True,
+    env=os.environ.copy(),
+    close_fds=(os.name == 'posix')
+  )
+  p.stdin.close()
+  
+  # Read stderr aside so a full pipe never blocks the command
+  error = []
+  reader = threading.Thread(target=lambda: error.append(p.stderr.read()))
+  reader.daemon = True
+  reader.start()
+  
+  for line in iter(p.stdout.readline, ''):
+    if on_line: on_line(line.rstrip('\n'))
+    
+  reader.join()
+  p.stdout.close()
+  p.stderr.close()
+  
+  return p.wait(), ''.join(error)
+  
 
+def run_multi(commands, workers=4, on_line=None, on_done=None):
+  """Run commands with at most workers at the same time; returns the
+  (retval, output, error) of every command in the same order.
+  
+  With on_line the output is streamed to on_line(index of the command,
+  line) instead (one call at a time) and returned empty. on_done(index,
+  retval, seconds) is called as each command finishes.
+  """
   from multiprocessing.dummy import Pool # thread pool
+  from time import time
+  
+  if not commands:
+    return []
+    
+  lock = threading.Lock()
+  def execute(item):
+    def line(text):
+      with lock: on_line(item[0], text)
+      
+    started = time()
+    if on_line:
+      retval, error = run_stream(item[1], line)
+      result = retval, '', error
+    else:
+      result = run(item[1])
       
-  processes = list()
-  for cmd in commands:
-    processes.append(subprocess.Popen(
-      cmd,
-      bufsize=0,
-      stdin=PIPE, stdout=PIPE, stderr=PIPE,
-      universal_newlines=True,
-      env=os.environ.copy(),
-      close_fds=(os.name == 'posix')
-  ))
-
-  outputs = Pool(len(processes)).map(_get_lines, processes)
-  exitcodes = [p.wait() for p in processes]
-
-  print "out: %s" % outputs
+    if on_done:
+      with lock: on_done(item[0], result[0], time() - started)
+    return result
+    
+  pool = Pool(max(1, min(workers, len(commands))))
+  try:
+    return pool.map(execute, enumerate(commands), chunksize=1)
+    
+  finally:
+    pool.close()
+    pool.join()
 
 
 def load_config_role(filename):
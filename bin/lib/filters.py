@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+import re
+import fnmatch
+
+WILDCARDS = '*?['
+
+
+class _Node():
+  __slots__ = ('children', 'entries', 'value')
+
+  def __init__(self):
+    self.children = {}
+    self.entries = []   # (partial component, pattern index)
+    self.value = None
+
+
+class PrefixTrie():
+  """Map paths to values, looked up by whole path components.
+
+  lookup('/etc/nginx/sites/a') finds a value stored for '/etc/nginx' but
+  lookup('/etc/nginx.old') does not.
+  """
+
+  def __init__(self, items=None):
+    self.root = _Node()
+    self.size = 0
+    for path, value in (items or []):
+      self.add(path, value)
+
+  def __len__(self):
+    return self.size
+
+  def add(self, path, value=True):
+    node = self.root
+    for comp in path.rstrip('/').split('/'):
+      node = node.children.setdefault(comp, _Node())
+
+    if node.value is None: self.size += 1
+    node.value = value
+
+  def lookup(self, path):
+    """Value of the longest stored prefix of path or None"""
+    found = None
+    node = self.root
+    for comp in path.split('/'):
+      node = node.children.get(comp)
+      if node is None: break
+      if node.value is not None: found = node.value
+
+    return found
+
+
+class PathFilter():
+  """List of fnmatch patterns compiled into a single matcher.
+
+  Results are the same as calling fnmatch.fnmatch() with every pattern:
+  literal patterns are a dict lookup, patterns with a literal head are
+  found through a trie keyed on that head and the rest are joined into a
+  single regular expression, so matching cost does not depend on the
+  number of patterns.
+  """
+
+  def __init__(self, patterns):
+    self.patterns = list(patterns)
+    self.regexes = []
+    self.exact = {}       # literal pattern -> [index]
+    self.floating = []    # indexes of patterns starting with a wildcard
+    self.root = _Node()
+
+    for idx, pattern in enumerate(self.patterns):
+      regex = fnmatch.translate(pattern)
+      self.regexes.append(re.compile(regex))
+
+      head = self.literal_head(pattern)
+      if head == pattern:
+        self.exact.setdefault(pattern, []).append(idx)
+
+      elif head:
+        comps = head.split('/')
+        node = self.root
+        for comp in comps[:-1]:
+          node = node.children.setdefault(comp, _Node())
+        node.entries.append((comps[-1], idx))
+
+      else:
+        self.floating.append(idx)
+
+    self.combined = None
+    if self.floating:
+      self.combined = re.compile('|'.join(
+        '(?:%s)' % re.sub(r'\(\?[a-zA-Z]+\)$', '', fnmatch.translate(self.patterns[idx]))
+        for idx in self.floating
+      ), re.S | re.M)
+
+  def __len__(self):
+    return len(self.patterns)
+
+  @staticmethod
+  def literal_head(pattern):
+    for pos, char in enumerate(pattern):
+      if char in WILDCARDS:
+        return pattern[:pos]
+
+    return pattern
+
+  def candidates(self, path):
+    # Patterns whose literal head is a prefix of path
+    comps = path.split('/')
+    node = self.root
+    for comp in comps:
+      for partial, idx in node.entries:
+        if comp.startswith(partial):
+          yield idx
+
+      node = node.children.get(comp)
+      if node is None: break
+
+  def match(self, path):
+    """True if any pattern matches path"""
+    if path in self.exact:
+      return True
+
+    if self.combined is not None and self.combined.match(path):
+      return True
+
+    for idx in self.candidates(path):
+      if self.regexes[idx].match(path):
+        return True
+
+    return False
+
+  def matches(self, path):
+    """Indexes of all the patterns matching path (in pattern order)"""
+    found = list(self.exact.get(path, []))
+
+    if self.combined is not None and self.combined.match(path):
+      found.extend([idx for idx in self.floating if self.regexes[idx].match(path)])
+
+    found.extend([idx for idx in self.candidates(path) if self.regexes[idx].match(path)])
+    return sorted(found)
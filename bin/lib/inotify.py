@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+import os
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+import logging
+import threading
+
+IN_ACCESS        = 0x00000001
+IN_MODIFY        = 0x00000002
+IN_ATTRIB        = 0x00000004
+IN_CLOSE_WRITE   = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN          = 0x00000020
+IN_MOVED_FROM    = 0x00000040
+IN_MOVED_TO      = 0x00000080
+IN_CREATE        = 0x00000100
+IN_DELETE        = 0x00000200
+IN_DELETE_SELF   = 0x00000400
+IN_MOVE_SELF     = 0x00000800
+IN_UNMOUNT       = 0x00002000
+IN_Q_OVERFLOW    = 0x00004000
+IN_IGNORED       = 0x00008000
+IN_ONLYDIR       = 0x01000000
+IN_DONT_FOLLOW   = 0x02000000
+IN_ISDIR         = 0x40000000
+
+IN_CLOEXEC  = 0o2000000
+IN_NONBLOCK = 0o4000
+
+FLAGS = dict((name, value) for name, value in globals().items() if name.startswith('IN_'))
+
+EVENT = struct.Struct('iIII')
+READ_SIZE = 1024 * 1024
+
+_libc = None
+
+
+def libc():
+  global _libc
+  if _libc is None:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _libc.inotify_init1.argtypes = [ctypes.c_int]
+    _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    _libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+  return _libc
+
+
+class Watcher():
+  """Recursive inotify watches read through epoll, without pyinotify.
+
+  wait() blocks on the inotify descriptor and read_events() decodes every
+  pending event straight from the read buffer, yielding (pathname, mask,
+  cookie) tuples. New directories are watched as they appear and the files
+  created in them before the watch was set are reported as IN_CREATE.
+  Watches may be added from another thread while events are read.
+  """
+
+  def __init__(self, mask, exclude=None):
+    self.mask = mask | IN_CREATE | IN_MOVED_FROM | IN_MOVED_TO
+    self.exclude = exclude or []
+    self.wds = {}     # wd -> path
+    self.paths = {}   # path -> wd
+    self.failed = []  # directories that could not be watched
+    self.lock = threading.Lock()
+
+    self.fd = libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, 'inotify_init1: ' + os.strerror(err))
+
+    self.epoll = select.epoll()
+    self.epoll.register(self.fd, select.EPOLLIN)
+
+  def __len__(self):
+    return len(self.wds)
+
+  def close(self):
+    self.epoll.close()
+    os.close(self.fd)
+
+  def excluded(self, path):
+    for regex in self.exclude:
+      if regex.search(path):
+        return True
+
+    return False
+
+  def add_watch(self, path):
+    wd = libc().inotify_add_watch(self.fd, path, self.mask | IN_DONT_FOLLOW)
+    if wd < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, 'inotify_add_watch: ' + os.strerror(err), path)
+
+    with self.lock:
+      old = self.wds.get(wd)
+      if old is not None and old != path:
+        self.paths.pop(old, None)
+
+      self.wds[wd] = path
+      self.paths[path] = wd
+
+    return wd
+
+  def add_tree(self, path, created=False):
+    """Watch path and its subdirectories, returns the paths found inside
+    when created is True (they may have been missed before the watch)"""
+    found = []
+    if self.excluded(path): return found
+
+    try:
+      self.add_watch(path)
+    except OSError, e:
+      self.watch_failed(path, e)
+      return found
+
+    if not os.path.isdir(path) or os.path.islink(path):
+      return found
+
+    for root, dirs, files in os.walk(path):
+      for name in list(dirs):
+        subdir = os.path.join(root, name)
+        if self.excluded(subdir) or os.path.islink(subdir):
+          dirs.remove(name)
+          continue
+
+        try:
+          self.add_watch(subdir)
+        except OSError, e:
+          self.watch_failed(subdir, e)
+          dirs.remove(name)
+
+      if created:
+        found.extend([(os.path.join(root, name), IN_CREATE | IN_ISDIR) for name in dirs])
+        found.extend([(os.path.join(root, name), IN_CREATE) for name in files])
+
+    return found
+
+  def watch_failed(self, path, error):
+    # Vanished directories are not an error
+    if error.errno == errno.ENOENT: return
+    logging.info("Unable to watch %s: %s" % (path, error.strerror))
+    self.failed.append(path)
+
+  def rm_tree(self, path):
+    prefix = path + '/'
+    with self.lock:
+      for wpath in [p for p in self.paths if p == path or p.startswith(prefix)]:
+        wd = self.paths.pop(wpath)
+        self.wds.pop(wd, None)
+        libc().inotify_rm_watch(self.fd, wd)
+
+  def move_tree(self, src, dst):
+    prefix = src + '/'
+    with self.lock:
+      for wpath in [p for p in self.paths if p == src or p.startswith(prefix)]:
+        wd = self.paths.pop(wpath)
+        self.wds[wd] = dst + wpath[len(src):]
+        self.paths[self.wds[wd]] = wd
+
+  def wait(self, timeout=None):
+    """Block until events are available or timeout (seconds) expires"""
+    if timeout is None: timeout = -1
+    try:
+      return bool(self.epoll.poll(timeout))
+    except IOError, e:
+      if e.errno == errno.EINTR: return False
+      raise
+
+  def read(self):
+    chunks = []
+    while True:
+      try:
+        chunk = os.read(self.fd, READ_SIZE)
+      except OSError, e:
+        if e.errno in (errno.EAGAIN, errno.EINTR): break
+        raise
+
+      if not chunk: break
+      chunks.append(chunk)
+
+    return chunks
+
+  def read_events(self):
+    """Decode all pending events into (pathname, mask, cookie) tuples.
+
+    Queue overflows are reported with a None pathname and watches removed
+    by the kernel (IN_IGNORED) with the path they were watching.
+    """
+    unpack = EVENT.unpack_from
+    size = EVENT.size
+    wds = self.wds
+    moved_dirs = {}   # cookie -> source of a directory move
+
+    for buf in self.read():
+      pos, end = 0, len(buf)
+      while pos < end:
+        wd, mask, cookie, length = unpack(buf, pos)
+        pos += size
+        name = buf[pos:pos + length].split('\0', 1)[0]
+        pos += length
+
+        if mask & IN_Q_OVERFLOW:
+          yield None, mask, cookie
+          continue
+
+        if mask & IN_IGNORED:
+          with self.lock:
+            path = wds.pop(wd, None)
+            if path is None or self.paths.get(path) != wd: continue
+            del self.paths[path]
+
+          yield path, mask, cookie
+          continue
+
+        path = wds.get(wd)
+        if path is None: continue
+
+        if name:
+          path = path + '/' + name
+
+        if mask & IN_ISDIR:
+          if mask & IN_MOVED_FROM:
+            moved_dirs[cookie] = path
+
+          elif mask & IN_MOVED_TO and moved_dirs.get(cookie) in self.paths:
+            self.move_tree(moved_dirs.pop(cookie), path)
+
+          elif mask & (IN_CREATE | IN_MOVED_TO):
+            moved_dirs.pop(cookie, None)
+            yield path, mask, cookie
+            for item in self.add_tree(path, created=True):
+              yield item[0], item[1], 0
+            continue
+
+        yield path, mask, cookie
+
+    # Directories moved out of the watched trees
+    for path in moved_dirs.values():
+      self.rm_tree(path)
@@ -0,0 +1,670 @@
+#!/usr/bin/env python
+
+import os
+import bisect
+import struct
+import logging
+
+from time import time
+
+UPDATE = 'U'
+DELETE = 'D'
+RENAME = 'R'   # path is source + '\0' + destination
+
+DEFAULT_MAX_ENTRIES = 100000
+DEFAULT_SEGMENT_SIZE = 8 * 1024 * 1024
+DEFAULT_MAX_BUNDLES = 64   # bundles announced in journal.head
+
+# Segment: header + records. A record is
+#   varint seq delta, op, varint shared prefix, varint suffix length, suffix
+# Every RESTART_INTERVAL records (and at the start of every write) the path
+# is stored in full and an (seq, offset) entry is added to the .idx file,
+# so a reader can start decoding at any index entry.
+MAGIC = 'ASJ1'
+HEADER = struct.Struct('<4s8sQ')   # magic, generation, first seq
+INDEX_ENTRY = struct.Struct('<QQ')  # seq, offset
+RESTART_INTERVAL = 64
+
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+HEAD_FILE = 'journal.head'
+
+
+def encode_varint(value):
+  out = []
+  while value > 0x7f:
+    out.append(chr((value & 0x7f) | 0x80))
+    value >>= 7
+
+  out.append(chr(value))
+  return ''.join(out)
+
+
+def decode_varint(buf, pos):
+  result = shift = 0
+  while True:
+    byte = ord(buf[pos])
+    pos += 1
+    result |= (byte & 0x7f) << shift
+    if not byte & 0x80:
+      return result, pos
+    shift += 7
+
+
+def segment_name(first_seq):
+  return '%016d%s' % (first_seq, SEGMENT_SUFFIX)
+
+
+def index_name(name):
+  return name[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+
+
+def rename_path(src, dst):
+  return src + '\0' + dst
+
+
+def split_rename(path):
+  """(source, destination) of a rename record path"""
+  return tuple(path.split('\0', 1))
+
+
+def encode_records(records, last_seq, offset):
+  """Encode [(seq, op, path)]; returns (data, index entries)"""
+  out, index = [], []
+  size = 0
+  prev = ''
+  for count, (seq, op, path) in enumerate(records):
+    shared = 0
+    if count % RESTART_INTERVAL:
+      limit = min(len(prev), len(path))
+      while shared < limit and prev[shared] == path[shared]:
+        shared += 1
+
+    else:
+      index.append(INDEX_ENTRY.pack(seq, offset + size))
+
+    record = encode_varint(seq - last_seq) + op + encode_varint(shared) + \
+      encode_varint(len(path) - shared) + path[shared:]
+
+    out.append(record)
+    size += len(record)
+    last_seq, prev = seq, path
+
+  return ''.join(out), index
+
+
+def decode_records(buf, pos, seq):
+  """Yield (seq, op, path, end offset) from buf[pos:]; seq is the sequence
+  of the record at pos. Stops silently at a truncated record."""
+  prev = ''
+  first = True
+  end = len(buf)
+  while pos < end:
+    try:
+      delta, cur = decode_varint(buf, pos)
+      op = buf[cur]
+      shared, cur = decode_varint(buf, cur + 1)
+      length, cur = decode_varint(buf, cur)
+
+    except IndexError:
+      return
+
+    if cur + length > end: return
+    path = prev[:shared] + buf[cur:cur + length]
+    pos = cur + length
+
+    if not first: seq += delta
+    first = False
+    prev = path
+    yield seq, op, path, pos
+
+
+def write_head(data_dir, journal_id, seq, tail, segments, bundles=()):
+  """Atomically write the journal.head announcing segments and bundles
+  [(name, first, last)]"""
+  lines = [
+    'id %s' % journal_id,
+    'head %d' % seq,
+    'tail %d' % tail,
+  ]
+  for name, first, last in segments:
+    if last >= first:
+      lines.append('segment %s %d %d' % (name, first, last))
+
+  for name, first, last in bundles:
+    lines.append('bundle %s %d %d' % (name, first, last))
+
+  filename = os.path.join(data_dir, HEAD_FILE)
+  with open(filename + '.tmp', 'w') as file:
+    file.write('\n'.join(lines) + '\n')
+
+  os.rename(filename + '.tmp', filename)
+
+
+class JournalReader():
+  """Read records from the journal segments in data_dir"""
+
+  def __init__(self, data_dir='./data'):
+    self.data_dir = data_dir
+
+  def head(self):
+    """Parsed journal.head: id, head, tail, segments and bundles
+    [(name, first, last)]"""
+    head = {'id': None, 'head': 0, 'tail': 0, 'segments': [], 'bundles': []}
+    try:
+      with open(os.path.join(self.data_dir, HEAD_FILE)) as file:
+        for line in file:
+          fields = line.split()
+          if not fields: continue
+
+          if fields[0] == 'segment':
+            head['segments'].append((fields[1], int(fields[2]), int(fields[3])))
+
+          elif fields[0] == 'bundle':
+            head['bundles'].append((fields[1], int(fields[2]), int(fields[3])))
+
+          elif fields[0] == 'id':
+            head['id'] = fields[1]
+
+          else:
+            head[fields[0]] = int(fields[1])
+
+    except (IOError, ValueError, IndexError):
+      pass
+
+    return head
+
+  def segments(self):
+    """[(name, first seq)] of the segments on disk"""
+    names = [name for name in os.listdir(self.data_dir) if name.endswith(SEGMENT_SUFFIX)]
+    return [(name, int(name[:-len(SEGMENT_SUFFIX)])) for name in sorted(names)]
+
+  def index(self, name):
+    try:
+      with open(os.path.join(self.data_dir, index_name(name)), 'rb') as file:
+        data = file.read()
+
+    except IOError:
+      return []
+
+    return [INDEX_ENTRY.unpack_from(data, pos)
+      for pos in range(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size)]
+
+  def generation(self, name):
+    """Generation of a segment (it changes when the segment is rewritten)"""
+    try:
+      with open(os.path.join(self.data_dir, name), 'rb') as file:
+        header = file.read(HEADER.size)
+
+    except IOError:
+      return None
+
+    if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+      return None
+
+    return HEADER.unpack(header)[1].encode('hex')
+
+  def read_segment(self, name, after=0, offset=None, last=None):
+    """Yield (seq, op, path, offset after the record) with seq > after
+    (and up to last when given: a segment may hold records past the head
+    announced).
+
+    Decoding starts at offset when given, which must be the end of a
+    complete append whose last record was after (see Cursor); otherwise
+    at the last index entry before after.
+    """
+    try:
+      file = open(os.path.join(self.data_dir, name), 'rb')
+    except IOError:
+      return
+
+    with file:
+      header = file.read(HEADER.size)
+      if len(header) < HEADER.size: return
+      magic, generation, first = HEADER.unpack(header)
+      if magic != MAGIC:
+        logging.info("Invalid journal segment: %s" % name)
+        return
+
+      size = os.fstat(file.fileno()).st_size
+      seq, pos = first, HEADER.size
+      if offset is not None:
+        seq, pos = after + 1, offset
+
+      else:
+        index = [entry for entry in self.index(name) if entry[1] < size]
+        found = bisect.bisect_right(index, (after + 1, size)) - 1
+        if found >= 0:
+          seq, pos = index[found]
+
+      file.seek(pos)
+      data = file.read()
+
+    for record in decode_records(data, 0, seq):
+      if last is not None and record[0] > last:
+        return
+
+      if record[0] > after:
+        yield record[:3] + (pos + record[3],)
+
+  def batches(self, after=0):
+    """Yield (segment name, [(seq, op, path)]) with the records after seq
+    up to the head"""
+    head = self.head()
+    ranges = dict((name, last) for name, first, last in head['segments'])
+    for name, first in self.segments():
+      if ranges.get(name, after + 1) <= after: continue
+
+      records = [record[:3] for record in self.read_segment(name, after, last=head['head'])]
+      if records:
+        yield name, records
+
+
+class Cursor():
+  """Position of a reader in the journal, persisted in filename.
+
+  seq is the last sequence applied. segment, generation and offset point
+  to the end of the last complete append read, so the next read decodes
+  from there instead of looking the segment index up. offset is None when
+  unknown (or the segment was rewritten by a compaction).
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.journal_id = None
+    self.seq = 0
+    self.segment = self.generation = self.offset = None
+    self.load()
+
+  def load(self):
+    try:
+      with open(self.filename) as file:
+        fields = file.read().split()
+
+      self.journal_id, self.seq = fields[0], int(fields[1])
+      if len(fields) == 5:
+        self.segment, self.generation, self.offset = fields[2], fields[3], int(fields[4])
+
+    except (IOError, ValueError, IndexError):
+      pass
+
+  def save(self):
+    fields = [self.journal_id or '-', str(self.seq)]
+    if self.segment and self.offset is not None:
+      fields.extend([self.segment, self.generation, str(self.offset)])
+
+    with open(self.filename + '.tmp', 'w') as file:
+      file.write(' '.join(fields) + '\n')
+
+    os.rename(self.filename + '.tmp', self.filename)
+
+  def reset(self, journal_id, seq=0):
+    self.journal_id, self.seq = journal_id, seq
+    self.segment = self.generation = self.offset = None
+
+  def read(self, reader, segments, last=None):
+    """Yield (segment name, [(seq, op, path)]) of the records after seq (up
+    to last) in segments and move the cursor past them (save() is left to
+    the caller)"""
+    for name in segments:
+      generation = reader.generation(name)
+      offset = None
+      if name == self.segment and generation == self.generation:
+        offset = self.offset
+
+      records, end = [], offset
+      for seq, op, path, end in reader.read_segment(name, self.seq, offset, last):
+        records.append((seq, op, path))
+
+      # Only the end of the file is known to be the end of an append
+      self.segment, self.generation = name, generation
+      self.offset = None
+      if end is not None and end == os.path.getsize(os.path.join(reader.data_dir, name)):
+        self.offset = end
+
+      if records:
+        self.seq = records[-1][0]
+        yield name, records
+
+
+class JournalWriter():
+  """Append-only journal segments with monotonic sequence numbers.
+
+  Every append() is a single write to the active segment, followed by its
+  index entries and an atomic rewrite of journal.head, which is what the
+  slaves read to know the sequence range available.
+  """
+
+  def __init__(self, data_dir='./data', segment_size=DEFAULT_SEGMENT_SIZE):
+    self.data_dir = data_dir
+    self.segment_size = segment_size
+    self.reader = JournalReader(data_dir)
+
+    head = self.reader.head()
+    self.id = head['id'] or os.urandom(8).encode('hex')
+    self.seq = head['head']
+    self.segments = []   # [name, first, last]
+    self.active = None
+    self.size = 0
+
+    # Archives with the content of the small files of a flush
+    self.bundles = [list(bundle) for bundle in head['bundles']
+      if os.path.exists(os.path.join(data_dir, bundle[0]))]
+
+    known = dict((segment[0], segment[2]) for segment in head['segments'])
+    for name, first in self.reader.segments():
+      self.segments.append([name, first, known.get(name, first - 1)])
+
+    if self.segments:
+      self.recover(self.segments[-1])
+
+    for segment in self.segments[:-1]:
+      if segment[2] < segment[1]:
+        for seq, op, path, pos in self.reader.read_segment(segment[0]):
+          segment[2] = seq
+
+  def recover(self, segment):
+    # Find the last complete record of the newest segment and drop the rest
+    name = segment[0]
+    path = os.path.join(self.data_dir, name)
+    end, last = HEADER.size, segment[1] - 1
+    for seq, op, _path, pos in self.reader.read_segment(name):
+      end, last = pos, seq
+
+    if os.path.getsize(path) > end:
+      logging.info("Truncating journal segment %s at %d" % (name, end))
+      with open(path, 'r+b') as file:
+        file.truncate(end)
+
+      index = [entry for entry in self.reader.index(name) if entry[1] < end]
+      with open(os.path.join(self.data_dir, index_name(name)), 'wb') as file:
+        file.write(''.join([INDEX_ENTRY.pack(*entry) for entry in index]))
+
+    segment[2] = last
+    self.seq = max(self.seq, last)
+    self.active = segment
+    self.size = end
+
+  def append(self, records):
+    """Append [(op, path)] to the journal; returns the last sequence"""
+    if not records:
+      return self.seq
+
+    first = self.seq + 1
+    records = [(first + count, op, path) for count, (op, path) in enumerate(records)]
+
+    if self.active is None or self.size >= self.segment_size:
+      self.active = [segment_name(first), first, first - 1]
+      self.segments.append(self.active)
+      with open(os.path.join(self.data_dir, self.active[0]), 'wb') as file:
+        file.write(HEADER.pack(MAGIC, os.urandom(8), first))
+
+      self.size = HEADER.size
+
+    data, index = encode_records(records, self.seq, self.size)
+    with open(os.path.join(self.data_dir, self.active[0]), 'ab') as file:
+      file.write(data)
+
+    with open(os.path.join(self.data_dir, index_name(self.active[0])), 'ab') as file:
+      file.write(''.join(index))
+
+    self.size += len(data)
+    self.seq = self.active[2] = records[-1][0]
+    self.write_head()
+    return self.seq
+
+  def write_head(self):
+    write_head(self.data_dir, self.id, self.seq,
+      self.segments and self.segments[0][1] or self.seq + 1, self.segments, self.bundles)
+
+  def add_bundle(self, name, first, last, max_count=DEFAULT_MAX_BUNDLES):
+    """Announce the bundle of records first to last in journal.head (with
+    the max_count newest ones at most)"""
+    self.bundles.append([name, first, last])
+    self.prune_bundles(max_count=max_count)
+    self.write_head()
+
+  def prune_bundles(self, max_age=None, max_count=None):
+    # Bundles of records no longer in the journal, older than max_age
+    # seconds or past the max_count newest (slaves rsync those files)
+    tail = self.segments and self.segments[0][1] or self.seq + 1
+    oldest = max_age is not None and time() - max_age
+    expired = []
+    for count, bundle in enumerate(self.bundles):
+      if bundle[2] < tail or (max_count is not None and count < len(self.bundles) - max_count):
+        expired.append(bundle)
+        continue
+
+      if oldest:
+        try:
+          if os.path.getmtime(os.path.join(self.data_dir, bundle[0])) < oldest:
+            expired.append(bundle)
+        except OSError:
+          expired.append(bundle)
+
+    for bundle in expired:
+      logging.debug("Removing expired bundle: %s" % bundle[0])
+      try:
+        os.remove(os.path.join(self.data_dir, bundle[0]))
+      except OSError:
+        pass
+
+      self.bundles.remove(bundle)
+
+    return len(expired)
+
+  def compact(self, compact_age, retention, bundle_age=None):
+    """Drop segments older than retention (and bundles older than
+    bundle_age) and merge the ones older than compact_age keeping only the
+    latest record of every path"""
+    now = time()
+    closed = self.segments[:-1]
+
+    def mtime(name):
+      return os.path.getmtime(os.path.join(self.data_dir, name))
+
+    expired = [segment for segment in closed if mtime(segment[0]) < now - retention]
+    for segment in expired:
+      logging.info("Removing expired journal segment: %s" % segment[0])
+      self.remove(segment)
+
+    dropped = self.prune_bundles(bundle_age)
+
+    old = [segment for segment in self.segments[:-1] if mtime(segment[0]) < now - compact_age]
+    if len(old) < 2:
+      if expired or dropped: self.write_head()
+      return
+
+    # Renames are barriers: records before them are not merged with the
+    # ones after (they may refer to the path before it was renamed)
+    records, latest = [], {}
+    for name, first, last in old:
+      for seq, op, path, pos in self.reader.read_segment(name):
+        if op == RENAME:
+          records.extend(sorted(latest.values()))
+          records.append((seq, op, path))
+          latest = {}
+
+        else:
+          latest[path] = (seq, op, path)
+
+    records.extend(sorted(latest.values()))
+    name = old[0][0]
+    mtimes = max([mtime(segment[0]) for segment in old])
+    tmp = os.path.join(self.data_dir, name + '.tmp')
+
+    data, index = encode_records(records, records[0][0], HEADER.size)
+    with open(tmp, 'wb') as file:
+      file.write(HEADER.pack(MAGIC, os.urandom(8), records[0][0]) + data)
+
+    with open(tmp + INDEX_SUFFIX, 'wb') as file:
+      file.write(''.join(index))
+
+    os.utime(tmp, (mtimes, mtimes))
+    os.rename(tmp + INDEX_SUFFIX, os.path.join(self.data_dir, index_name(name)))
+    os.rename(tmp, os.path.join(self.data_dir, name))
+
+    for segment in old[1:]:
+      self.remove(segment)
+
+    old[0][1], old[0][2] = records[0][0], old[-1][2]
+    logging.info("Compacted %d journal segments into %s (%d records)" % \
+      (len(old), name, len(records)))
+    self.write_head()
+
+  def remove(self, segment):
+    for name in (segment[0], index_name(segment[0])):
+      try:
+        os.remove(os.path.join(self.data_dir, name))
+      except OSError:
+        pass
+
+    self.segments.remove(segment)
+
+
+class ChangeSet():
+  """Coalesce filesystem changes per path keeping them in a valid order.
+
+  Repeated changes of the same path are merged and a delete cancels the
+  previous create/write of that path. Renames are kept in the order they
+  happened: pending changes of the source (or below it) are moved after
+  the rename with their new path, and a source created in this same set
+  (not known by the slaves yet) is turned into an update of the
+  destination. changes() returns the resulting [(op, path)], sorted by
+  path between renames.
+  """
+
+  def __init__(self):
+    self.records = []   # [op, path, new] in arrival order
+    self.index = {}     # path -> position in records
+    self.renames = 0
+
+  def __len__(self):
+    return len(self.index) + self.renames
+
+  def add(self, path, op=UPDATE, new=False):
+    """Record a change; new=True means path did not exist before"""
+    pos = self.index.get(path)
+
+    if pos is None:
+      self.index[path] = len(self.records)
+      self.records.append([op, path, new])
+
+    elif op == UPDATE:
+      # create + write, write + write, delete + create: one update
+      self.records[pos][0] = UPDATE
+
+    elif self.records[pos][0] != DELETE:
+      # Delete cancels earlier create/write
+      record = self.records[pos]
+      self.records[pos] = None
+      del self.index[path]
+
+      if not record[2]:
+        # Path existed before this window: slaves must delete it
+        self.index[path] = len(self.records)
+        self.records.append([DELETE, path, False])
+
+  def pop(self, path, tree=False):
+    """Remove the pending records of path (and below it when tree is True);
+    returns [(relative path, op, new)]"""
+    paths = [path]
+    if tree:
+      prefix = path + '/'
+      paths.extend([_path for _path in self.index if _path.startswith(prefix)])
+
+    found = []
+    for _path in paths:
+      pos = self.index.pop(_path, None)
+      if pos is None: continue
+
+      op, _path, new = self.records[pos]
+      self.records[pos] = None
+      found.append((_path[len(path):], op, new))
+
+    return found
+
+  def rename(self, src, dst, is_dir=False):
+    moved = self.pop(src, is_dir)
+
+    # Destination (and whatever was below it) is replaced
+    replaced = self.pop(dst, is_dir)
+
+    if moved and moved[0][0] == '' and moved[0][2]:
+      # Source is new: slaves only need the destination, which is new only
+      # when it was itself created in this set (else a delete must reach them)
+      new = bool(replaced and replaced[0][0] == '' and replaced[0][2])
+      self.add(dst, UPDATE, new)
+      return
+
+    self.records.append([RENAME, rename_path(src, dst), False])
+    self.renames += 1
+    for rel, op, new in moved:
+      self.add(dst + rel, op, new)
+
+  def changes(self):
+    out, group = [], []
+    for record in self.records:
+      if not record: continue
+
+      if record[0] == RENAME:
+        out.extend([(op, path) for path, op in sorted(group)])
+        out.append((RENAME, record[1]))
+        group = []
+
+      else:
+        group.append((record[1], record[0]))
+
+    out.extend([(op, path) for path, op in sorted(group)])
+    return out
+
+  def clear(self):
+    self.records = []
+    self.index = {}
+    self.renames = 0
+
+
+class ChangeJournal(ChangeSet):
+  """Coalesce filesystem changes (see ChangeSet) and write them in batches.
+
+  Changes are kept in memory until flush() is called (once per master
+  tick) and then appended to the journal with a single write. When more
+  than max_entries paths are pending the buffer is spilled to disk before
+  the tick ends. on_flush is called with the [(op, path)] written.
+  """
+
+  def __init__(self, writer, max_entries=DEFAULT_MAX_ENTRIES, on_flush=None):
+    ChangeSet.__init__(self)
+    self.writer = writer
+    self.max_entries = max_entries
+    self.on_flush = on_flush
+
+  def add(self, path, op=UPDATE, new=False):
+    ChangeSet.add(self, path, op, new)
+    self.spill()
+
+  def rename(self, src, dst, is_dir=False):
+    ChangeSet.rename(self, src, dst, is_dir)
+    self.spill()
+
+  def spill(self):
+    if len(self.index) >= self.max_entries:
+      logging.info("JOURNAL FULL (%d entries): Spilling to disk" % len(self.index))
+      self.flush()
+
+  def flush(self):
+    """Append pending changes to the journal; returns entries written"""
+    # Sorted paths share longer prefixes; order only matters around renames
+    records = self.changes()
+    self.clear()
+
+    if not records:
+      return 0
+
+    seq = self.writer.append(records)
+    logging.info("WRITTING %d CHANGES: Journal version %d" % (len(records), seq))
+
+    if self.on_flush:
+      self.on_flush(records)
+
+    return len(records)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+import os
+import stat
+import struct
+import sqlite3
+import hashlib
+import threading
+import Queue
+
+from time import time
+
+from journal import encode_varint, decode_varint
+
+MANIFEST_FILE = './var/manifest.db'
+EXPORT_FILE = 'manifest.dat'
+
+# Export: header + records sorted by path. A record is
+#   varint shared prefix, varint suffix length, suffix, varint size,
+#   varint mtime, hash length (0 or 20), hash
+EXPORT_MAGIC = 'ASM1'
+EXPORT_HEADER = struct.Struct('<4sQQ')   # magic, journal seq, records
+HASH_CHUNK = 1024 * 1024
+HASH_RETRY = 60              # seconds before hashing a file that failed again
+HASH_RETRY_MAX = 3600 * 6    # doubled on each failure up to this
+
+
+class Manifest():
+  """Persisted (inode, size, mtime, ctime, hash) index of the watched files"""
+
+  def __init__(self, filename=MANIFEST_FILE):
+    self.filename = filename
+    self.db = sqlite3.connect(filename)
+    self.db.text_factory = str
+    self.db.execute('PRAGMA synchronous = OFF')
+    self.db.execute(
+      'CREATE TABLE IF NOT EXISTS files ('
+      '  path TEXT PRIMARY KEY, dir TEXT,'
+      '  inode INTEGER, size INTEGER, mtime REAL, ctime REAL, hash TEXT,'
+      '  hash_failures INTEGER, hash_retry REAL)'
+    )
+    self.db.execute('CREATE INDEX IF NOT EXISTS files_dir ON files (dir)')
+
+    # Manifests written before hashes (and their failures) were kept
+    columns = [row[1] for row in self.db.execute('PRAGMA table_info(files)')]
+    for column, type in (('hash', 'TEXT'), ('hash_failures', 'INTEGER'), ('hash_retry', 'REAL')):
+      if column not in columns:
+        self.db.execute('ALTER TABLE files ADD COLUMN %s %s' % (column, type))
+
+  def __len__(self):
+    return self.db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+  @staticmethod
+  def key(st):
+    return (st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+
+  def get(self, path):
+    row = self.db.execute(
+      'SELECT inode, size, mtime, ctime FROM files WHERE path = ?', (path,)
+    ).fetchone()
+    return row and tuple(row)
+
+  def directory(self, dirname):
+    """{name: key} of the files indexed in dirname"""
+    rows = self.db.execute(
+      'SELECT path, inode, size, mtime, ctime FROM files WHERE dir = ?', (dirname,)
+    )
+    return dict((os.path.basename(row[0]), tuple(row[1:])) for row in rows)
+
+  def entry(self, path):
+    """(key, hash) of path or None"""
+    row = self.db.execute(
+      'SELECT inode, size, mtime, ctime, hash FROM files WHERE path = ?', (path,)
+    ).fetchone()
+    return row and (tuple(row[:4]), row[4])
+
+  def hashes(self, dirname):
+    """{name: (key, hash)} of the files indexed in dirname"""
+    rows = self.db.execute(
+      'SELECT path, inode, size, mtime, ctime, hash FROM files WHERE dir = ?', (dirname,)
+    )
+    return dict((os.path.basename(row[0]), (tuple(row[1:5]), row[5])) for row in rows)
+
+  def files(self):
+    """Yield (path, hash or None) of every file"""
+    for row in self.db.execute('SELECT path, hash FROM files'):
+      yield row[0], row[1]
+
+  def directories(self, path):
+    """Indexed directories at or below path"""
+    rows = self.db.execute(
+      'SELECT DISTINCT dir FROM files WHERE dir = ? OR (dir >= ? AND dir < ?)',
+      (path, path + '/', path + '0')
+    )
+    return set(row[0] for row in rows)
+
+  def update(self, path, key):
+    """Store the stat key of path (and forget its hash and failures)"""
+    self.db.execute(
+      'INSERT OR REPLACE INTO files (path, dir, inode, size, mtime, ctime, hash) '
+      'VALUES (?, ?, ?, ?, ?, ?, NULL)', (path, os.path.dirname(path)) + tuple(key)
+    )
+
+  def set_hash(self, path, key, digest):
+    """False (and ignored) when the file changed while it was being hashed"""
+    return self.db.execute(
+      'UPDATE files SET hash = ? WHERE path = ? AND inode = ? AND size = ? '
+      'AND mtime = ? AND ctime = ?', (digest, path) + tuple(key)
+    ).rowcount > 0
+
+  def hash_failed(self, path, now=None):
+    # Retried after HASH_RETRY seconds, twice as long on each failure
+    self.db.execute(
+      'UPDATE files SET hash_failures = IFNULL(hash_failures, 0) + 1, '
+      'hash_retry = ? + MIN(?, ? << MIN(IFNULL(hash_failures, 0), 16)) '
+      'WHERE path = ? AND hash IS NULL', (now or time(), HASH_RETRY_MAX, HASH_RETRY, path)
+    )
+
+  def unhashed(self, limit, now=None):
+    """Files without hash, those never tried (or retried longest ago) first"""
+    rows = self.db.execute(
+      'SELECT path FROM files WHERE hash IS NULL AND (hash_retry IS NULL OR hash_retry <= ?) '
+      'ORDER BY hash_retry LIMIT ?', (now or time(), limit)
+    )
+    return [row[0] for row in rows]
+
+  def remove(self, path):
+    self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+
+  def remove_directory(self, dirname):
+    self.db.execute('DELETE FROM files WHERE dir = ?', (dirname,))
+
+  def remove_tree(self, path):
+    self.db.execute(
+      'DELETE FROM files WHERE path = ? OR (path >= ? AND path < ?)',
+      (path, path + '/', path + '0')
+    )
+
+  def refresh(self, path, exclude=None):
+    """Update path (a file or a whole directory) from the filesystem"""
+    try:
+      st = os.lstat(path)
+    except OSError:
+      self.remove_tree(path)
+      return
+
+    if stat.S_ISREG(st.st_mode):
+      if not (exclude and exclude.match(path)) and self.get(path) != self.key(st):
+        self.update(path, self.key(st))
+      return
+
+    if not stat.S_ISDIR(st.st_mode):
+      return
+
+    for root, dirs, files in os.walk(path):
+      for name in files:
+        filename = os.path.join(root, name)
+        try:
+          st = os.lstat(filename)
+        except OSError:
+          continue
+
+        if not stat.S_ISREG(st.st_mode) or (exclude and exclude.match(filename)):
+          continue
+
+        if self.get(filename) != self.key(st):
+          self.update(filename, self.key(st))
+
+  def export(self, filename, seq=0):
+    """Write every file (sorted by path) to filename in one sequential file"""
+    rows = self.db.execute('SELECT path, size, mtime, hash FROM files ORDER BY path')
+    out = []
+    prev = ''
+    count = 0
+    for path, size, mtime, digest in rows:
+      limit = min(len(prev), len(path))
+      shared = 0
+      while shared < limit and prev[shared] == path[shared]:
+        shared += 1
+
+      digest = digest and digest.decode('hex') or ''
+      out.append(encode_varint(shared) + encode_varint(len(path) - shared) + \
+        path[shared:] + encode_varint(size) + encode_varint(int(mtime)) + \
+        chr(len(digest)) + digest)
+      prev = path
+      count += 1
+
+    with open(filename + '.tmp', 'wb') as file:
+      file.write(EXPORT_HEADER.pack(EXPORT_MAGIC, seq, count))
+      file.write(''.join(out))
+
+    os.rename(filename + '.tmp', filename)
+    return count
+
+  def commit(self):
+    self.db.commit()
+
+  def close(self):
+    self.db.commit()
+    self.db.close()
+
+
+def read_export(filename):
+  """Yield (path, size, mtime, hex hash or None) from an exported manifest"""
+  with open(filename, 'rb') as file:
+    data = file.read()
+
+  if len(data) < EXPORT_HEADER.size: return
+  magic, seq, count = EXPORT_HEADER.unpack_from(data)
+  if magic != EXPORT_MAGIC: return
+
+  pos = EXPORT_HEADER.size
+  prev = ''
+  for i in xrange(count):
+    shared, pos = decode_varint(data, pos)
+    length, pos = decode_varint(data, pos)
+    path = prev[:shared] + data[pos:pos + length]
+    size, pos = decode_varint(data, pos + length)
+    mtime, pos = decode_varint(data, pos)
+    hlen = ord(data[pos])
+    digest = data[pos + 1:pos + 1 + hlen].encode('hex') or None
+    pos += 1 + hlen
+    prev = path
+    yield path, size, mtime, digest
+
+
+def hash_file(path):
+  """(key, sha1) of path or None if it changed while reading it"""
+  try:
+    before = Manifest.key(os.lstat(path))
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+      while True:
+        chunk = file.read(HASH_CHUNK)
+        if not chunk: break
+        digest.update(chunk)
+
+    if Manifest.key(os.lstat(path)) != before:
+      return None
+
+  except (IOError, OSError):
+    return None
+
+  return before, digest.hexdigest()
+
+
+class Hasher():
+  """Pool of threads hashing files in the background.
+
+  submit() queues paths and collect() returns the (path, key, hash) results
+  available so far (key and hash are None when the file could not be
+  hashed); the manifest is only written from the caller's thread.
+  """
+
+  def __init__(self, workers=2):
+    self.todo = Queue.Queue()
+    self.done = Queue.Queue()
+    self.pending = 0
+
+    for i in range(max(1, int(workers))):
+      thread = threading.Thread(target=self.worker)
+      thread.daemon = True
+      thread.start()
+
+  def worker(self):
+    while True:
+      path = self.todo.get()
+      self.done.put((path, hash_file(path)))
+
+  def submit(self, paths):
+    for path in paths:
+      self.pending += 1
+      self.todo.put(path)
+
+  def collect(self):
+    results = []
+    while True:
+      try:
+        path, result = self.done.get_nowait()
+      except Queue.Empty:
+        break
+
+      self.pending -= 1
+      results.append((path, result and result[0], result and result[1]))
+
+    return results
@@ -2,18 +2,39 @@
 
 import os
 import sys
+import re
 import signal
 import logging
-import fnmatch
+import threading
 
 from pyinotify import *
-from time import time, sleep
+from time import time
 
 from common import *
+from journal import ChangeJournal, JournalWriter, UPDATE, DELETE, RENAME, split_rename
+from filters import PathFilter, PrefixTrie
+from manifest import Manifest, Hasher, EXPORT_FILE
+from scanner import Scanner, WatchRegistrar
+from notify import NotifyServer
+from merkle import build_tree, export_tree, TREE_FILE
+from bundle import bundle_name, write_bundle
+from metrics import Metrics, MetricsServer, COUNTER, GAUGE, HISTOGRAM
+from profiling import Profiler
+
+import inotify
 
 LOG_FILE = './var/log/ackstorm-sync-master.log'
 CONFIG_FILE = './etc/master_conf.py'
 VERSION_FILE = './var/.version'
+DATA_DIR = './data'
+COMPACT_INTERVAL = 600
+HASH_BATCH = 10000
+METRICS_FILE = './var/ackstorm-sync-master.prom'
+WATCH_RETRY_INTERVAL = 60
+
+# Options applied on restart only (reload_config warns about them)
+RESTART_OPTIONS = ['inotify_backend', 'notify_address', 'metrics_address', 'hash_workers',
+  'journal_segment_size', 'daemonize']
 
 DEFAULT_EVENTS = [
     "IN_CLOSE_WRITE",
@@ -24,37 +45,90 @@ DEFAULT_EVENTS = [
 ]
 
 
+class IndexedWatchManager(WatchManager):
+  """WatchManager with a path -> wd index so get_wd() does not scan every
+  watch (it is called for each directory created)
+
+  Entries are checked against the watch they point to, so the ones of
+  removed watches are just misses. pyinotify does not follow directories
+  moved inside the tree: move_tree() renames their watches (as
+  inotify.Watcher does) when the master sees the move.
+  """
+  def __init__(self, *args, **kwargs):
+    WatchManager.__init__(self, *args, **kwargs)
+    self.paths = {}
+    
+  def add_watch(self, *args, **kwargs):
+    # Also called by pyinotify itself for the directories it auto adds
+    wds = WatchManager.add_watch(self, *args, **kwargs)
+    for path, wd in wds.items():
+      if wd >= 0: self.paths[os.path.normpath(path)] = wd
+      
+    return wds
+    
+  def del_watch(self, wd):
+    watch = self.watches.get(wd)
+    if watch is not None and self.paths.get(watch.path) == wd:
+      del self.paths[watch.path]
+      
+    WatchManager.del_watch(self, wd)
+    
+  def get_wd(self, path):
+    path = os.path.normpath(path)
+    wd = self.paths.get(path)
+    watch = self.watches.get(wd)
+    if watch is not None and watch.path == path:
+      return wd
+      
+    return None
+    
+  def move_tree(self, src, dst):
+    prefix = src + '/'
+    for watch in self.watches.values():
+      if watch.path == src or watch.path.startswith(prefix):
+        if self.paths.get(watch.path) == watch.wd:
+          del self.paths[watch.path]
+          
+        watch.path = dst + watch.path[len(src):]
+        self.paths[watch.path] = watch.wd
+        
+    
 class SyncMaster():
   class Inotify(ProcessEvent):
+    def my_init(self, master=None):
+      self.master = master
+
     def process_default(self, event):
-      inotify_file = os.path.join(event.path, event.name)
-      logging.debug("caught %s on %s" % \
-          (event.maskname, inotify_file))
-          
-      # Process excludes
-      for exclude in config.excludes:
-        logging.debug("exclude?? %s <> %s" %(inotify_file, exclude))
-        if fnmatch.fnmatch(inotify_file, exclude):
-          logging.info("EXCLUDED FILE: %s" % inotify_file)
-          return
-        
-      extra = '';
-      if event.maskname.startswith('IN_DELETE') or \
-        event.maskname.startswith('IN_MOVED_FROM'):
-          extra = '#DELETE:'
+      # Watches of a directory moved inside the tree follow it (pyinotify
+      # paired the move by cookie), before the events below its new path
+      src = getattr(event, 'src_pathname', None)
+      if event.dir and event.mask & inotify.IN_MOVED_TO and src:
+        self.master.wm.move_tree(src, event.pathname)
+        
+      self.master.process_event(event.pathname, event.mask, getattr(event, 'cookie', 0))
+      
+      # New directories pyinotify could not watch (auto_add), not the ones
+      # that vanished meanwhile
+      if event.dir and event.mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO) and \
+        self.master.wm.get_wd(event.pathname) is None and os.path.isdir(event.pathname) and \
+        not self.master.pruned(event.pathname):
+          self.master.watch_failed(event.pathname)
           
-      # Write changes files
-      _time = str(int(time()))
-      changes_file = './data/' + _time + '.inotify'
-      logging.info("WRITTING CHANGES ON: %s" % changes_file)
-  
-      with open(changes_file, 'a') as file:
-        file.write("%s%s\n" %(extra,inotify_file))
+    def process_IN_Q_OVERFLOW(self, event):
+      self.master.overflow()
+      
+    def process_IN_IGNORED(self, event):
+      self.master.watch_removed(event.path)
 
   def __init__(self):
     # Create required folders
     create_dirs()
+    started = time()
     self.config = self.load_config()
+    self.config_mtime = file_mtime(CONFIG_FILE)
+    self.reload_requested = False
+    self.timings = {'config': time() - started}
+    self.mask = reduce(lambda x,y: x|y, [inotify.FLAGS[e] for e in DEFAULT_EVENTS])
     
   def run(self, pid_file):
     # Check and write pid
@@ -64,10 +138,6 @@ class SyncMaster():
 
     pid_file_write(pid_file)
     
-    # Set config as global
-    global config
-    config = self.config
-
     # Configure logging
     loglevel = logging.INFO
     if self.config.verbose: loglevel = logging.DEBUG
@@ -76,85 +146,593 @@ class SyncMaster():
     logging.info("STARTING...")
     
     # Catch signals
+    self.profiler = Profiler('master', self.config.profile_log_threshold)
     self.catch_signals()
-  
-    wm = WatchManager()
-    ev = self.Inotify()
     
-    # exclude our working dirs (var and data)
-    excludes = ['^' + os.path.abspath('./var'), '^' + os.path.abspath('./data')]
-    excludes = excludes + config.inotify_excludes
+    writer = JournalWriter(DATA_DIR, self.config.journal_segment_size)
+    self.journal = ChangeJournal(writer, self.config.journal_max_entries, self.journal_flushed)
+    self.compacted = time()
+    logging.info("Journal version: %d" % writer.seq)
+    
+    # Slaves waiting on the notify server fetch as soon as the journal moves
+    self.notify = None
+    if self.config.notify_address:
+      self.notify = NotifyServer(self.config.notify_address)
+      self.notify.publish(writer.id, writer.seq)
+      self.notify.start()
+    
+    self.manifest = Manifest()
+    self.hasher = Hasher(self.config.hash_workers)
+    self.exported = self.tree_exported = 0
+    self.tree_thread = None
+    self.manifest_dirty = self.tree_dirty = True
+    
+    # Watches lost or never set are rescanned until they can be watched
+    self.wm = self.watcher = self.registrar = None
+    self.registrars = []
+    self.indexing = set()
+    self.moving = None
+    self.since = self.last_run = self.read_last_run()
+    self.catching_up = set(self.config.watch_paths)
+    self.timings['out_of_sync'] = 0
+    self.prune = [re.compile(regex) for regex in self.watch_excludes()]
+    self.unwatched = set()
+    self.rescans = set()
+    self.retried = time()
+    self.first_change = None
+    self.start_metrics()
+    self.profiler.metrics = self.metrics
+  
+    if self.config.inotify_backend == 'native':
+      self.run_native()
+      
+    else:
+      self.run_pyinotify()
   
-    notifier = AsyncNotifier(wm, ev, read_freq=10)
-    mask = reduce(lambda x,y: x|y, [EventsCodes.ALL_FLAGS[e] for e in DEFAULT_EVENTS])
-    excl = ExcludeFilter(excludes)
-    wds = wm.add_watch(self.config.watch_paths, mask, rec=True, exclude_filter=excl, auto_add=True)
+    pid_file_del(pid_file)
+    self.end()
+    
+  def start_metrics(self):
+    metrics = self.metrics = Metrics()
+    metrics.declare('events_total', COUNTER, 'Filesystem events received')
+    metrics.declare('events_excluded_total', COUNTER, 'Events on excluded paths')
+    metrics.declare('overflows_total', COUNTER, 'Inotify queue overflows')
+    metrics.declare('watch_failures_total', COUNTER, 'Directories that could not be watched')
+    metrics.declare('watches_lost_total', COUNTER, 'Watches removed by the kernel')
+    metrics.declare('rescanned_paths_total', COUNTER, 'Paths compared against the manifest')
+    metrics.declare('journal_records_total', COUNTER, 'Records written to the journal')
+    metrics.declare('journal_flush_seconds', HISTOGRAM, 'Seconds from an event to its journal flush')
+    metrics.declare('journal_seq', GAUGE, 'Journal head sequence')
+    metrics.declare('journal_bytes', GAUGE, 'Size of the journal segments')
+    metrics.declare('journal_segments', GAUGE, 'Journal segments')
+    metrics.declare('watches', GAUGE, 'Directories watched')
+    metrics.declare('unwatched_paths', GAUGE, 'Directories polled while they can not be watched')
+    metrics.declare('hash_pending', GAUGE, 'Files being hashed for the manifest')
+    metrics.declare('startup_seconds', GAUGE, 'Seconds spent in each startup phase')
+    metrics.declare('phase_seconds', HISTOGRAM, 'Seconds spent in each phase of a cycle')
+    
+    if self.config.metrics_address:
+      MetricsServer(metrics, self.config.metrics_address).start()
+      
+  def run_pyinotify(self):
+    self.wm = IndexedWatchManager()
+    ev = self.Inotify(master=self)
     
-    # Check if there are out of sync files from last run
-    self.check_out_of_sync(self.config.watch_paths)
+    notifier = AsyncNotifier(self.wm, ev, read_freq=10)
+    self.register_watches()
     
+    # Same schedule as run_native: check_events() blocks until an event
+    # comes without a timeout, which would starve tick() on an idle tree
     logging.info("Main process started")
+    debounce = self.config.inotify_debounce
+    profiler = self.profiler
+    first_change = None
+    last_run = 0
     while True:
       try:
-        notifier.process_events()
-        if notifier.check_events():
-          notifier.read_events()
+        timeout = self.config.sleep
+        if first_change is not None: timeout = debounce
+        
+        with profiler.span('wait'):
+          ready = notifier.check_events(timeout=int(timeout * 1000))
+          
+        if ready:
+          with profiler.span('events'):
+            notifier.read_events()
+            notifier.process_events()
+            self.end_moves()
+            
+          if first_change is None and len(self.journal):
+            first_change = time()
+            
+        if not ready or (first_change is not None and time() - first_change >= debounce * 10):
+          with profiler.span('journal_flush'):
+            self.journal.flush()
+          first_change = None
           
-        self.update_last_run(int(time()))
-        sleep(self.config.sleep)
+        if time() - last_run >= self.config.sleep:
+          last_run = int(time())
+          self.tick()
     
       except KeyboardInterrupt:
         logging.info("killed by keyboard interrupt")
-        self.update_last_run(int(time()))
+        self.journal.flush()
+        if not self.catching_up: self.update_last_run(int(time()))
         notifier.stop()
         break
-  
-    pid_file_del(pid_file)
-    self.end()
-  
-  def check_out_of_sync(self,paths):
-    last_run = None
-    if os.path.isfile(VERSION_FILE):
-      with open(VERSION_FILE, 'r') as file:
-        last_run = file.read()
-  
-    if last_run:
-      newer_files=[]
-      _time = str(int(time()))
-      for path in paths:
-        logging.info("Looking for out of sync files at: %s" % path)
         
-        # Find files newer than VERSION_FILE
-        _cmd = 'find ' + path + ' -type f -cnewer ' + VERSION_FILE
-        out,std,err = run(shlex.split(_cmd))
+  def run_native(self):
+    # Block on the inotify descriptor and flush the journal once events
+    # stop for inotify_debounce seconds (or 10 times that under load)
+    watcher = self.watcher = inotify.Watcher(self.mask, self.prune)
+    self.register_watches()
+    
+    logging.info("Main process started")
+    debounce = self.config.inotify_debounce
+    profiler = self.profiler
+    first_change = None
+    last_run = 0
+    while True:
+      try:
+        timeout = self.config.sleep
+        if first_change is not None: timeout = debounce
         
-        for line in std.split('\n'):
-          if not line: continue
+        with profiler.span('wait'):
+          ready = watcher.wait(timeout)
           
-          # Process excludes
-          skip_this = False
-          for exclude in config.excludes:
-            if fnmatch.fnmatch(line, exclude):
-              logging.debug("EXCLUDED FILE: %s" % line)
-              skip_this = True
-              
-          if skip_this: continue
-          logging.info('File out of sync: %s' % line)
-          newer_files.append(line)
-  
-      if newer_files:
-          changes_file = './data/' +  str(int(time())) + '.sync';
-          logging.info("Writting on: %s" % changes_file)
-          with open(changes_file, 'a') as file:
-            file.write("%s\n" %('\n'.join(newer_files)))
+        if ready:
+          with profiler.span('events'):
+            for path, mask, cookie in watcher.read_events():
+              if mask & inotify.IN_Q_OVERFLOW:
+                self.overflow()
+                
+              elif mask & inotify.IN_IGNORED:
+                self.watch_removed(path)
+                
+              else:
+                self.process_event(path, mask, cookie)
+                
+            self.end_moves()
+            for path in watcher.failed:
+              self.watch_failed(path)
+            del watcher.failed[:]
+            
+          if first_change is None and len(self.journal):
+            first_change = time()
             
-          self.update_last_run(_time)
+        # Flush once quiet (or under load) but tick on time anyway: events
+        # that never reach the journal (excluded paths) must not starve it
+        if not ready or (first_change is not None and time() - first_change >= debounce * 10):
+          with profiler.span('journal_flush'):
+            self.journal.flush()
+          first_change = None
+          
+        if time() - last_run >= self.config.sleep:
+          last_run = int(time())
+          self.tick()
           
+      except KeyboardInterrupt:
+        logging.info("killed by keyboard interrupt")
+        self.journal.flush()
+        if not self.catching_up: self.update_last_run(int(time()))
+        watcher.close()
+        break
+        
+  def process_event(self, path, mask, cookie=0):
+    self.metrics.inc('events_total')
+    if self.first_change is None: self.first_change = time()
+    
+    # A move is kept until the next event: it is a rename when that one
+    # is the matching IN_MOVED_TO, otherwise the source left the tree
+    moving, self.moving = self.moving, None
+    if moving and mask & inotify.IN_MOVED_TO and cookie and cookie == moving[2]:
+      self.process_rename(moving[0], path, mask)
+      return
+      
+    if moving:
+      self.process_change(*moving[:2])
+      
+    if mask & inotify.IN_MOVED_FROM and cookie:
+      self.moving = (path, mask, cookie)
+      return
+      
+    self.process_change(path, mask)
+    
+  def end_moves(self):
+    # Moves not matched by the last event read
+    if self.moving:
+      self.process_change(*self.moving[:2])
+      self.moving = None
+      
+  def process_change(self, path, mask):
+    if not mask & self.mask: return
+    logging.debug("caught %x on %s", mask, path)
+    
+    # Process excludes
+    if self.config.exclude_filter.match(path):
+      logging.info("EXCLUDED FILE: %s" % path)
+      self.metrics.inc('events_excluded_total')
+      return
+      
+    if mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+      self.journal.add(path, DELETE)
+      
+    else:
+      new = bool(mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO))
+      self.journal.add(path, UPDATE, new)
+      
+  def process_rename(self, src, dst, mask):
+    logging.debug("caught rename %s -> %s", src, dst)
+    
+    # Renames from or to excluded paths are a delete or a create
+    if self.config.exclude_filter.match(src):
+      self.process_change(dst, mask)
+      
+    elif self.config.exclude_filter.match(dst):
+      self.process_change(src, inotify.IN_MOVED_FROM)
+      
     else:
+      self.journal.rename(src, dst, bool(mask & inotify.IN_ISDIR))
+      
+  def register_watches(self, paths=None):
+    # Watches are registered in background, breadth first, so the events of
+    # the directories already watched are journaled from the start
+    registrar = WatchRegistrar(self.add_watch, paths or self.config.watch_paths,
+      self.config.scan_workers, self.prune)
+    registrar.start()
+    
+    if self.registrar is None: self.registrar = registrar # startup
+    self.registrars.append(registrar)
+    
+  def add_watch(self, path):
+    # Watch a single directory (called from the registration thread)
+    if self.config.watch_filter.lookup(path) is None:
+      return True # watch path removed meanwhile
+      
+    with self.profiler.span('watch_registration'):
+      return self.add_watch_path(path)
+      
+  def add_watch_path(self, path):
+    if self.wm is not None:
+      wd = self.wm.add_watch(path, self.mask, auto_add=True,
+        exclude_filter=ExcludeFilter(self.watch_excludes())).get(path)
+      return (wd is not None and wd >= 0) or not os.path.exists(path)
+      
+    self.watcher.add_watch(path)
+    return True
+    
+  def catch_up(self):
+    # Once the tree of a watch path is watched, scan it for the files
+    # changed while we were not running or before its watch was set
+    paths = []
+    for registrar in list(self.registrars):
+      while registrar.failed:
+        self.watch_failed(registrar.failed.pop(0))
+        
+      while not registrar.registered.empty():
+        paths.append(registrar.registered.get())
+        
+      if not registrar.is_alive() and registrar.registered.empty():
+        self.registrars.remove(registrar)
+        
+    paths = [path for path in paths if path in self.config.watch_paths]
+    if not paths:
+      return
+      
+    # Paths added by a reload are only indexed (slaves sync them in full)
+    added = [path for path in paths if path in self.indexing]
+    if added:
+      logging.info("Indexing added watch paths: %s" % ', '.join(added))
+      self.indexing.difference_update(added)
+      with self.profiler.span('out_of_sync'):
+        self.rescan(added, indexing=True)
+        
+    paths = [path for path in paths if path not in added]
+    if not paths or not self.catching_up:
+      return
+      
+    self.check_out_of_sync(paths)
+    self.catching_up.difference_update(paths)
+    if not self.catching_up:
+      self.timings['watches'] = self.registrar.elapsed
+      for phase in ('config', 'watches', 'out_of_sync'):
+        self.metrics.set('startup_seconds', round(self.timings[phase], 3), phase=phase)
+      logging.info("STARTUP: config %.2fs, watches %.2fs, out of sync %.2fs" % \
+        (self.timings['config'], self.timings['watches'], self.timings['out_of_sync']))
+        
+  def check_out_of_sync(self,paths):
+    started = time()
+    logging.info("Looking for out of sync files at: %s" % ', '.join(paths))
+    with self.profiler.span('out_of_sync'):
+      self.rescan(paths, self.since)
+    self.timings['out_of_sync'] += time() - started
+    
+  def rescan(self, paths, since=None, indexing=False):
+    # Compare files against the manifest of the last run. Without manifest
+    # (first run after an upgrade) fall back to files changed after last run.
+    # When indexing, files missing from the manifest are only added to it
+    manifest = self.manifest
+    indexed = len(manifest) > 0
+    if not indexed and not since:
       logging.debug("No last version found: Starting from 0")
   
+    changes = 0
+    visited = set()
+    scanner = Scanner(self.config.scan_workers, self.prune)
+    
+    for dirname, files, complete in scanner.scan(paths):
+      visited.add(dirname)
+      known = {}
+      if complete: known = manifest.directory(dirname)
+      
+      for name, st in files:
+        path = os.path.join(dirname, name)
+        if self.config.exclude_filter.match(path):
+          logging.debug("EXCLUDED FILE: %s" % path)
+          continue
+          
+        key = Manifest.key(st)
+        old = known.pop(name, None) if complete else manifest.get(path)
+        if old == key: continue
+        
+        manifest.update(path, key)
+        if old is None and (indexing or not indexed and (not since or st.st_ctime <= since)):
+          continue
+          
+        logging.info('File out of sync: %s' % path)
+        self.journal.add(path, UPDATE)
+        changes += 1
+          
+      # Files deleted while we were not running
+      for name in known:
+        changes += self.deleted_out_of_sync(os.path.join(dirname, name))
+        
+    for path in paths:
+      # Watched file removed
+      if manifest.get(path) and not os.path.isfile(path):
+        changes += self.deleted_out_of_sync(path)
+        continue
+        
+      # Directories not found anymore
+      for dirname in manifest.directories(path) - visited:
+        if not scanner.pruned(dirname):
+          for name in manifest.directory(dirname):
+            changes += self.deleted_out_of_sync(os.path.join(dirname, name))
+            
+        manifest.remove_directory(dirname)
+        
+    manifest.commit()
+    if changes:
+      logging.info("Files out of sync: %d" % changes)
+      
+    self.journal.flush()
+    return changes
+    
+  def deleted_out_of_sync(self, path):
+    self.manifest.remove(path)
+    if self.config.exclude_filter.match(path):
+      return 0
+      
+    logging.info('File deleted out of sync: %s' % path)
+    self.journal.add(path, DELETE)
+    return 1
+  
+  def watch(self, path):
+    # Watch path recursively (failures are rescanned later)
+    if self.wm is not None:
+      wds = self.wm.add_watch(path, self.mask, rec=True, auto_add=True,
+        exclude_filter=ExcludeFilter(self.watch_excludes()))
+      failed = [_path for _path, wd in wds.items() if wd < 0 and os.path.isdir(_path)]
+      
+    else:
+      self.watcher.add_tree(path)
+      failed = list(self.watcher.failed)
+      del self.watcher.failed[:]
+      
+    for _path in failed:
+      self.watch_failed(_path)
+      
+    return failed
+    
+  def watch_count(self):
+    if self.wm is not None:
+      return len(self.wm.watches)
+      
+    return len(self.watcher)
+    
+  def watch_failed(self, path):
+    if path in self.unwatched: return
+    logging.info("UNABLE TO WATCH: %s (check fs.inotify.max_user_watches)" % path)
+    self.metrics.inc('watch_failures_total')
+    self.unwatched.add(path)
+    self.rescans.add(path)
+    
+  def watch_removed(self, path):
+    # The kernel dropped a watch of a directory that still exists
+    if not os.path.isdir(path) or self.pruned(path): return
+    if self.config.watch_filter.lookup(path) is None: return # unwatched
+    logging.info("WATCH LOST: %s" % path)
+    self.metrics.inc('watches_lost_total')
+    self.unwatched.add(path)
+    self.rescans.add(path)
+    
+  def overflow(self):
+    # Events were lost: compare everything against the manifest
+    logging.info("INOTIFY QUEUE OVERFLOW: Rescanning watch paths")
+    self.metrics.inc('overflows_total')
+    self.rescans.update(self.config.watch_paths)
+    
+  def pruned(self, path):
+    for regex in self.prune:
+      if regex.search(path):
+        return True
+        
+    return False
+    
+  def recover(self):
+    # Watch again the directories we lost and poll them meanwhile
+    if self.unwatched and time() - self.retried >= WATCH_RETRY_INTERVAL:
+      self.retried = time()
+      paths, self.unwatched = topmost(self.unwatched), set()
+      for path in paths:
+        if os.path.isdir(path):
+          self.watch(path)
+          self.rescans.add(path)
+          
+    if self.rescans:
+      paths, self.rescans = topmost(self.rescans), set()
+      self.metrics.inc('rescanned_paths_total', len(paths))
+      logging.info("Rescanning: %s" % ', '.join(paths))
+      with self.profiler.span('rescan'):
+        self.rescan(paths, self.last_run)
+      
+  def write_metrics(self):
+    metrics = self.metrics
+    writer = self.journal.writer
+    size = 0
+    for segment in writer.segments:
+      try:
+        size += os.path.getsize(os.path.join(DATA_DIR, segment[0]))
+      except OSError:
+        pass
+        
+    metrics.set('journal_seq', writer.seq)
+    metrics.set('journal_bytes', size)
+    metrics.set('journal_segments', len(writer.segments))
+    metrics.set('watches', self.watch_count())
+    metrics.set('unwatched_paths', len(self.unwatched))
+    metrics.set('hash_pending', self.hasher.pending)
+    metrics.write(METRICS_FILE)
+    
+  def watch_excludes(self):
+    # exclude our working dirs (var and data)
+    excludes = ['^' + os.path.abspath('./var'), '^' + os.path.abspath('./data')]
+    return excludes + self.config.inotify_excludes
+    
+  def tick(self):
+    # Housekeeping of the main loops, which ends a profiler cycle
+    profiler = self.profiler
+    self.check_config()
+    self.catch_up()
+    self.recover()
+    if not self.catching_up:
+      self.update_last_run(int(time()))
+      
+    with profiler.span('compact'):
+      self.compact_journal()
+      
+    with profiler.span('manifest'):
+      self.maintain_manifest()
+      
+    self.write_metrics()
+    profiler.cycle()
+    
+  def journal_flushed(self, records):
+    self.metrics.inc('journal_records_total', len(records))
+    if self.first_change is not None:
+      self.metrics.observe('journal_flush_seconds', time() - self.first_change)
+      self.first_change = None
+      
+    # Keep the manifest in step with the journal
+    for op, path in records:
+      if op == DELETE:
+        self.manifest.remove_tree(path)
+        
+      elif op == RENAME:
+        src, dst = split_rename(path)
+        self.manifest.remove_tree(src)
+        self.manifest.refresh(dst, self.config.exclude_filter)
+        
+      else:
+        self.manifest.refresh(path, self.config.exclude_filter)
+        
+    self.manifest.commit()
+    self.manifest_dirty = self.tree_dirty = True
+    
+    # Content of the small files goes next to the journal
+    if self.config.bundle_file_size:
+      self.write_bundle(records)
+      
+    if self.notify:
+      self.notify.publish(self.journal.writer.id, self.journal.writer.seq)
+    
+  def write_bundle(self, records):
+    writer = self.journal.writer
+    first = writer.seq - len(records) + 1
+    name = bundle_name(first)
+    
+    paths = [path for op, path in records if op == UPDATE]
+    count = write_bundle(os.path.join(DATA_DIR, name), paths, self.config.bundle_file_size)
+    if count:
+      writer.add_bundle(name, first, writer.seq, self.config.bundle_max_count)
+      logging.debug("Bundle %s: %d files" % (name, count))
+      
+  def maintain_manifest(self):
+    # Store hashes computed in background and queue more files to hash
+    # (files that vanished or changed meanwhile are retried later, backing off)
+    results = self.hasher.collect()
+    for path, key, digest in results:
+      if digest is None or not self.manifest.set_hash(path, key, digest):
+        self.manifest.hash_failed(path)
+        
+    if results:
+      self.manifest.commit()
+      self.manifest_dirty = self.tree_dirty = True
+      
+    if not self.hasher.pending:
+      self.hasher.submit(self.manifest.unhashed(HASH_BATCH))
+      
+    # Export it through the updates module
+    if self.manifest_dirty and time() - self.exported >= self.config.manifest_export_interval:
+      count = self.manifest.export(os.path.join(DATA_DIR, EXPORT_FILE), self.journal.writer.seq)
+      logging.debug("Manifest exported: %d files (%d being hashed)" % (count, self.hasher.pending))
+      self.exported = time()
+      self.manifest_dirty = False
+      
+    # and the hash tree slaves compare with theirs before a full sync (built
+    # in background from a snapshot, one at a time)
+    interval = self.config.merkle_export_interval
+    if interval and self.tree_dirty and time() - self.tree_exported >= interval and \
+      not (self.tree_thread and self.tree_thread.is_alive()):
+      self.tree_thread = threading.Thread(target=self.write_tree,
+        args=(list(self.manifest.files()), list(self.config.watch_paths), self.journal.writer.seq))
+      self.tree_thread.daemon = True
+      self.tree_thread.start()
+      self.tree_exported = time()
+      self.tree_dirty = False
+      
+  def write_tree(self, files, roots, seq):
+    with self.profiler.span('tree_export'):
+      try:
+        tree = build_tree(files, roots)
+        count = export_tree(tree, os.path.join(DATA_DIR, TREE_FILE), seq)
+        logging.debug("Hash tree exported: %d directories" % count)
+        
+      except (IOError, OSError), e:
+        logging.error("Unable to export the hash tree: %s" % e)
+        
+
+  def compact_journal(self):
+    if time() - self.compacted < COMPACT_INTERVAL:
+      return
+      
+    self.compacted = time()
+    self.journal.writer.compact(self.config.journal_compact_age, self.config.journal_retention,
+      self.config.bundle_max_age)
+    
+  def read_last_run(self):
+    if os.path.isfile(VERSION_FILE):
+      with open(VERSION_FILE, 'r') as file:
+        last_run = file.read().strip()
+        
+      if last_run:
+        return float(last_run)
+        
+    return None
+    
   def update_last_run(self,_time):
     logging.debug("Update last run: " + str(_time))
+    self.last_run = _time
     with open(VERSION_FILE, 'w') as file:
        file.write("%s" % _time)
        
@@ -162,6 +740,78 @@ class SyncMaster():
     signal.signal(signal.SIGTERM, self.end)
     signal.signal(signal.SIGINT,  self.end)
     
+    # SIGHUP reloads the configuration on the next tick
+    signal.signal(signal.SIGHUP, self.hangup)
+    signal.siginterrupt(signal.SIGHUP, False)
+    
+    # SIGUSR1 starts/stops cProfile, SIGUSR2 dumps it to ./var
+    self.profiler.catch_signals()
+    
+  def hangup(self, signum=None, frame=None):
+    self.reload_requested = True
+    
+  def check_config(self):
+    # Reload on SIGHUP or when the configuration file changed
+    mtime = file_mtime(CONFIG_FILE)
+    if not self.reload_requested and mtime == self.config_mtime:
+      return
+      
+    self.reload_requested = False
+    self.config_mtime = mtime
+    with self.profiler.span('reload'):
+      self.reload_config()
+      
+  def reload_config(self):
+    """Apply a new configuration in place: watches of the watch paths
+    added are registered (and the paths indexed) and the ones of the paths
+    removed dropped, everything else is read from config as it is used"""
+    try:
+      config = self.load_config()
+      
+    except Exception, e:
+      logging.info("CONFIGURATION NOT RELOADED: %s" % e)
+      return
+      
+    old, self.config = self.config, config
+    added = [path for path in config.watch_paths if path not in old.watch_paths]
+    removed = [path for path in old.watch_paths if path not in config.watch_paths]
+    
+    self.prune[:] = [re.compile(regex) for regex in self.watch_excludes()]
+    if self.watcher is not None: self.watcher.exclude = self.prune
+    self.journal.max_entries = config.journal_max_entries
+    self.profiler.threshold = config.profile_log_threshold
+    
+    for path in removed:
+      self.unwatch(path)
+      
+    if added:
+      self.indexing.update(added)
+      self.register_watches(added)
+      
+    logging.info("CONFIGURATION RELOADED: %d watch paths added, %d removed" % (len(added), len(removed)))
+    restart = [name for name in RESTART_OPTIONS if getattr(old, name, None) != getattr(config, name, None)]
+    if restart:
+      logging.info("RESTART NEEDED TO APPLY: %s" % ', '.join(restart))
+      
+  def unwatch(self, path):
+    # Stop watching a watch path removed from the configuration
+    logging.info("Removing watch path: %s" % path)
+    if self.wm is not None:
+      wd = self.wm.get_wd(path)
+      if wd is not None: self.wm.rm_watch(wd, rec=True, quiet=True)
+      
+    elif self.watcher is not None:
+      self.watcher.rm_tree(path)
+      
+    inside = lambda _path: _path == path or _path.startswith(path + '/')
+    for paths in (self.unwatched, self.rescans, self.catching_up, self.indexing):
+      paths.difference_update([_path for _path in paths if inside(_path)])
+      
+    # Indexed again from scratch if it is ever added back
+    self.manifest.remove_tree(path)
+    self.manifest.commit()
+    self.manifest_dirty = self.tree_dirty = True
+    
   def load_config(self):
     if not os.path.isfile(CONFIG_FILE):
       raise RuntimeError, "Configuration file does not exist: %s" % CONFIG_FILE
@@ -175,6 +825,10 @@ class SyncMaster():
     else:
       raise RuntimeError, "Configuration file must be a importable python file ending in .py"
   
+    # Read it again on every load (reload_config)
+    sys.modules.pop(configfile, None)
+    if os.path.exists(CONFIG_FILE + 'c'): os.remove(CONFIG_FILE + 'c')
+    
     sys.path.append(configdir)
     exec("import %s as __config__" % configfile)
     sys.path.remove(configdir)
@@ -199,8 +853,69 @@ class SyncMaster():
     config.sleep = int(config.sleep)
     if config.sleep < 5: config.sleep = 5
     
+    if not "scan_workers" in dir(config):
+      config.scan_workers = 4
+      
+    if not "hash_workers" in dir(config):
+      config.hash_workers = 2
+      
+    if not "manifest_export_interval" in dir(config):
+      config.manifest_export_interval = 60
+      
+    # Files up to this size are shipped in a bundle with the journal
+    if not "bundle_file_size" in dir(config):
+      config.bundle_file_size = 65536
+      
+    if not "merkle_export_interval" in dir(config):
+      config.merkle_export_interval = 600
+      
+    if not "journal_max_entries" in dir(config):
+      config.journal_max_entries = 100000
+
+    config.journal_max_entries = int(config.journal_max_entries)
+    
+    if not "journal_segment_size" in dir(config):
+      config.journal_segment_size = 8 * 1024 * 1024
+      
+    # Merge segments older than journal_compact_age, drop the ones older than
+    # journal_retention (slaves behind it need a full sync)
+    if not "journal_compact_age" in dir(config):
+      config.journal_compact_age = 3600
+      
+    if not "journal_retention" in dir(config):
+      config.journal_retention = 3600*24*7
+      
+    # Bundles are dropped once older than bundle_max_age or past the
+    # bundle_max_count newest (slaves further behind rsync those files)
+    if not "bundle_max_age" in dir(config):
+      config.bundle_max_age = config.journal_compact_age
+      
+    if not "bundle_max_count" in dir(config):
+      config.bundle_max_count = 64
+    
+    if not "inotify_backend" in dir(config):
+      config.inotify_backend = 'pyinotify'
+      
+    if not "inotify_debounce" in dir(config):
+      config.inotify_debounce = 0.2
+      
+    config.inotify_debounce = float(config.inotify_debounce)
+    
+    # Long-poll endpoint for slaves ('host:port' or a Unix socket path),
+    # unauthenticated so only on loopback unless told where slaves are
+    if not "notify_address" in dir(config):
+      config.notify_address = '127.0.0.1:8731'
+      
+    # Prometheus endpoint ('host:port' or a Unix socket, None to disable)
+    if not "metrics_address" in dir(config):
+      config.metrics_address = './var/ackstorm-sync-master.sock'
+      
+    # Cycles busy this long (seconds) log their phases at INFO
+    if not "profile_log_threshold" in dir(config):
+      config.profile_log_threshold = 1.0
+      
     if not "inotify_excludes" in dir(config):
-      inotify_excludes = []
+      config.inotify_excludes = []
   
     if not "watch_paths" in dir(config):
       raise RuntimeError, "no paths given to watch"
@@ -213,9 +928,24 @@ class SyncMaster():
       if not os.path.isabs(wpath):
         config.watch_paths[config.watch_paths.index(wpath)] = os.path.abspath(wpath)
         
+    # Compile matchers once per configuration load
+    config.exclude_filter = PathFilter(config.excludes)
+    config.watch_filter = PrefixTrie([(wpath, wpath) for wpath in config.watch_paths])
+    
     return config
 
   @staticmethod
   def end(signal=None, frame=None):
     logging.info("FINISHED: Bye bye; Hasta otro ratito")
     sys.exit(1)
+
+
+def topmost(paths):
+  """paths without the ones inside another one of them"""
+  found = []
+  for path in sorted(paths):
+    if found and (path == found[-1] or path.startswith(found[-1] + '/')):
+      continue
+    found.append(path)
+
+  return found
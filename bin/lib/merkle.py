@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+import os
+import struct
+import hashlib
+import logging
+
+from multiprocessing.dummy import Pool
+
+from journal import encode_varint, decode_varint
+from manifest import Manifest, hash_file
+from scanner import Scanner
+
+TREE_FILE = 'merkle.dat'
+HASH_CACHE = './var/hashes.db'
+
+# Export: header + one record per directory sorted by path. A record is
+#   varint shared prefix, varint suffix length, suffix, tree hash, files hash
+# where an unknown hash (files not hashed yet) is stored as UNKNOWN
+TREE_MAGIC = 'AST1'
+TREE_HEADER = struct.Struct('<4sQQ')   # magic, journal seq, records
+UNKNOWN = '\0' * 20
+
+
+def build_tree(files, roots):
+  """{directory: (tree hash, files hash)} of files [(path, hex hash or None)]
+
+  The files hash of a directory covers the names and hashes of the files
+  in it and its tree hash covers that plus the tree hashes of the
+  subdirectories.
+  A hash is None when any file below it has no hash yet. Only directories
+  holding files (at any depth) are in the tree. Roots that are files map
+  to their own hash.
+  """
+  roots = set(roots)
+  dirs = {}
+  for path, digest in files:
+    if path in roots:
+      dirs[path] = {'files': [(os.path.basename(path), digest)], 'dirs': [], 'file': digest}
+      continue
+
+    dirname = os.path.dirname(path)
+    node = dirs.get(dirname)
+    if node is None:
+      node = dirs[dirname] = {'files': [], 'dirs': []}
+    node['files'].append((os.path.basename(path), digest))
+
+  # Every directory up to its watch path
+  for dirname in list(dirs):
+    while dirname not in roots:
+      parent = os.path.dirname(dirname)
+      if parent == dirname: break
+
+      node = dirs.get(parent)
+      if node is None:
+        node = dirs[parent] = {'files': [], 'dirs': []}
+        node['dirs'].append(dirname)
+        dirname = parent
+        continue
+
+      node['dirs'].append(dirname)
+      break
+
+  tree = {}
+  for dirname in sorted(dirs, key=lambda path: -path.count('/')):
+    node = dirs[dirname]
+    if 'file' in node:
+      tree[dirname] = (node['file'], node['file'])
+      continue
+
+    files = hashlib.sha1()
+    for name, digest in sorted(node['files']):
+      if digest is None:
+        files = None
+        break
+      files.update('%s\0%s\n' % (name, digest))
+
+    files = files and files.hexdigest()
+    digest = hashlib.sha1(files or '')
+    for subdir in sorted(node['dirs']):
+      subtree = tree[subdir][0]
+      if subtree is None or files is None:
+        digest = None
+        break
+      digest.update('%s\0%s\n' % (os.path.basename(subdir), subtree))
+
+    tree[dirname] = (digest and digest.hexdigest(), files)
+
+  return tree
+
+
+def export_tree(tree, filename, seq=0):
+  out = []
+  prev = ''
+  for path in sorted(tree):
+    limit = min(len(prev), len(path))
+    shared = 0
+    while shared < limit and prev[shared] == path[shared]:
+      shared += 1
+
+    digest, files = tree[path]
+    out.append(encode_varint(shared) + encode_varint(len(path) - shared) + \
+      path[shared:] + (digest and digest.decode('hex') or UNKNOWN) + \
+      (files and files.decode('hex') or UNKNOWN))
+    prev = path
+
+  with open(filename + '.tmp', 'wb') as file:
+    file.write(TREE_HEADER.pack(TREE_MAGIC, seq, len(out)))
+    file.write(''.join(out))
+
+  os.rename(filename + '.tmp', filename)
+  return len(out)
+
+
+def read_tree(filename):
+  """Tree written by export_tree() or None if it can not be read"""
+  try:
+    with open(filename, 'rb') as file:
+      data = file.read()
+
+  except IOError:
+    return None
+
+  if len(data) < TREE_HEADER.size: return None
+  magic, seq, count = TREE_HEADER.unpack_from(data)
+  if magic != TREE_MAGIC: return None
+
+  def unhex(digest):
+    if digest == UNKNOWN: return None
+    return digest.encode('hex')
+
+  tree = {}
+  pos = TREE_HEADER.size
+  prev = ''
+  for i in xrange(count):
+    shared, pos = decode_varint(data, pos)
+    length, pos = decode_varint(data, pos)
+    path = prev[:shared] + data[pos:pos + length]
+    pos += length
+    tree[path] = (unhex(data[pos:pos + 20]), unhex(data[pos + 20:pos + 40]))
+    pos += 40
+    prev = path
+
+  return tree
+
+
+def children(tree):
+  """{directory: [subdirectories]} of a tree"""
+  found = {}
+  for path in tree:
+    found.setdefault(os.path.dirname(path), []).append(path)
+
+  return found
+
+
+def diverged(master, local, roots):
+  """Subtrees to sync so local matches master: [(path, [subdirectories
+  already equal on both sides])], descending only into the directories
+  whose hashes differ"""
+  master_children = children(master)
+  local_children = children(local)
+  jobs = []
+
+  todo = list(roots)
+  while todo:
+    path = todo.pop(0)
+    theirs, ours = master.get(path), local.get(path)
+    if theirs and ours and theirs[0] and theirs[0] == ours[0]:
+      continue
+
+    if theirs is None and ours is None:
+      continue
+
+    subdirs = set(master_children.get(path, [])) | set(local_children.get(path, []))
+    equal = set([subdir for subdir in subdirs if master.get(subdir) and \
+      master[subdir][0] and master[subdir] == local.get(subdir)])
+    differ = subdirs - equal
+
+    # Same files here and the subdirectories that differ exist on both
+    # sides: look into them
+    if theirs and ours and theirs[1] and theirs[1] == ours[1] and \
+      not [subdir for subdir in differ if subdir not in master or subdir not in local]:
+      todo.extend(sorted(differ))
+      continue
+
+    jobs.append((path, sorted(equal)))
+
+  return jobs
+
+
+class HashCache():
+  """Hashes of the local files keyed on (inode, size, mtime, ctime) so
+  unchanged files are never hashed twice"""
+
+  def __init__(self, filename=HASH_CACHE, workers=2, prune=None, exclude=None):
+    self.db = Manifest(filename)
+    self.workers = max(1, int(workers))
+    self.scanner = Scanner(self.workers, prune)
+    self.exclude = exclude
+
+  def files(self, roots):
+    """Yield (path, hex hash) of every file below roots, hashing the new
+    or changed ones"""
+    db = self.db
+    todo = []
+    for dirname, files, complete in self.scanner.scan(roots):
+      known = {}
+      if complete:
+        known = db.hashes(dirname)
+
+      for name, st in files:
+        path = os.path.join(dirname, name)
+        if self.exclude and self.exclude.match(path):
+          continue
+
+        key = Manifest.key(st)
+        cached = known.pop(name, None) if complete else db.entry(path)
+        if cached and cached[0] == key and cached[1]:
+          yield path, cached[1]
+        else:
+          todo.append(path)
+
+      # Files gone since last time
+      for name in known:
+        db.remove(os.path.join(dirname, name))
+
+    if todo:
+      logging.info("Hashing %d local files" % len(todo))
+      pool = Pool(self.workers)
+      try:
+        results = pool.map(hash_file, todo, chunksize=64)
+      finally:
+        pool.close()
+        pool.join()
+
+      for path, result in zip(todo, results):
+        if not result:
+          yield path, None
+          continue
+
+        db.update(path, result[0])
+        db.set_hash(path, result[0], result[1])
+        yield path, result[1]
+
+    db.commit()
+
+  def tree(self, roots):
+    return build_tree(self.files(roots), roots)
+
+  def close(self):
+    self.db.close()
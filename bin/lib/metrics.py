@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+import os
+import threading
+import logging
+import SocketServer
+import BaseHTTPServer
+
+from time import time
+from notify import parse_address
+
+PREFIX = 'ackstorm_sync_'
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+
+def format_labels(labels):
+  if not labels: return ''
+  return '{%s}' % ','.join(['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+    for name, value in labels])
+
+
+class Metrics():
+  """Counters, gauges and histograms rendered in the Prometheus text format.
+
+  Metrics are declared once with their type and help and then updated by
+  name with optional labels (keyword arguments). Safe to use from threads.
+  """
+
+  def __init__(self, prefix=PREFIX):
+    self.prefix = prefix
+    self.lock = threading.Lock()
+    self.metrics = {}   # name -> [type, help, buckets, {labels: value}]
+
+  def declare(self, name, type, help, buckets=DEFAULT_BUCKETS):
+    self.metrics[name] = [type, help, buckets, {}]
+
+  def inc(self, name, value=1, **labels):
+    key = tuple(sorted(labels.items()))
+    with self.lock:
+      values = self.metrics[name][3]
+      values[key] = values.get(key, 0) + value
+
+  def set(self, name, value, **labels):
+    key = tuple(sorted(labels.items()))
+    with self.lock:
+      self.metrics[name][3][key] = value
+
+  def observe(self, name, value, **labels):
+    key = tuple(sorted(labels.items()))
+    with self.lock:
+      metric = self.metrics[name]
+      item = metric[3].get(key)
+      if item is None:
+        item = metric[3][key] = [[0] * len(metric[2]), 0, 0.0]   # buckets, count, sum
+
+      for i, bound in enumerate(metric[2]):
+        if value <= bound: item[0][i] += 1
+
+      item[1] += 1
+      item[2] += value
+
+  def render(self):
+    lines = []
+    with self.lock:
+      for name in sorted(self.metrics):
+        type, help, buckets, values = self.metrics[name]
+        name = self.prefix + name
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, type))
+
+        for key in sorted(values):
+          if type != HISTOGRAM:
+            lines.append('%s%s %s' % (name, format_labels(key), values[key]))
+            continue
+
+          counts, count, total = values[key]
+          for bound, value in zip(buckets, counts):
+            lines.append('%s_bucket%s %d' % (name, format_labels(key + (('le', bound),)), value))
+          lines.append('%s_bucket%s %d' % (name, format_labels(key + (('le', '+Inf'),)), count))
+          lines.append('%s_sum%s %s' % (name, format_labels(key), total))
+          lines.append('%s_count%s %d' % (name, format_labels(key), count))
+
+    return '\n'.join(lines) + '\n'
+
+  def write(self, filename):
+    with open(filename + '.tmp', 'w') as file:
+      file.write(self.render())
+
+    os.rename(filename + '.tmp', filename)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_GET(self):
+    data = self.server.metrics.render()
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def address_string(self):
+    return str(self.client_address)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class MetricsServer():
+  """HTTP endpoint serving metrics on 'host:port' or a Unix socket path"""
+
+  def __init__(self, metrics, address):
+    self.address = parse_address(address)
+
+    if isinstance(self.address, tuple):
+      server = SocketServer.ThreadingTCPServer
+    else:
+      server = SocketServer.ThreadingUnixStreamServer
+      if os.path.exists(self.address): os.remove(self.address)
+
+    server.allow_reuse_address = True
+    server.daemon_threads = True
+    self.server = server(self.address, _Handler)
+    self.server.metrics = metrics
+
+  def start(self):
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logging.info("Metrics served on: %s" % (self.address,))
+
+  def close(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+
+def read_samples(filename):
+  """{sample name with labels (without PREFIX): value} of a metrics file"""
+  samples = {}
+  with open(filename) as file:
+    for line in file:
+      line = line.strip()
+      if not line or line.startswith('#'):
+        continue
+
+      name, value = line.rsplit(' ', 1)
+      if name.startswith(PREFIX): name = name[len(PREFIX):]
+      samples[name] = float(value)
+
+  return samples
+
+
+def summary(filename):
+  """Lines describing the samples of a metrics file (histograms as count
+  and average) or None when it can not be read"""
+  try:
+    samples = read_samples(filename)
+    age = time() - os.path.getmtime(filename)
+
+  except (IOError, OSError):
+    return None
+
+  lines = ['metrics updated %ds ago' % age]
+  for name in sorted(samples):
+    base, sep, labels = name.partition('{')
+    if base.endswith('_bucket') or base.endswith('_sum'):
+      continue
+
+    if base.endswith('_count'):
+      key = base[:-6] + sep + labels
+      count = samples[name]
+      average = count and samples.get(base[:-6] + '_sum' + sep + labels, 0) / count or 0
+      lines.append('  %-60s %d (avg %.2fs)' % (key, count, average))
+    else:
+      lines.append('  %-60s %s' % (name, '%g' % samples[name]))
+
+  return lines
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+import os
+import socket
+import logging
+import threading
+import SocketServer
+
+from time import time
+
+DEFAULT_PORT = 8731
+MAX_WAIT = 300
+MAX_WAITERS = 256   # clients past this are told to poll (a thread each)
+CONNECT_TIMEOUT = 5 # an unreachable server falls back to polling quickly
+
+
+def parse_address(address):
+  """'/path/to/socket' or 'host:port' (port defaults to DEFAULT_PORT)"""
+  if address.startswith('/') or address.startswith('./'):
+    return address
+
+  host, sep, port = address.rpartition(':')
+  if not sep:
+    return address, DEFAULT_PORT
+
+  return host, int(port)
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+  # WAIT <journal id> <seq> <timeout>  ->  HEAD <journal id> <seq> (or BUSY)
+  def handle(self):
+    line = self.rfile.readline(1024).split()
+    if len(line) != 4 or line[0] != 'WAIT':
+      return
+
+    try:
+      seq, timeout = int(line[2]), min(float(line[3]), MAX_WAIT)
+    except ValueError:
+      return
+
+    result = self.server.wait(line[1], seq, timeout)
+    if result is None:
+      self.wfile.write('BUSY\n')
+      return
+
+    self.wfile.write('HEAD %s %d\n' % result)
+
+
+class NotifyServer():
+  """Long-poll endpoint announcing the head of the journal.
+
+  Clients send the journal id and sequence they have and the answer comes
+  as soon as publish() moves the head past it (or the timeout expires).
+  address is a 'host:port' to listen on TCP or the path of a Unix socket.
+  There is no authentication: listen only where the slaves are. At most
+  max_waiters clients wait at once, the others get BUSY and poll.
+  """
+
+  def __init__(self, address, max_waiters=MAX_WAITERS):
+    self.address = parse_address(address)
+    self.journal_id = '-'
+    self.head = 0
+    self.max_waiters = max_waiters
+    self.waiters = 0
+    self.cond = threading.Condition()
+
+    if isinstance(self.address, tuple):
+      server = SocketServer.ThreadingTCPServer
+    else:
+      server = SocketServer.ThreadingUnixStreamServer
+      if os.path.exists(self.address): os.remove(self.address)
+
+    server.allow_reuse_address = True
+    server.daemon_threads = True
+    self.server = server(self.address, _Handler)
+    self.server.wait = self.wait
+
+  def start(self):
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logging.info("Notify server listening on: %s" % (self.address,))
+
+  def close(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def publish(self, journal_id, head):
+    with self.cond:
+      self.journal_id, self.head = journal_id, head
+      self.cond.notify_all()
+
+  def wait(self, journal_id, seq, timeout):
+    # (journal id, head) or None when too many clients are waiting
+    deadline = time() + timeout
+    with self.cond:
+      if self.waiters >= self.max_waiters:
+        return None
+
+      self.waiters += 1
+      try:
+        while self.journal_id == journal_id and self.head <= seq:
+          remaining = deadline - time()
+          if remaining <= 0: break
+          self.cond.wait(remaining)
+
+      finally:
+        self.waiters -= 1
+
+      return self.journal_id, self.head
+
+
+class NotifyClient():
+  """Block until the journal head of a NotifyServer moves"""
+
+  def __init__(self, address):
+    self.address = parse_address(address)
+    self.available = True
+
+  def wait(self, journal_id, seq, timeout):
+    """True when there are new changes, False on timeout and None when
+    the server can not be reached"""
+    if isinstance(self.address, tuple):
+      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    else:
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+      try:
+        sock.settimeout(CONNECT_TIMEOUT)
+        sock.connect(self.address)
+        sock.settimeout(timeout + 10)
+        sock.sendall('WAIT %s %d %d\n' % (journal_id or '-', seq, timeout))
+        line = sock.makefile('r').readline().split()
+
+      finally:
+        sock.close()
+
+    except (socket.error, socket.timeout), e:
+      if self.available:
+        logging.info("NOTIFY SERVER UNAVAILABLE (%s): Polling" % e)
+      self.available = False
+      return None
+
+    if len(line) != 3 or line[0] != 'HEAD':
+      self.available = False
+      return None
+
+    if not self.available:
+      logging.info("NOTIFY SERVER AVAILABLE: %s" % (self.address,))
+    self.available = True
+
+    return line[1] != (journal_id or '-') or int(line[2]) > seq
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+import os
+import signal
+import logging
+import threading
+import cProfile
+
+from time import time, strftime
+from collections import deque
+
+WINDOW = 100    # cycles kept for the rolling statistics
+IDLE = 'wait'   # phase of a loop waiting for work
+PROFILE_DIR = './var'
+
+
+class Profiler():
+  """Time spent in each phase of a main loop cycle.
+
+  Phases are timed with "with profiler.span(name):" (from any thread, nested
+  spans count in both) and cycle() ends a cycle: it logs one line with the
+  time of every phase in it and its average and maximum over the last
+  WINDOW cycles, at INFO when the cycle was busy (not in the IDLE phase)
+  for threshold seconds or more.
+
+  SIGUSR1 starts and stops a cProfile session of the main thread and
+  SIGUSR2 dumps what it collected to PROFILE_DIR.
+  """
+
+  def __init__(self, name, threshold=1.0, metrics=None):
+    self.name = name
+    self.threshold = threshold
+    self.metrics = metrics
+    self.lock = threading.Lock()
+    self.current = {}     # phase -> [seconds, count] in this cycle
+    self.history = {}     # phase -> deque of the seconds of the last cycles
+    self.started = time()
+    self.profile = None
+    self.profiling = False
+
+  def span(self, phase):
+    return _Span(self, phase)
+
+  def add(self, phase, seconds):
+    with self.lock:
+      item = self.current.get(phase)
+      if item is None:
+        item = self.current[phase] = [0.0, 0]
+
+      item[0] += seconds
+      item[1] += 1
+
+  def cycle(self):
+    now = time()
+    with self.lock:
+      current, self.current = self.current, {}
+      for phase in self.history:
+        if phase not in current:
+          self.history[phase].append(0.0)
+
+      for phase in current:
+        if phase not in self.history:
+          self.history[phase] = deque(maxlen=WINDOW)
+        self.history[phase].append(current[phase][0])
+
+    elapsed, self.started = now - self.started, now
+    busy = elapsed - current.get(IDLE, [0.0])[0]
+
+    parts = []
+    for phase in sorted(current, key=lambda phase: -current[phase][0]):
+      if phase == IDLE: continue
+      seconds, count = current[phase]
+      history = self.history[phase]
+      parts.append('%s %.2f/%.2f/%.2f%s' % (phase, seconds, sum(history) / len(history),
+        max(history), count > 1 and ' x%d' % count or ''))
+
+      if self.metrics:
+        self.metrics.observe('phase_seconds', seconds, phase=phase)
+
+    if not parts:
+      return busy
+
+    level = busy >= self.threshold and logging.INFO or logging.DEBUG
+    logging.log(level, "CYCLE %.2fs BUSY OF %.2fs (last/avg/max): %s" % (busy, elapsed, ', '.join(parts)))
+    return busy
+
+  def catch_signals(self):
+    # Restart the system calls they interrupt (reading rsync output)
+    for signum, handler in ((signal.SIGUSR1, self.toggle), (signal.SIGUSR2, self.dump)):
+      signal.signal(signum, handler)
+      signal.siginterrupt(signum, False)
+
+  def toggle(self, signum=None, frame=None):
+    if self.profile is None:
+      self.profile = cProfile.Profile()
+
+    if self.profiling:
+      self.profile.disable()
+      self.profiling = False
+      logging.info("PROFILING STOPPED (SIGUSR2 dumps it)")
+
+    else:
+      self.profile.enable()
+      self.profiling = True
+      logging.info("PROFILING STARTED")
+
+  def dump(self, signum=None, frame=None):
+    if self.profile is None:
+      logging.info("Nothing profiled yet (SIGUSR1 starts it)")
+      return
+
+    filename = os.path.abspath(os.path.join(PROFILE_DIR,
+      'ackstorm-sync-%s-%s.prof' % (self.name, strftime('%Y%m%d-%H%M%S'))))
+
+    # Stats can only be created from a stopped profile
+    if self.profiling: self.profile.disable()
+    try:
+      self.profile.dump_stats(filename)
+      logging.info("PROFILE DUMPED: %s" % filename)
+
+    except (IOError, OSError), e:
+      logging.info("Unable to dump profile to %s: %s" % (filename, e))
+
+    if self.profiling: self.profile.enable()
+
+
+class _Span():
+  def __init__(self, profiler, phase):
+    self.profiler = profiler
+    self.phase = phase
+
+  def __enter__(self):
+    self.started = time()
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.profiler.add(self.phase, time() - self.started)
+    return False
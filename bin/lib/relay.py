@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import logging
+
+# METRICS_FILE is where "ackstorm-sync status" reads the relay metrics
+from slave import SyncSlave, DATA_DIR, METRICS_FILE
+from journal import write_head, index_name, SEGMENT_SUFFIX, INDEX_SUFFIX
+from bundle import is_bundle
+from manifest import EXPORT_FILE
+from merkle import TREE_FILE
+from notify import NotifyServer
+
+STAGING_DIR = './var/upstream'
+
+
+def is_journal(name):
+  return name.endswith(SEGMENT_SUFFIX) or name.endswith(INDEX_SUFFIX) or is_bundle(name)
+
+
+class SyncRelay(SyncSlave):
+  """Slave that other slaves sync from.
+
+  The journal of the upstream host is fetched into STAGING_DIR and only
+  published in DATA_DIR (the updates module of this host) once applied
+  here, with the same journal id and sequences, so downstream slaves never
+  see changes before the files behind them. The tree is served from the
+  root module like on the master and a notify server announces the head.
+  """
+
+  data_dir = STAGING_DIR
+
+  def __init__(self):
+    SyncSlave.__init__(self)
+    if not os.path.isdir(STAGING_DIR):
+      os.mkdir(STAGING_DIR)
+
+    self.notify_server = None
+    self.published = None
+
+  def load_config(self):
+    config = SyncSlave.load_config(self)
+
+    # Where downstream slaves wait for changes (None to disable),
+    # unauthenticated so only on loopback unless told where slaves are
+    if not "relay_notify_address" in dir(config):
+      config.relay_notify_address = '127.0.0.1:8731'
+
+    return config
+
+  def sync_updates(self, last_version, fetch=True):
+    result = SyncSlave.sync_updates(self, last_version, fetch)
+
+    # What was applied before a restart is published as soon as the
+    # upstream head is known, not with the next change
+    if self.published is None and not self.config.dry_run:
+      with self.profiler.span('publish'), self.fetch_lock:
+        self.publish()
+
+    return result
+
+  def apply(self, batch):
+    SyncSlave.apply(self, batch)
+    if not self.config.dry_run:
+      with self.profiler.span('publish'), self.fetch_lock:
+        self.publish()
+
+  def prune_journal(self):
+    # Downstream slaves may be behind: keep everything upstream still has
+    if not self.head or not self.head['id']:
+      return
+
+    keep = set([bundle[0] for bundle in self.head['bundles']])
+    for name, first, last in self.head['segments']:
+      keep.update([name, index_name(name)])
+
+    for name in os.listdir(self.data_dir):
+      if is_journal(name) and name not in keep:
+        logging.debug("Removing upstream journal file: %s" % name)
+        os.remove(os.path.join(self.data_dir, name))
+
+  def publish(self):
+    """Expose the journal applied so far to downstream slaves"""
+    head = self.head
+    if not head or not head['id']:
+      return
+
+    # Newest segments present here, without gaps (a gap would skip records).
+    # They may already hold records past version: readers stop at the head
+    version = self.version
+    files = set(os.listdir(self.data_dir))
+    segments = []
+    for name, first, last in reversed(head['segments']):
+      if first > version: continue
+      if name not in files or index_name(name) not in files: break
+      segments.insert(0, (name, first, min(last, version)))
+
+    bundles = [bundle for bundle in head['bundles'] if bundle[0] in files and bundle[2] <= version]
+    exports = [name for name in (TREE_FILE, EXPORT_FILE) if name in files]
+
+    published = (self.journal_id, version, segments, bundles,
+      [os.path.getmtime(os.path.join(self.data_dir, name)) for name in exports])
+    if published == self.published:
+      return
+
+    names = list(exports)
+    names.extend([bundle[0] for bundle in bundles])
+    for name, first, last in segments:
+      names.extend([name, index_name(name)])
+
+    for name in names:
+      self.link(name)
+
+    # journal.head last and then what is no longer announced
+    tail = segments and segments[0][1] or version + 1
+    write_head(DATA_DIR, self.journal_id, version, tail, segments, bundles)
+
+    names = set(names)
+    for name in os.listdir(DATA_DIR):
+      if is_journal(name) and name not in names:
+        os.remove(os.path.join(DATA_DIR, name))
+
+    logging.info("PUBLISHED JOURNAL VERSION %d (%d segments)" % (version, len(segments)))
+    self.published = published
+    self.announce(version)
+
+  def link(self, name):
+    # Hard link (rsync replaces the staged files, never rewrites them)
+    src = os.path.join(self.data_dir, name)
+    dst = os.path.join(DATA_DIR, name)
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+      return
+
+    tmp = dst + '.tmp'
+    if os.path.exists(tmp): os.remove(tmp)
+    try:
+      os.link(src, tmp)
+    except OSError:
+      shutil.copy2(src, tmp)
+
+    os.rename(tmp, dst)
+
+  def announce(self, version):
+    if not self.config.relay_notify_address:
+      return
+
+    if self.notify_server is None:
+      try:
+        self.notify_server = NotifyServer(self.config.relay_notify_address)
+        self.notify_server.start()
+
+      except Exception, e:
+        logging.info("Unable to start notify server on %s: %s" % (self.config.relay_notify_address, e))
+        self.config.relay_notify_address = None
+        return
+
+    self.notify_server.publish(self.journal_id, version)
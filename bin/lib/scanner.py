@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+import os
+import stat
+import errno
+import logging
+import threading
+import Queue
+
+from time import time
+
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+DEFAULT_WORKERS = 4
+PROGRESS_INTERVAL = 10
+_DONE = object()
+
+
+def listdir(path, files=True):
+  """Yield (name, is_dir, lstat or None) for the entries of path (only the
+  directories when files is False)"""
+  if scandir is not None:
+    for entry in scandir(path):
+      if entry.is_dir(follow_symlinks=False):
+        yield entry.name, True, None
+
+      elif files and entry.is_file(follow_symlinks=False):
+        yield entry.name, False, entry.stat(follow_symlinks=False)
+
+    return
+
+  for name in os.listdir(path):
+    try:
+      st = os.lstat(os.path.join(path, name))
+    except OSError:
+      continue
+
+    if stat.S_ISDIR(st.st_mode):
+      yield name, True, None
+
+    elif files and stat.S_ISREG(st.st_mode):
+      yield name, False, st
+
+
+class Scanner():
+  """Walk directory trees with a pool of threads.
+
+  scan() yields one (dirname, files, complete) tuple per directory, files
+  being a list of (name, lstat) for the regular files found. complete is
+  False when the directory could not be read (or dirname is only the parent
+  of a watched file) so callers must not infer deletions from it.
+  Directories whose path matches one of the prune regexes are skipped and
+  files are not listed at all when files is False. visit(dirname), when
+  given, is called from the worker threads right before listing dirname.
+  """
+
+  def __init__(self, workers=DEFAULT_WORKERS, prune=None, files=True):
+    self.workers = max(1, int(workers))
+    self.prune = prune or []
+    self.files = files
+
+  def pruned(self, path):
+    for regex in self.prune:
+      if regex.search(path):
+        return True
+
+    return False
+
+  def scan(self, paths, visit=None):
+    dirs = Queue.Queue()
+    results = Queue.Queue(maxsize=self.workers * 64)
+    state = {'pending': 0, 'stop': False}
+    lock = threading.Lock()
+
+    def put(item):
+      while not state['stop']:
+        try:
+          results.put(item, timeout=1)
+          return
+        except Queue.Full:
+          pass
+
+    def worker():
+      while True:
+        dirname = dirs.get()
+        if dirname is None: break
+
+        files, complete = [], True
+        try:
+          if not state['stop']:
+            if visit: visit(dirname)
+            for name, is_dir, st in listdir(dirname, self.files):
+              path = os.path.join(dirname, name)
+              if is_dir:
+                if self.pruned(path): continue
+                with lock: state['pending'] += 1
+                dirs.put(path)
+
+              else:
+                files.append((name, st))
+
+        except OSError, e:
+          logging.info("Unable to scan %s: %s" % (dirname, e))
+          complete = False
+
+        put((dirname, files, complete))
+
+        with lock:
+          state['pending'] -= 1
+          if not state['pending']: put(_DONE)
+
+    # Single files are reported by themselves
+    roots = []
+    for path in paths:
+      if os.path.isdir(path) and not os.path.islink(path):
+        roots.append(path)
+
+      elif os.path.isfile(path):
+        try:
+          files = [(os.path.basename(path), os.lstat(path))]
+        except OSError:
+          files = []
+        yield os.path.dirname(path), files, False
+
+    if not roots:
+      return
+
+    state['pending'] = len(roots)
+    for path in roots:
+      dirs.put(path)
+
+    threads = []
+    for i in range(self.workers):
+      thread = threading.Thread(target=worker)
+      thread.daemon = True
+      thread.start()
+      threads.append(thread)
+
+    try:
+      while True:
+        item = results.get()
+        if item is _DONE: break
+        yield item
+
+    finally:
+      state['stop'] = True
+      for thread in threads:
+        dirs.put(None)
+
+
+class WatchRegistrar(threading.Thread):
+  """Register the watches of directory trees in background, breadth first.
+
+  add(path) is called for every watch path and every directory below it
+  and returns False when path could not be watched; those paths are
+  appended to failed. Each watch path is put in registered once its whole
+  tree has been walked, so a scan started after that misses nothing.
+  Directories are registered before they are listed so the ones created
+  meanwhile are either listed or reported by the watch.
+  """
+
+  def __init__(self, add, paths, workers=DEFAULT_WORKERS, prune=None):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.add = add
+    self.paths = list(paths)
+    self.scanner = Scanner(workers, prune, files=False)
+    self.count = 0
+    self.failed = []
+    self.registered = Queue.Queue()
+    self.elapsed = None
+    self.lock = threading.Lock()
+
+  def register(self, path):
+    try:
+      if not self.add(path):
+        self.failed.append(path)
+        return
+
+    except OSError, e:
+      if e.errno != errno.ENOENT:
+        logging.info("Unable to watch %s: %s" % (path, e.strerror))
+        self.failed.append(path)
+      return
+
+    with self.lock:
+      self.count += 1
+
+  def run(self):
+    started = last = time()
+    for root in self.paths:
+      self.register(root)
+      if os.path.isdir(root) and not os.path.islink(root):
+        visit = lambda dirname: dirname != root and self.register(dirname)
+        for dirname, files, complete in self.scanner.scan([root], visit):
+          if time() - last >= PROGRESS_INTERVAL:
+            last = time()
+            logging.info("Registering watches: %d directories (%d/s)" % \
+              (self.count, self.count / max(last - started, 1)))
+
+      self.elapsed = time() - started
+      self.registered.put(root)
+
+    logging.info("Watches registered: %d directories in %.1fs (%d failed)" % \
+      (self.count, self.elapsed, len(self.failed)))
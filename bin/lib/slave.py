@@ -5,21 +5,185 @@ import sys
 import signal
 import re
 import logging
-import fnmatch
 import shutil
-import shlex
+import threading
+import copy
+import Queue
 
-from time import sleep
+from time import sleep, time
+from multiprocessing.dummy import Pool
 from common import *
+from filters import PathFilter
+from manifest import EXPORT_FILE, read_export
+from merkle import HashCache, read_tree, diverged, TREE_FILE
+from journal import JournalReader, ChangeSet, Cursor, UPDATE, DELETE, RENAME, HEAD_FILE
+from journal import split_rename, index_name
+from notify import NotifyClient
+from actions import ActionScheduler
+from bundle import bundle_members, extract_bundle, is_bundle
+from metrics import Metrics, MetricsServer, COUNTER, GAUGE, HISTOGRAM
+from profiling import Profiler
 
 LOG_FILE = './var/log/ackstorm-sync-slave.log'
 CONFIG_FILE = './etc/slave_conf.py'
 VERSION_FILE = './var/.version'
+CURSOR_FILE = './var/.cursor'
+FULLSYNC_FILE = './var/.fullsync'
+FILES_FROM = './var/.files-from'
+UPDATES_FROM = './var/.updates-from'
+DATA_DIR = './data'
+METRICS_FILE = './var/ackstorm-sync-slave.prom'
 
-RSYNC_ERROR_DELETE = 23
 RSYNC_ERROR_MKDIR = 11
+RSYNC_ERROR_VANISHED = 24
 
+# Options applied on restart only (reload_config warns about them)
+RESTART_OPTIONS = ['metrics_address', 'action_workers', 'relay_notify_address', 'daemonize']
+
+
+class SyncedFiles():
+  """Paths synced in a cycle, matched against the actions as they arrive
+  (from rsync output, deletes and renames) instead of being kept"""
+  
+  def __init__(self, slave):
+    self.slave = slave
+    self.count = 0
+    self.matched = set()  # actions already scheduled
+    
+  def __len__(self):
+    return self.count
+    
+  def append(self, path):
+    self.count += 1
+    self.slave.metrics.inc('synced_paths_total')
+    logging.debug("Synced: %s" % path)
+    if not self.slave.config.dry_run:
+      self.slave.process_actions([path], self.matched)
+      
+  def extend(self, paths):
+    for path in paths:
+      self.append(path)
+      
+  def line(self, line, base='/'):
+    # --out-format 'file:%b %n%L': bytes transferred and the name, where
+    # directories end with '/' and symlinks have ' -> target' appended
+    if not line.startswith('file:') or line.endswith('/'):
+      return
+      
+    size, sep, name = line[5:].partition(' ')
+    if size.isdigit():
+      self.slave.metrics.inc('synced_bytes_total', int(size))
+      
+    self.append(os.path.abspath(os.path.join(base, name.split(' -> ')[0])))
+
+
+def merge_batches(batches):
+  """A single batch with the journal of batches (consecutive)"""
+  if len(batches) == 1:
+    return batches[0]
+    
+  merged = dict(batches[-1])
+  merged['pending'], merged['bundles'], names = [], [], set()
+  for batch in batches:
+    merged['pending'].extend(batch['pending'])
+    for bundle in batch['bundles']:
+      if bundle[0] in names: continue
+      names.add(bundle[0])
+      merged['bundles'].append(bundle)
+      
+  return merged
+  
+  
+class FullsyncState():
+  """Progress of the last full sync, persisted in filename as each job
+  finishes so a restart resumes it instead of starting over.
+
+  journal_id and version are those of the journal when it started (the
+  journal is replayed from there once it is done), started and finished
+  are timestamps (finished is None while incomplete) and done holds the
+  keys of the jobs completed.
+  """
+  
+  def __init__(self, filename):
+    self.filename = filename
+    self.journal_id = None
+    self.version = 0
+    self.started = self.finished = None
+    self.done = set()
+    self.lock = threading.Lock()
+    self.load()
+    
+  def load(self):
+    try:
+      with open(self.filename) as file:
+        lines = file.read().split('\n')
+        
+      fields = lines[0].split()
+      self.journal_id, self.version, self.started = fields[0], int(fields[1]), float(fields[2])
+      self.finished = fields[3] != '-' and float(fields[3]) or None
+      self.done = set([line for line in lines[1:] if line])
+      
+    except (IOError, ValueError, IndexError):
+      pass
+      
+  def save(self):
+    with self.lock:
+      lines = ['%s %d %f %s' % (self.journal_id or '-', self.version, self.started or 0,
+        self.finished and '%f' % self.finished or '-')]
+      lines.extend(sorted(self.done))
+      
+      with open(self.filename + '.tmp', 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+        
+      os.rename(self.filename + '.tmp', self.filename)
+      
+  @staticmethod
+  def key(job):
+    # A job is a path without the subdirectories synced apart
+    path, split = job
+    return '\t'.join([path] + list(split))
+    
+  def recent(self, journal_id, max_age):
+    """True when a full sync of journal_id finished less than max_age
+    seconds ago"""
+    return bool(max_age and self.finished and self.journal_id == journal_id and \
+      time() - self.finished < max_age)
+      
+  def resumable(self, journal_id, max_age):
+    """True when an incomplete full sync of journal_id started less than
+    max_age seconds ago"""
+    return bool(max_age and self.started and not self.finished and \
+      self.journal_id == journal_id and time() - self.started < max_age)
+      
+  def begin(self, journal_id, version, max_age=0):
+    # Go on with the one in progress (only when given max_age) or start another
+    if self.resumable(journal_id, max_age):
+      return
+      
+    with self.lock:
+      self.journal_id, self.version = journal_id, version
+      self.started, self.finished = time(), None
+      self.done = set()
+      
+    self.save()
+    
+  def job_done(self, job):
+    with self.lock:
+      self.done.add(self.key(job))
+      
+    self.save()
+    
+  def finish(self):
+    with self.lock:
+      self.finished = time()
+      
+    self.save()
+    
+    
 class SyncSlave():
+  # Where the journal of the master is copied to
+  data_dir = DATA_DIR
+  
   def __init__(self):
     # Create required folders
     create_dirs()
@@ -28,12 +192,29 @@ class SyncSlave():
     # Read config from master
     import master
     self.master = master.SyncMaster()
+    self.config_mtimes = self.read_config_mtimes()
+    self.reload_requested = False
     
     # exlude our paths
     self.exclude_paths = ['./var', './data']
     
     # Get last updated version (read from file if needed)
+    self.cursor = Cursor(CURSOR_FILE)
+    self.journal_id = self.cursor.journal_id
     self.version = self.read_version()
+    self.fullsync_state = FullsyncState(FULLSYNC_FILE)
+    self.head = None
+    self.bundles = []
+    
+    # Pipeline: batches fetched ahead of the one being applied
+    self.batches = self.fetch_thread = None
+    self.fetch_failed = None
+    self.fetch_lock = threading.RLock()   # data_dir and its files list
+    self.apply_lock = threading.Lock()    # local tree and version
+    
+    self.notify = self.notified = None
+    if self.config.notify_address:
+      self.notify = NotifyClient(self.config.notify_address)
     
   def run(self,pid_file):
     # Check and write pid
@@ -51,42 +232,81 @@ class SyncSlave():
     logging.info("STARTING...")
     
     # Catch signals
+    self.profiler = Profiler('slave', self.config.profile_log_threshold)
     self.catch_signals()
     
+    self.start_metrics()
+    self.profiler.metrics = self.metrics
+    self.actions = ActionScheduler(self.config.action_workers, self.config.action_delay,
+      self.config.action_max_delay, self.config.action_timeout, self.metrics)
+    
     # Run initial sync?
-    if self.config.initial_fullsync:
+    state = self.fullsync_state
+    max_age = self.config.fullsync_resume_age
+    if self.config.initial_fullsync and state.recent(self.journal_id, max_age):
+      logging.info("INITIAL SYNCRONIZATION: SKIPPED (full sync done %ds ago at version %d)" % \
+        (time() - state.finished, state.version))
+      self.resume_version(state.version)
+      
+    elif self.config.initial_fullsync and state.resumable(self.journal_id, max_age):
+      logging.info("RESUMING INITIAL SYNCRONIZATION (%d jobs done at version %d)" % \
+        (len(state.done), state.version))
+      self.resume_version(state.version)
+      self.fullsync(resume=True)
+      self.check_config()
+      
+    elif self.config.initial_fullsync:
       logging.info("RUNNING INITIAL SYNCRONIZATION")
       
       # Read updates and set last version (avoid to process file)
-      _last_version, _ = self.sync_updates(self.version)
+      _last_version, _ = self.sync_updates(self.version, fetch=False)
       self.update_version(_last_version, self.version)
       self.version = _last_version
       
       # Now run the fullsync
       self.fullsync()
       
-      # Once initial sync is done, reload config and run again
-      logging.info("Reloading configuration and syncing again")
-      self.config = self.load_config()
-      self.fullsync(True)
+      # The initial sync may have changed the configuration: the watch
+      # paths it adds are synced too
+      self.check_config()
 
     else:
       logging.info("INITIAL SYNCRONIZATION: SKIPPED")
       
-    elasped = 0
+    # Periodic full syncs keep their schedule across restarts
+    last_fullsync = time()
+    if state.recent(self.journal_id, self.config.fullsync_interval):
+      last_fullsync = state.finished
     logging.info("Main process started")
+    profiler = self.profiler
+    self.start_pipeline()
     while True:
       try:
-        self.process_pending()
-        sleep(self.config.sleep)
+        if self.batches is None:
+          with profiler.span('process_pending'):
+            self.process_pending()
+            
+        else:
+          self.process_batches()
+          
+        # Configuration pushed with those changes (or SIGHUP)
+        with self.apply_lock:
+          self.check_config()
+        
+        if self.batches is None:
+          with profiler.span('wait'):
+            self.wait_changes()
         
         # Time to do a full sync?
         if self.config.fullsync_interval:
-          elasped = elasped + self.config.sleep
-          if elasped >= self.config.fullsync_interval:
+          if time() - last_fullsync >= self.config.fullsync_interval:
             logging.info("RUNNING FULL SYNCRONIZATION")
-            self.fullsync()
-            elasped = 0
+            with profiler.span('fullsync'), self.apply_lock:
+              self.fullsync()
+            last_fullsync = time()
+            
+        self.write_metrics()
+        profiler.cycle()
           
       except KeyboardInterrupt:
         logging.info("KILLED BY KEYBOARD INTERRUPT")
@@ -95,13 +315,125 @@ class SyncSlave():
     pid_file_del(pid_file)
     self.end()
       
+  def start_metrics(self):
+    metrics = self.metrics = Metrics()
+    metrics.declare('journal_version', GAUGE, 'Journal sequence applied')
+    metrics.declare('journal_lag', GAUGE, 'Journal records behind the master head')
+    metrics.declare('journal_pending', GAUGE, 'Journal records read in the last cycle')
+    metrics.declare('rsync_runs_total', COUNTER, 'Rsync invocations')
+    metrics.declare('rsync_seconds', HISTOGRAM, 'Duration of rsync invocations')
+    metrics.declare('synced_paths_total', COUNTER, 'Paths synced, deleted or renamed')
+    metrics.declare('synced_bytes_total', COUNTER, 'Bytes transferred by rsync')
+    metrics.declare('bundle_files_total', COUNTER, 'Files extracted from bundles')
+    metrics.declare('action_seconds', HISTOGRAM, 'Duration of action runs')
+    metrics.declare('action_failures_total', COUNTER, 'Action commands that failed')
+    metrics.declare('fullsync_total', COUNTER, 'Full syncs run')
+    metrics.declare('fullsync_seconds', GAUGE, 'Duration of the last full sync of a path')
+    metrics.declare('phase_seconds', HISTOGRAM, 'Seconds spent in each phase of a cycle')
+    metrics.declare('pipeline_batches', GAUGE, 'Journal batches fetched and waiting to be applied')
+    
+    if self.config.metrics_address:
+      MetricsServer(metrics, self.config.metrics_address).start()
+      
+  def write_metrics(self):
+    if self.head and self.head['id'] == self.journal_id:
+      self.metrics.set('journal_lag', max(self.head['head'] - self.version, 0))
+      
+    self.metrics.set('journal_version', self.version)
+    if self.batches is not None:
+      self.metrics.set('pipeline_batches', self.batches.qsize())
+      
+    self.metrics.write(METRICS_FILE)
+    
   def process_pending(self):
-    # Build pending updates files
-    last_version, pending = self.sync_updates(self.version)
+    # Fetch the journal and apply it in turn
+    with self.profiler.span('sync_updates'):
+      last_version, pending = self.sync_updates(self.version)
+      
+    self.apply(self.batch(last_version, pending))
+    
+  def batch(self, last_version, pending):
+    """What sync_updates() read: the journal segments to apply, up to
+    last_version, with the bundles and the cursor after them"""
+    return {'version': last_version, 'pending': pending, 'bundles': list(self.bundles),
+      'cursor': copy.copy(self.cursor)}
+      
+  def start_pipeline(self):
+    """Fetch the journal in a thread of its own while the main one
+    applies it (and the action scheduler runs the actions), so a large
+    transfer never delays fetching and waiting for the next changes"""
+    if not self.config.pipeline_depth or self.config.dry_run:
+      return
+      
+    self.batches = Queue.Queue(self.config.pipeline_depth)
+    thread = self.fetch_thread = threading.Thread(target=self.fetch_loop)
+    thread.daemon = True
+    thread.start()
+    
+  def fetch_loop(self):
+    # Stage 1: journal fetched past what was fetched before (not what was
+    # applied) and queued, blocking once pipeline_depth batches wait
+    fetched = self.version
+    profiler = self.profiler
+    try:
+      while True:
+        with profiler.span('sync_updates'):
+          last_version, pending = self.sync_updates(fetched)
+          
+        if pending:
+          self.batches.put(self.batch(last_version, pending))
+          
+        fetched = last_version
+        with profiler.span('fetch_wait'):
+          self.wait_changes(fetched)
+          
+    except Exception, e:
+      logging.exception("FETCH FAILED: %s" % e)
+      self.fetch_failed = e
+      
+  def process_batches(self):
+    # Stage 2: every batch fetched so far applied at once (changes to the
+    # same paths across them are merged) in journal order
+    if self.fetch_failed:
+      raise RuntimeError, "Journal fetch stopped: %s" % self.fetch_failed
+      
+    batches = []
+    try:
+      with self.profiler.span('wait'):
+        batches.append(self.batches.get(True, self.config.sleep))
+        
+      while True:
+        batches.append(self.batches.get_nowait())
         
+    except Queue.Empty:
+      pass
+      
+    try:
+      with self.apply_lock:
+        if batches:
+          self.apply(merge_batches(batches))
+          
+        else:
+          self.write_end_sync()
+          
+    finally:
+      for batch in batches:
+        self.batches.task_done()
+        
+  def exclusive(self):
+    """Lock for the fetch stage to change the version or the local tree
+    (new journal, full sync): batches queued are applied first"""
+    if threading.current_thread() is self.fetch_thread:
+      self.batches.join()
+      
+    return self.apply_lock
+    
+  def apply(self, batch):
+    # Stage 2: plan the changes of batch and bring the local tree there
+    last_version, pending = batch['version'], batch['pending']
+    
     # Sync each file
     failed = False
-    failed_stdout = ''
     failed_stderr = ''
     files_processed = 0
     
@@ -118,143 +450,388 @@ class SyncSlave():
         exclude = exclude[1:]
       extra_rsync_opts.append("--exclude=%s" % exclude)
     
-    synced_files, commands = [], []
-    for file in pending:
-      logging.info("SYNCING FILES FROM %s" % file)
-
-      # Run rsync
-      files_processed += 1
-      retval, output, error = self.rsync(
-        self.config.rsync_user + '@' + self.config.master + '::root/',
-        '/',
-        extra_rsync_opts + ["--files-from=" + './data/' + file]
-      )
+    # Replay the changes of every pending segment into a single list: one
+    # entry per path (a delete followed by a create is an update) with the
+    # renames kept in order
+    synced_files = SyncedFiles(self)
+    changes, renamed_dirs = ChangeSet(), set()
+    last_seqs, renamed = {}, 0
+    count = 0
+    for name, records in pending:
+      logging.debug("Changes from %s: %d" % (name, len(records)))
+      count += len(records)
       
-      # Check if there is a pending delete or mkdir
-      if retval == RSYNC_ERROR_DELETE:
-        with open('./data/' + file, 'r') as ofile:
-          content = ofile.read()
+      for seq, op, path in records:
+        if op == RENAME:
+          renamed = seq
+          src, dst = split_rename(path)
+          is_dir = os.path.isdir(src) or src in renamed_dirs
+          if is_dir: renamed_dirs.add(dst)
+          changes.rename(src, dst, is_dir)
           
-        for line in content.splitlines():
-          if line.startswith('#DELETE:'):
-            _file = '/' + line[8:]
-            if not self.inside_sync_paths(_file):
-              logging.info("File not inside sync path: %s" % _file)
-              continue
-              
-            try:
-              if os.path.isfile(_file):
-                os.remove(_file)
-                logging.info("DELETE FILE: %s" %line[8:])
-              
-              elif os.path.isdir(_file):
-                shutil.rmtree(_file)
-                logging.info("DELETE DIR: %s" %line[8:])
-              
-              synced_files.append(_file)
-            except OSError: 
-              pass
-              
-        # Process again rsync command to ensure all files exists
-        self.rsync(
-          self.config.rsync_user + '@' + self.config.master + '::root/',
-          '/',
-          extra_rsync_opts + ["--files-from=" + './data/' + file]
-        )
-      
-      elif retval == RSYNC_ERROR_MKDIR:
-        self.rsync_error_mkdir(retval,error)
-                
-        # Process again rsync command to ensure all files exists
-        self.rsync(
-          self.config.rsync_user + '@' + self.config.master + '::root/',
-          '/',
-          extra_rsync_opts + ["--files-from=" + './data/' + file]
-        )
-            
-      elif retval:
-        failed = True
-        failed_stdout = output
-        failed_stderr = error
-        
-      for line in output.split('\n'):
-        if not line: continue
-        if not line.startswith('file:'): continue
-        if line.endswith('/'): continue
-        
-        _file = '/' + line[5:]
-        logging.debug("Synced: %s" % _file)
-        synced_files.append(os.path.abspath(_file))
+        else:
+          changes.add(path, op)
+          last_seqs[path] = seq
+          
+    self.metrics.set('journal_pending', count)
+    changes = changes.changes()
+    bundled = self.bundled(last_seqs, renamed, batch['bundles'])
+    last_seqs = None
+    if pending:
+      logging.info("SYNCING %d CHANGES (%d PATHS) FROM %d JOURNAL SEGMENTS" % \
+        (count, len(changes), len(pending)))
         
-#      logging.debug("r: %i - %s %s" %(retval,output,error))
+    # One rsync per group of changes between renames (and rsync_max_files)
+    group = []
+    for op, path in changes + [(None, None)]:
+      if op != RENAME and op is not None:
+        group.append((op, path))
+        if len(group) < self.config.rsync_max_files:
+          continue
+          
+      if group:
+        files_processed += 1
+        retval, error = self.transfer(group, extra_rsync_opts, synced_files, bundled)
+        if retval not in (0, RSYNC_ERROR_VANISHED):
+          failed = True
+          failed_stderr = error
+          
+      group = []
+      if op == RENAME:
+        # Renamed locally or transferred again with the next files
+        src, dst = split_rename(path)
+        with self.profiler.span('rename'):
+          renamed_locally = self.rename(src, dst)
+          
+        if renamed_locally:
+          synced_files.append(dst)
+          
+        else:
+          group.extend([(DELETE, src), (UPDATE, dst)])
+          
 
     if files_processed:    
-      logging.info('FILES PROCESSED: %d' % files_processed)
+      logging.info('FILES PROCESSED: %d (%d paths synced)' % (files_processed, len(synced_files)))
       
     if self.config.dry_run:
       logging.info('NOT uptating version: %s (DRY RUN)' % last_version)
       return
     
-    if synced_files:
-      logging.debug("PROCESS ACTIONS")
-      self.process_actions(synced_files)
-    
     if failed: 
       logging.info("Some problems happened")
-      logging.info("Rsync output: %s - %s" % (failed_stdout,failed_stderr))
+      logging.info("Rsync errors: %s" % failed_stderr)
       # but continue to not live in and endless loop
       
-    # Go ahead if we are using the same file  
-    if files_processed == 1 and last_version == self.version:
-      logging.info("SAME FILE PROCESSED: Moving version forward")
-      last_version = last_version + 1
-
     # Write last updated file
     if last_version != self.version:
-      self.update_version(last_version,self.version)
+      self.update_version(last_version, self.version, batch['cursor'])
       self.version = last_version
-      
+      with self.fetch_lock:
+        self.prune_journal()
+        
+    self.write_end_sync()
+    
+  def write_end_sync(self):
     # Write end of sync file  
     with open(self.config.end_sync_file, 'w') as ofile:
       ofile.write("%s" % self.version)
       
-  def sync_updates(self, last_version):
-    logging.debug("SYNCING DATA FILES")
-    _data_dir = './data/'
+  def transfer(self, records, extra_rsync_opts, synced_files, bundled=None):
+    # Deletes and missing parent directories are done locally first so a
+    # single rsync only carries the content
+    with self.profiler.span('delete'):
+      deleted = self.delete([path for op, path in records if op == DELETE])
+    synced_files.extend(deleted)
+    
+    updates = [path for op, path in records if op != DELETE]
+    self.make_parents(updates)
     
-    # Run rsync
-    retval, output, error = self.rsync(
-      self.config.rsync_user + '@' + self.config.master + '::' + self.config.rsync_updates + '/',
-      _data_dir,
+    # Small files shipped in bundles do not need rsync
+    if bundled and updates and not self.config.dry_run:
+      with self.profiler.span('bundles'):
+        extracted = self.extract_bundled(updates, bundled)
+      synced_files.extend(extracted)
+      if extracted:
+        extracted = set(extracted)
+        updates = [path for path in updates if path not in extracted]
+        
+    if not updates:
+      return 0, ''
+      
+    with open(FILES_FROM, 'w') as ofile:
+      for path in updates:
+        ofile.write(path + '\n')
+
+    # Run rsync (synced paths are handled while it runs)
+    return self.rsync(
+      self.config.rsync_user + '@' + self.config.master + '::root/',
+      '/',
+      extra_rsync_opts + ["--files-from=" + FILES_FROM],
+      synced_files.line,
+      'journal'
     )
     
-    _pending = []
-    for _file in os.listdir(_data_dir):
+  def bundled(self, last_seqs, renamed, bundles):
+    """{path: bundle} for the pending updates found in one of bundles
+    written with (or after) their last change"""
+    found = {}
+    for name, first, last in bundles:
+      # Renamed paths may have had other content in earlier bundles
+      if first <= renamed: continue
+      
+      filename = os.path.join(self.data_dir, name)
+      for path in bundle_members(filename):
+        seq = last_seqs.get(path)
+        if seq is not None and seq <= last:
+          found[path] = filename
+          
+    return found
+    
+  def extract_bundled(self, updates, bundled):
+    paths = {}
+    for path in updates:
+      filename = bundled.get(path)
+      if filename: paths.setdefault(filename, set()).add(path)
+      
+    extracted = []
+    for filename in sorted(paths):
+      extracted.extend(extract_bundle(filename, paths[filename]))
+      
+    if extracted:
+      logging.info("EXTRACTED %d FILES FROM %d BUNDLES" % (len(extracted), len(paths)))
+      self.metrics.inc('bundle_files_total', len(extracted))
+      
+    return extracted
+    
+  def delete(self, paths):
+    # Paths below another deleted directory go with it
+    planned = []
+    for path in sorted(['/' + path.lstrip('/') for path in paths]):
+      if planned and path.startswith(planned[-1] + '/'):
+        continue
+        
+      if not self.inside_sync_paths(path):
+        logging.info("File not inside sync path: %s" % path)
+        continue
+        
+      planned.append(path)
+      
+    if not planned or self.config.dry_run:
+      return []
+      
+    if len(planned) == 1:
+      deleted = [self.delete_path(planned[0])]
+      
+    else:
+      pool = Pool(min(self.config.delete_workers, len(planned)))
       try:
-        file_version,file_type = _file.split('.')
-        file_version = int(file_version)
+        deleted = pool.map(self.delete_path, planned)
+      finally:
+        pool.close()
+        pool.join()
+        
+    return [path for path in deleted if path]
     
-      except:
+  def delete_path(self, path):
+    try:
+      if os.path.islink(path) or os.path.isfile(path):
+        os.remove(path)
+        logging.info("DELETE FILE: %s" % path)
+        
+      elif os.path.isdir(path):
+        shutil.rmtree(path)
+        logging.info("DELETE DIR: %s" % path)
+        
+      else:
+        return None
+        
+    except OSError, e:
+      logging.info("Unable to delete %s: %s" % (path, e))
+      return None
+      
+    return path
+    
+  def make_parents(self, paths):
+    if self.config.dry_run:
+      return
+      
+    checked = set()
+    for path in paths:
+      parent = os.path.dirname('/' + path.lstrip('/'))
+      if parent in checked: continue
+      checked.add(parent)
+      
+      if os.path.isdir(parent) or not self.inside_sync_paths(parent):
         continue
         
-      if file_version >= self.version:
-        logging.debug("File needs to be processed: %s" %_file)
-        _pending.append(_file)
+      try:
+        os.makedirs(parent)
+        logging.info("Destination folder: %s doesn't exists (creating it)" % parent)
+      except OSError, e:
+        logging.info("Unable to create %s: %s" % (parent, e))
+        
+  def rename(self, src, dst):
+    # Apply a rename of the master locally; False if dst must be transferred
+    if not self.inside_sync_paths(src) or not self.inside_sync_paths(dst):
+      logging.info("Rename not inside sync path: %s -> %s" % (src, dst))
+      return False
+      
+    if not os.path.lexists(src):
+      logging.info("RENAME SOURCE NOT FOUND: %s (transferring %s)" % (src, dst))
+      return False
+      
+    if self.config.dry_run:
+      logging.info("RENAME: %s -> %s (DRY RUN)" % (src, dst))
+      return True
+      
+    try:
+      parent = os.path.dirname(dst)
+      if not os.path.isdir(parent):
+        os.makedirs(parent)
+        
+      # The master replaced dst, so it was an empty directory there
+      if os.path.isdir(src) and os.path.isdir(dst) and not os.path.islink(dst):
+        shutil.rmtree(dst)
+        
+      os.rename(src, dst)
+      
+    except OSError, e:
+      logging.info("Unable to rename %s -> %s: %s (transferring it)" % (src, dst, e))
+      return False
+      
+    logging.info("RENAME: %s -> %s" % (src, dst))
+    return True
+    
+  def wait_changes(self, version=None):
+    # Block on the master notify endpoint until the journal moves past
+    # version (polling every sleep seconds when it is disabled or can not
+    # be reached). If the last announced changes could not be fetched sleep
+    # too (no busy loop)
+    if version is None: version = self.version
+    notify = self.notify
+    if notify and self.notified != version:
+      timeout = self.config.notify_timeout
+      if self.config.fullsync_interval:
+        timeout = min(timeout, self.config.fullsync_interval)
+        
+      changed = notify.wait(self.journal_id, version, timeout)
+      if changed is not None:
+        self.notified = version if changed else None
+        return changed
         
-#      else:
-#        logging.debug("Already processed: %s" %_file)
+    self.notified = None
+    sleep(self.config.sleep)
+    return None
+    
+  def sync_updates(self, last_version, fetch=True):
+    # journal.head first and then only the segments past last_version (none
+    # when fetch is False: the version just moves to the head)
+    logging.debug("SYNCING JOURNAL HEAD")
+    with self.fetch_lock:
+      self.fetch_updates([HEAD_FILE])
+      
+      reader = JournalReader(self.data_dir)
+      head = self.head = reader.head()
+      
+    if not head['id']:
+      logging.info("No journal found on master")
+      return last_version, []
+      
+    # A new journal (or the first one) is read from the beginning
+    if head['id'] != self.journal_id:
+      with self.exclusive():
+        logging.info("NEW MASTER JOURNAL: %s (was %s)" % (head['id'], self.journal_id))
+        self.journal_id = head['id']
+        self.update_version(0, self.version)
+        self.version = last_version = 0
         
-      # Get last processed to write time
-      if file_version > last_version:
-        last_version = file_version
+    elif last_version and last_version < head['tail'] - 1:
+      with self.exclusive():
+        logging.info("JOURNAL VERSION %d IS GONE ON MASTER (oldest is %d)" % \
+          (last_version, head['tail']))
+        self.fullsync()
         
-    # Sort list of files
-    ordered = sorted(_pending, key=lambda x: (int(re.sub('\D','',x)),x))
+    self.bundles = []
+    if not fetch:
+      return max(last_version, head['head']), []
+      
+    segments = [name for name, first, last in head['segments'] if last > last_version]
+    if not segments:
+      return last_version, []
+      
+    names = []
+    for name in segments:
+      names.extend([name, index_name(name)])
+      
+    # and the bundles with the content of the small files
+    self.bundles = [bundle for bundle in head['bundles'] if bundle[2] > last_version]
+    names.extend([bundle[0] for bundle in self.bundles])
+    
+    logging.debug("SYNCING JOURNAL SEGMENTS: %s" % ', '.join(segments))
+    with self.fetch_lock:
+      self.fetch_updates(names)
+      
+      # Records not applied (dry run) are read again
+      if self.cursor.journal_id != self.journal_id or self.cursor.seq != last_version:
+        self.cursor.reset(self.journal_id, last_version)
         
-    return last_version, ordered
+      # Up to the head announced: a relay publishes segments holding
+      # records it has not applied yet
+      _pending = []
+      for name, records in self.cursor.read(reader, segments, head['head']):
+        logging.debug("Changes need to be processed: %s" % name)
+        _pending.append((name, records))
+          
+        # Get last processed to write version
+        if records[-1][0] > last_version:
+          last_version = records[-1][0]
+          
+    return last_version, _pending
     
+  def fetch_updates(self, names):
+    # Copy names from the updates module of the master into data_dir
+    with self.fetch_lock:
+      with open(UPDATES_FROM, 'w') as ofile:
+        ofile.write('\n'.join(names) + '\n')
+        
+      return self.rsync(
+        self.config.rsync_user + '@' + self.config.master + '::' + self.config.rsync_updates + '/',
+        self.data_dir + '/',
+        ["--files-from=" + UPDATES_FROM],
+        kind = 'fetch'
+      )
+    
+  def prune_journal(self):
+    # Local copies of the segments already applied (but the newest one,
+    # it is where the master keeps appending)
+    if not self.head or not self.head['segments']:
+      return
+      
+    keep = set([self.head['segments'][-1][0]])
+    keep.update([name for name, first, last in self.head['segments'] if last > self.version])
+    
+    # Bundles are not needed once applied
+    bundles = set([name for name, first, last in self.head['bundles'] if last > self.version])
+    for name in os.listdir(self.data_dir):
+      if is_bundle(name) and name not in bundles:
+        os.remove(os.path.join(self.data_dir, name))
+        
+    reader = JournalReader(self.data_dir)
+    for name, first in reader.segments():
+      if name in keep: continue
+      
+      logging.debug("Removing applied journal segment: %s" % name)
+      for _name in (name, index_name(name)):
+        try:
+          os.remove(os.path.join(self.data_dir, _name))
+        except OSError:
+          pass
+          
   def read_version(self):
-    version=1
+    if self.cursor.journal_id:
+      return self.cursor.seq
+      
+    version=0
     if os.path.exists(VERSION_FILE):
       for line in open(VERSION_FILE):
         line = line.strip()
@@ -269,13 +846,97 @@ class SyncSlave():
     signal.signal(signal.SIGTERM, self.end)
     signal.signal(signal.SIGINT,  self.end)
     
-  def update_version(self,_version, _old_version = 1):
+    # SIGHUP reloads the configuration on the next cycle
+    signal.signal(signal.SIGHUP, self.hangup)
+    signal.siginterrupt(signal.SIGHUP, False)
+    
+    # SIGUSR1 starts/stops cProfile, SIGUSR2 dumps it to ./var
+    self.profiler.catch_signals()
+    
+  def hangup(self, signum=None, frame=None):
+    self.reload_requested = True
+    
+  def read_config_mtimes(self):
+    import master
+    return file_mtime(CONFIG_FILE), file_mtime(master.CONFIG_FILE)
+    
+  def check_config(self):
+    # Reload on SIGHUP or when one of the configuration files changed
+    mtimes = self.read_config_mtimes()
+    if not self.reload_requested and mtimes == self.config_mtimes:
+      return
+      
+    self.reload_requested = False
+    self.config_mtimes = mtimes
+    with self.profiler.span('reload'):
+      self.reload_config()
+      
+  def reload_config(self):
+    """Apply new configurations (ours and the master one) in place: only
+    the watch paths added are synced in full, excludes and actions are
+    read from config as they are used"""
+    try:
+      config = self.load_config()
+      master_config = self.master.load_config()
+      
+    except Exception, e:
+      logging.info("CONFIGURATION NOT RELOADED: %s" % e)
+      return
+      
+    old, self.config = self.config, config
+    old_paths = self.master.config.watch_paths
+    self.master.config = master_config
+    added = [path for path in master_config.watch_paths if path not in old_paths]
+    removed = [path for path in old_paths if path not in master_config.watch_paths]
+    
+    actions = self.actions
+    actions.delay = config.action_delay
+    actions.max_delay = max(config.action_delay, config.action_max_delay)
+    actions.timeout = config.action_timeout
+    self.profiler.threshold = config.profile_log_threshold
+    
+    if config.notify_address != old.notify_address:
+      self.notify = self.notified = None
+      if config.notify_address:
+        self.notify = NotifyClient(config.notify_address)
+        
+    logging.info("CONFIGURATION RELOADED: %d watch paths added, %d removed" % (len(added), len(removed)))
+    restart = [name for name in RESTART_OPTIONS if getattr(old, name, None) != getattr(config, name, None)]
+    if restart:
+      logging.info("RESTART NEEDED TO APPLY: %s" % ', '.join(restart))
+      
+    if added:
+      logging.info("SYNCING ADDED WATCH PATHS: %s" % ', '.join(added))
+      with self.profiler.span('fullsync'):
+        self.fullsync(paths=added)
+        
+  def resume_version(self, version):
+    # The journal is replayed from where the full sync started (at least)
+    if self.version < version:
+      self.update_version(version, self.version)
+      self.version = version
+      
+  def update_version(self,_version, _old_version = 1, cursor = None):
+    # cursor is where the journal was read up to _version (batch())
     logging.info("UPDATING VERSION: %s (was %s)" %(_version, _old_version))
     with open(VERSION_FILE, 'w') as ofile:
       ofile.write("%s" % _version)
       
-  def fullsync(self, is_recursion=False):
+    # The cursor only keeps its position when it is where _version is
+    cursor = cursor or self.cursor
+    if cursor.journal_id != self.journal_id or cursor.seq != _version:
+      cursor.reset(self.journal_id, _version)
+      
+    cursor.save()
+      
+  def fullsync(self, is_recursion=False, paths=None, resume=False):
+    # All the watch paths (checkpointed in fullsync_state) or only paths,
+    # resume goes on with an interrupted one instead of starting afresh
     logging.info("Full syncronization in progress...")
+    state = None
+    if paths is None:
+      state = self.fullsync_state
+      state.begin(self.journal_id, self.version, resume and self.config.fullsync_resume_age or 0)
 
     # Prepare excludes
     excludes = self.master.config.excludes + [
@@ -284,13 +945,32 @@ class SyncSlave():
       os.path.abspath('./.git') + '/**',
     ]
 
-    synced_files = []
-    run_again = False
-    for path in self.master.config.watch_paths:
+    # One rsync per watch path (or per large subtree) run in parallel, or
+    # only for the subtrees that differ from the master
+    jobs = None
+    if paths is None:
+      jobs = self.merkle_jobs()
+      
+    if jobs is None:
+      jobs = self.fullsync_jobs(paths)
+      
+    # Jobs completed before a restart
+    if state and state.done:
+      count = len(jobs)
+      jobs = [job for job in jobs if state.key(job) not in state.done]
+      if count > len(jobs):
+        logging.info("Full sync resumed: %d of %d jobs already done" % (count - len(jobs), count))
+        
+    commands, bases = [], []
+    for path, split in jobs:
       logging.info("SYNCING PATH: %s" % path)  
       
       if not os.path.isfile(path):
         path = path + '/'
+        bases.append(path)
+        
+      else:
+        bases.append(os.path.dirname(path))
         
       # Excludes need to be relative to path
       extra_rsync_opts = []   
@@ -307,85 +987,186 @@ class SyncSlave():
         else:
           extra_rsync_opts.append("--exclude=%s" % exclude)
 
-      # Run rsync
-      retval, output, error = self.rsync(
+      # Subtrees synced by their own job
+      for subdir in split:
+        extra_rsync_opts.append("--exclude=/%s/" % subdir[len(path):])
+        
+      commands.append(self.rsync_command(
         self.config.rsync_user + '@' + self.config.master + '::root' + path,
         path,
         extra_rsync_opts
-      )
+      ))
       
+    # Synced paths are handled as the rsyncs report them
+    def done(index, retval, elapsed):
+      self.metrics.inc('rsync_runs_total', kind='fullsync')
+      self.metrics.observe('rsync_seconds', elapsed, kind='fullsync')
+      self.metrics.set('fullsync_seconds', round(elapsed, 3), path=jobs[index][0])
+      if state and retval in (0, RSYNC_ERROR_VANISHED):
+        state.job_done(jobs[index])
+        
+    synced_files = SyncedFiles(self)
+    results = run_multi(commands, self.config.fullsync_workers,
+      lambda index, line: synced_files.line(line, bases[index]), done)
+    self.metrics.inc('fullsync_total')
+    
+    run_again = False
+    for (path, split), (retval, output, error) in zip(jobs, results):
+      if retval:
+        logging.debug("RETVAL: %s (%s)" % (retval, path))
+        logging.debug("ERROR:  %s" % error)
+        
       # Check if there is an error with destination path
       if retval == RSYNC_ERROR_MKDIR:
         self.rsync_error_mkdir(retval,error)
         run_again = True
-        continue
-    
-      for line in output.split('\n'):
-        if not line: continue
-        if not line.startswith('file:'): continue
-        if line.endswith('/'): continue
         
-        _file = path + '/' + line[5:]
-        logging.debug("Synced: %s" % _file)
-        synced_files.append(os.path.abspath(_file))
-        
-    if synced_files:
-      logging.debug("FULL SYNC PROCESS ACTIONS")
-      self.process_actions(synced_files)
+    logging.info("Full sync done: %d paths synced" % len(synced_files))
+    # Complete once every job is (failed ones are run again on resume)
+    if state and not [result for result in results if result[0] not in (0, RSYNC_ERROR_VANISHED)]:
+      state.finish()
     
     # We have processed errors so run again 
     if run_again and not is_recursion:
-        self.fullsync(True)
+        self.fullsync(True, paths, resume=True)
         
     # Write end of sync file  
     with open(self.config.end_sync_file, 'w') as ofile:
       ofile.write("%s" % self.version)
 #      logging.debug("r: %i - %s %s" %(retval,output,error))
   
-  def process_actions(self,files):
-    for file in files:
-      # Process actions
-      todos = {}
-      for action in self.config.actions:
-        if fnmatch.fnmatch(file, action.keys()[0]):
-          logging.info("MATCH ACTION %s IN FILE: %s" % (action[action.keys()[0]],file))
-          todos[action[action.keys()[0]]] = 1
+  def merkle_jobs(self):
+    """[(path, [subdirectories equal on both sides])] that differ from the
+    master or None when the master hash tree is not available"""
+    if not self.config.merkle_fullsync:
+      return None
+      
+    # Never compare against a stale copy
+    filename = os.path.join(self.data_dir, TREE_FILE)
+    if os.path.exists(filename): os.remove(filename)
+    
+    self.fetch_updates([TREE_FILE])
+    master_tree = read_tree(filename)
+    if master_tree is None:
+      logging.info("No hash tree found on master")
+      return None
+      
+    started = time()
+    watch_paths = self.master.config.watch_paths
+    cache = HashCache(workers=self.config.hash_workers,
+      prune=[re.compile(regex) for regex in self.master.watch_excludes()],
+      exclude=self.master.config.exclude_filter)
+    try:
+      local_tree = cache.tree(watch_paths)
+    finally:
+      cache.close()
+      
+    jobs = diverged(master_tree, local_tree, watch_paths)
+    if jobs:
+      logging.info("Hash tree compared in %.1fs: %d subtrees differ" % (time() - started, len(jobs)))
+    else:
+      logging.info("NO DRIFT: Hash tree equal to master (%.1fs)" % (time() - started))
+    return jobs
+    
+  def fullsync_jobs(self, paths=None):
+    """[(path, [subdirectories synced by their own job])] to sync (all
+    the watch paths or the ones in paths).
+
+    Subdirectories holding more than fullsync_split_files files (counted
+    from the manifest exported by the master) get their own job, so a
+    single large tree is spread over the workers.
+    """
+    watch_paths = paths or self.master.config.watch_paths
+    limit = self.config.fullsync_split_files
+    counts = {}
+    
+    manifest = os.path.join(self.data_dir, EXPORT_FILE)
+    if limit:
+      self.fetch_updates([EXPORT_FILE])
+      
+    if limit and os.path.isfile(manifest):
+      watch_filter = self.master.config.watch_filter
+      for path, size, mtime, digest in read_export(manifest):
+        root = watch_filter.lookup(path)
+        if root is None: continue
+        
+        dirname = os.path.dirname(path)
+        while len(dirname) > len(root):
+          counts[dirname] = counts.get(dirname, 0) + 1
+          dirname = os.path.dirname(dirname)
           
-    for todo in todos.keys():
-      if not todo: continue        
-      logging.info("RUNNING ACTION (in background): %s" %todo)
+    children = {}
+    for dirname, count in counts.items():
+      if count > limit:
+        children.setdefault(os.path.dirname(dirname), []).append(dirname)
+        
+    jobs = []
+    todo = list(watch_paths)
+    while todo:
+      path = todo.pop(0)
+      split = sorted(children.get(path, []))
+      jobs.append((path, split))
+      todo.extend(split)
       
-      # Split processes ';'
-      commands = todo.split(';')
-      for cmd in commands:
-        run(shlex.split(cmd), detached=True)
+    if len(jobs) > len(watch_paths):
+      logging.info("Full sync split in %d jobs" % len(jobs))
+      
+    return jobs
+    
+  def process_actions(self, files, matched=None):
+    with self.profiler.span('actions'):
+      self.schedule_actions(files, matched)
+      
+  def schedule_actions(self, files, matched=None):
+    # Each action once, however many of its files changed (matched keeps
+    # the actions already scheduled across calls)
+    if matched is None: matched = set()
+    todos = {}
+    for file in files:
+      for idx in self.config.action_filter.matches(file):
+        if idx in todos or idx in matched: continue
+        action = self.config.actions[idx]
+        logging.info("MATCH ACTION %s IN FILE: %s" % (action[action.keys()[0]],file))
+        todos[idx] = action[action.keys()[0]]
+          
+    matched.update(todos)
+    for idx in sorted(todos):
+      todo, timeout = todos[idx], None
+      if isinstance(todo, (tuple, list)):
+        todo, timeout = todo
+        
+      if not todo: continue
+      self.actions.schedule(todo, timeout)
         
   def inside_sync_paths(self,filename):
     abspath = os.path.abspath(filename)
+    return self.master.config.watch_filter.lookup(abspath) is not None
     
-    for path in self.master.config.watch_paths:
-      if path in abspath:
-        return True
-        
-    return False
-    
-  def rsync(self, rsync_from, rsync_to, rsync_ops = []):
-      _cmd = [self.config.rsync_cmd] + self.config.rsync_opts + rsync_ops + [
+  def rsync_command(self, rsync_from, rsync_to, rsync_ops = []):
+      return [self.config.rsync_cmd] + self.config.rsync_opts + rsync_ops + [
         '--out-format',
-        'file:%n%L',
+        'file:%b %n%L',
         "--password-file",
         self.config.rsync_secret_file,
         rsync_from,
         rsync_to
       ]
       
+  def rsync(self, rsync_from, rsync_to, rsync_ops = [], on_line = None, kind = 'journal'):
+      # Output lines go to on_line() as they arrive, stderr is returned
+      _cmd = self.rsync_command(rsync_from, rsync_to, rsync_ops)
+      
       logging.debug("Executing command: " + ' '.join(_cmd))
-      _retval, _output, _error = run(_cmd)
+      started = time()
+      with self.profiler.span('rsync'):
+        _retval, _error = run_stream(_cmd, on_line)
+      self.metrics.inc('rsync_runs_total', kind=kind)
+      self.metrics.observe('rsync_seconds', time() - started, kind=kind)
       
       if _retval:
         logging.debug("RETVAL: %s" % _retval)
         logging.debug("ERROR:  %s" % _error)
-      return _retval, _output, _error
+      return _retval, _error
   
   def rsync_error_mkdir(self, retval, stderr):
       if retval != RSYNC_ERROR_MKDIR:
@@ -414,6 +1195,10 @@ class SyncSlave():
     else:
       raise RuntimeError, "Configuration file must be a importable python file ending in .py"
   
+    # Read it again on every load (reload_config)
+    sys.modules.pop(configfile, None)
+    if os.path.exists(CONFIG_FILE + 'c'): os.remove(CONFIG_FILE + 'c')
+    
     sys.path.append(configdir)
     exec("import %s as __config__" % configfile)
     sys.path.remove(configdir)
@@ -462,6 +1247,20 @@ class SyncSlave():
       config.fullsync_interval = 3600*4
       
     config.fullsync_interval = int(config.fullsync_interval)
+    
+    # A full sync done less than this ago is not run again on start and an
+    # interrupted one is resumed (0 to always start over)
+    if not "fullsync_resume_age" in dir(config):
+      config.fullsync_resume_age = 3600*4
+      
+    config.fullsync_resume_age = int(config.fullsync_resume_age)
+    
+    # Journal batches fetched ahead while another one is applied (0 to
+    # fetch and apply in turn)
+    if not "pipeline_depth" in dir(config):
+      config.pipeline_depth = 2
+      
+    config.pipeline_depth = max(int(config.pipeline_depth), 0)
       
     if not "sleep" in dir(config):       
       config.sleep = 5
@@ -469,9 +1268,75 @@ class SyncSlave():
     config.sleep = int(config.sleep)
     if config.sleep < 5: config.sleep = 5
     
+    # Parallel rsync runs of a full sync and files of the subdirectories
+    # synced by a job of their own (0 to never split a watch path)
+    if not "fullsync_workers" in dir(config):
+      config.fullsync_workers = 4
+      
+    config.fullsync_workers = max(int(config.fullsync_workers), 1)
+    
+    if not "fullsync_split_files" in dir(config):
+      config.fullsync_split_files = 20000
+      
+    config.fullsync_split_files = int(config.fullsync_split_files)
+    
+    # Compare directory hash trees with the master to sync only what differs
+    if not "merkle_fullsync" in dir(config):
+      config.merkle_fullsync = True
+      
+    if not "hash_workers" in dir(config):
+      config.hash_workers = 2
+      
+    # Threads removing the paths deleted on the master
+    if not "delete_workers" in dir(config):
+      config.delete_workers = 4
+      
+    config.delete_workers = max(int(config.delete_workers), 1)
+    
+    # Maximum paths transferred by a single rsync run
+    if not "rsync_max_files" in dir(config):
+      config.rsync_max_files = 50000
+      
+    config.rsync_max_files = max(int(config.rsync_max_files), 1)
+    
+    # Only where the master (or relay) listens for slaves: it binds to
+    # loopback unless its notify_address is set, so poll by default
+    if not "notify_address" in dir(config):
+      config.notify_address = None
+      
+    if not "notify_timeout" in dir(config):
+      config.notify_timeout = 60
+      
+    config.notify_timeout = max(int(config.notify_timeout), config.sleep)
+    
+    # Prometheus endpoint ('host:port' or a Unix socket, None to disable)
+    if not "metrics_address" in dir(config):
+      config.metrics_address = './var/ackstorm-sync-slave.sock'
+    
     if not "actions" in dir(config):
       config.actions = []
+      
+    # Seconds without new matches before an action runs (at most
+    # action_max_delay after the first one) and before it is killed
+    if not "action_delay" in dir(config):
+      config.action_delay = 5
+      
+    if not "action_max_delay" in dir(config):
+      config.action_max_delay = 60
+      
+    if not "action_timeout" in dir(config):
+      config.action_timeout = 300
+      
+    if not "action_workers" in dir(config):
+      config.action_workers = 2
+      
+    # Cycles busy this long (seconds) log their phases at INFO
+    if not "profile_log_threshold" in dir(config):
+      config.profile_log_threshold = 1.0
         
+    # Compile action globs once per configuration load
+    config.action_filter = PathFilter([action.keys()[0] for action in config.actions])
+    
     return config
 
   @staticmethod
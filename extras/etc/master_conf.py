@@ -4,6 +4,55 @@ verbose     = False
 daemonize   = True
 sleep       = 10
 
+# Changed paths kept in memory between flushes (spilled to disk above it)
+journal_max_entries = 100000
+
+# Journal segments older than journal_compact_age are merged keeping the
+# last change of every path, and removed after journal_retention seconds
+journal_compact_age = 3600
+journal_retention   = 3600*24*7
+
+# Inotify backend: 'pyinotify' (polls every sleep seconds) or 'native'
+# (epoll, changes are written once quiet for inotify_debounce seconds)
+inotify_backend  = 'pyinotify'
+inotify_debounce = 0.2
+
+# Threads used to look for files changed while the master was stopped
+scan_workers = 4
+
+# Manifest of the watched files (./var/manifest.db): threads hashing changed
+# files and how often it is exported to the updates module (data/manifest.dat)
+hash_workers = 2
+manifest_export_interval = 60
+
+# Seconds between exports of the directory hash tree (data/merkle.dat) that
+# slaves use to sync only the subtrees that differ (0 to disable)
+merkle_export_interval = 600
+
+# Changed files up to this size (bytes) are also packed into a compressed
+# bundle per journal flush so slaves get them without rsync (0 to disable)
+bundle_file_size = 65536
+
+# Bundles older than this (seconds, default journal_compact_age) or past the
+# newest bundle_max_count are removed: slaves behind them rsync the files
+bundle_max_age = 3600
+bundle_max_count = 64
+
+# Slaves are told about new journal entries through this long-poll endpoint
+# ('host:port' or the path of a Unix socket, None to disable). It has no
+# authentication: listen on the address slaves rsync from (the default is
+# '127.0.0.1:8731', where they can only poll)
+notify_address = 'front1:8731'
+
+# Metrics in Prometheus format served over HTTP on 'host:port' or a Unix
+# socket (None to disable); also written to var/ackstorm-sync-master.prom
+metrics_address = './var/ackstorm-sync-master.sock'
+
+# Every cycle logs the time spent in each of its phases, at INFO when it was
+# busy this many seconds. SIGUSR1 starts/stops cProfile, SIGUSR2 dumps it to
+# var/ackstorm-sync-master-<time>.prof
+profile_log_threshold = 1.0
+
 # directory that should be watched for changes
 watch_paths = [
     "/usr/local/ackstorm/sync",
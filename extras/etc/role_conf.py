@@ -1,6 +1,7 @@
 #!/usr/local/env python
 
-# Need to set role = 'master' or 'slave' use the python logic you want
+# Need to set role = 'master', 'slave' or 'relay' (a slave other slaves
+# sync from, configured in slave_conf.py) use the python logic you want
 import platform
 
 role = 'slave'
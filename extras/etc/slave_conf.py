@@ -10,13 +10,48 @@ sleep          = 5
 # Run a full sync on startup
 initial_fullsync   = True
 
+# Progress of full syncs is kept in var/.fullsync: on startup a full sync
+# done less than fullsync_resume_age seconds ago is not run again and an
+# interrupted one resumes from the paths left (0 to always start over)
+fullsync_resume_age = 3600*4
+
 # Run a full sync on intervals (0 to disable)
 # Default is 3600*4 (4 hours)
 fullsync_interval  = 3600
 
-# Master host
+# Parallel rsync runs of a full sync; subdirectories with more files than
+# fullsync_split_files are synced by a run of their own (0 to disable)
+fullsync_workers     = 4
+fullsync_split_files = 20000
+
+# Compare directory hash trees with the master and sync only the subtrees
+# that differ; local hashes are cached in ./var/hashes.db
+merkle_fullsync      = True
+hash_workers         = 2
+
+# Master host (or the relay this slave syncs from)
 master         = 'front1'
 
+# Relay role only: where downstream slaves wait for changes. It has no
+# authentication: set it to the address they rsync from
+relay_notify_address = '127.0.0.1:8731'
+
+# Wait for changes on the master notify endpoint (sleep is used as a
+# fallback when it is not reachable). It must match notify_address on the
+# master, which only listens on loopback by default. Default is None (always
+# poll). Seconds to wait before polling anyway:
+notify_address = 'front1:8731'
+notify_timeout = 60
+
+# Metrics in Prometheus format served over HTTP on 'host:port' or a Unix
+# socket (None to disable); also written to var/ackstorm-sync-slave.prom
+metrics_address = './var/ackstorm-sync-slave.sock'
+
+# Every cycle logs the time spent in each of its phases, at INFO when it was
+# busy this many seconds. SIGUSR1 starts/stops cProfile, SIGUSR2 dumps it to
+# var/ackstorm-sync-slave-<time>.prof
+profile_log_threshold = 1.0
+
 # Rsync options
 rsync_cmd      = 'rsync'
 rsync_user     = 'ackstorm-sync'
@@ -24,16 +59,38 @@ rsync_password = '******'
 rsync_updates  = 'updates'
 rsync_opts     = ["-av","-x","-r","--delete","--timeout=20","--force","--ignore-errors"]
 
+# Pending changes are merged and sent in rsync runs of up to this many paths
+rsync_max_files = 50000
+
+# The journal is fetched in a thread of its own while the changes already
+# fetched are applied; up to pipeline_depth batches wait to be applied and
+# are merged into a single one (0 to fetch and apply in turn)
+pipeline_depth = 2
+
+# Threads deleting the paths removed on the master
+delete_workers = 4
+
 # Write this file when sync is done
 end_sync_file  = '/tmp/sync-client.done'
 
-# Actions (will run in detached process)
+# Actions run in the background once no more matching files arrived for
+# action_delay seconds (or action_max_delay after the first one), never
+# twice at the same time, killed after action_timeout seconds. Output goes
+# to var/log/ackstorm-sync-actions.log. A (command, timeout) tuple sets the
+# timeout of a single action.
+#
+# Changes to etc/*.py need no action: the configuration is reloaded in
+# place (SIGHUP does it too) and only the watch paths added are synced.
+action_delay     = 5
+action_max_delay = 60
+action_timeout   = 300
+action_workers   = 2
+
 actions        = [
     {'/etc/fstab': 'mount -a'},
     {'/etc/monit/conf.d/*': 'service monit restart'},
     
     {'/etc/nginx/*': 'service nginx reload'},
-    {'/usr/local/ackstorm/sync/etc/*.py': '/usr/local/ackstorm/sync/bin/ackstorm-sync restart'},
     {'/usr/local/ackstorm/sync/bin/*.py': '/usr/local/ackstorm/sync/bin/ackstorm-sync restart'}
 ]
 
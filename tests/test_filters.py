@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import random
+import fnmatch
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'bin', 'lib'))
+
+from filters import PathFilter, PrefixTrie
+
+PATTERNS = [
+  '*~', '*.swp', '*/.git/*', '/var/www/cache', '/var/www/cache/*', '/var/www/*/tmp/*',
+  '/var/www/site?/logs/*', '/var/www/[ab]*', '/srv/data/*.log', '/srv/da*', '*/node_modules',
+  '/etc/nginx/sites-enabled/*', '/etc/nginx', '*', '/var/www/cache',
+]
+
+PATHS = [
+  '/var/www/cache', '/var/www/cache/a', '/var/www/cache.old', '/var/www/site1/logs/x',
+  '/var/www/site12/logs/x', '/var/www/site1/tmp/y', '/var/www/alpha', '/var/www/c',
+  '/srv/data/x.log', '/srv/data/sub/x.log', '/srv/database', '/home/u/.git/config',
+  '/home/u/file~', '/home/u/file.swp', '/home/u/app/node_modules', '/etc/nginx',
+  '/etc/nginx/sites-enabled/default', '/etc/nginxx', '', '/', '/a\nb~',
+]
+
+
+class PathFilterTest(unittest.TestCase):
+  """PathFilter gives the same results as fnmatch with every pattern"""
+
+  def check(self, patterns, paths):
+    path_filter = PathFilter(patterns)
+    for path in paths:
+      expected = [idx for idx, pattern in enumerate(patterns) if fnmatch.fnmatch(path, pattern)]
+      self.assertEqual(path_filter.matches(path), expected, (path, patterns))
+      self.assertEqual(path_filter.match(path), bool(expected), (path, patterns))
+
+  def test_each_pattern(self):
+    for pattern in PATTERNS:
+      self.check([pattern], PATHS)
+
+  def test_all_patterns(self):
+    self.check(PATTERNS, PATHS)
+
+  def test_without_floating_patterns(self):
+    self.check([pattern for pattern in PATTERNS if not pattern.startswith('*')], PATHS)
+
+  def test_empty(self):
+    self.check([], PATHS)
+
+  def test_random(self):
+    rand = random.Random(1)
+    comps = ['var', 'www', 'a', 'ab', 'b.log', 'c~', '.git']
+    wild = ['*', '?', '[ab]', '*.log', 'a*']
+    for run in range(50):
+      patterns = []
+      for count in range(rand.randint(1, 8)):
+        parts = [rand.choice(comps + wild) for i in range(rand.randint(1, 4))]
+        patterns.append(rand.choice(['/', '']) + '/'.join(parts))
+
+      paths = ['/' + '/'.join(rand.choice(comps) for i in range(rand.randint(1, 5)))
+        for count in range(30)]
+      self.check(patterns, paths)
+
+
+class PrefixTrieTest(unittest.TestCase):
+
+  def test_lookup(self):
+    trie = PrefixTrie([('/var/www', 'www'), ('/var/www/site', 'site'), ('/etc/', 'etc')])
+    self.assertEqual(len(trie), 3)
+    self.assertEqual(trie.lookup('/var/www'), 'www')
+    self.assertEqual(trie.lookup('/var/www/a/b'), 'www')
+    self.assertEqual(trie.lookup('/var/www/site/x'), 'site')
+    self.assertEqual(trie.lookup('/var/www.old'), None)
+    self.assertEqual(trie.lookup('/var'), None)
+    self.assertEqual(trie.lookup('/etc/hosts'), 'etc')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'bin', 'lib'))
+
+from journal import ChangeSet, JournalWriter, JournalReader, Cursor, UPDATE, DELETE, RENAME, \
+  INDEX_ENTRY, rename_path, encode_varint, decode_varint, encode_records, decode_records
+
+
+class ChangeSetTest(unittest.TestCase):
+
+  def changes(self, *events):
+    # events: (op, path[, new]) or (RENAME, src, dst[, is_dir])
+    changes = ChangeSet()
+    for event in events:
+      if event[0] == RENAME:
+        changes.rename(*event[1:])
+      else:
+        changes.add(event[1], event[0], *event[2:])
+
+    return changes.changes()
+
+  def test_writes_coalesce(self):
+    self.assertEqual(self.changes((UPDATE, '/a', True), (UPDATE, '/a'), (UPDATE, '/a')),
+      [(UPDATE, '/a')])
+
+  def test_delete_of_new_file_cancels(self):
+    self.assertEqual(self.changes((UPDATE, '/a', True), (DELETE, '/a')), [])
+
+  def test_delete_of_existing_file(self):
+    self.assertEqual(self.changes((UPDATE, '/a'), (DELETE, '/a')), [(DELETE, '/a')])
+
+  def test_delete_then_create_is_update(self):
+    self.assertEqual(self.changes((DELETE, '/a'), (UPDATE, '/a', True)), [(UPDATE, '/a')])
+
+  def test_sorted_between_renames(self):
+    self.assertEqual(self.changes((UPDATE, '/c'), (UPDATE, '/a'), (RENAME, '/x', '/y'), (UPDATE, '/b')),
+      [(UPDATE, '/a'), (UPDATE, '/c'), (RENAME, rename_path('/x', '/y')), (UPDATE, '/b')])
+
+  def test_rename_moves_pending_changes(self):
+    self.assertEqual(self.changes((UPDATE, '/d/f'), (RENAME, '/d', '/e', True)),
+      [(RENAME, rename_path('/d', '/e')), (UPDATE, '/e/f')])
+
+  def test_rename_of_new_source_is_update(self):
+    self.assertEqual(self.changes((UPDATE, '/t', True), (RENAME, '/t', '/b')), [(UPDATE, '/b')])
+
+  def test_rename_of_new_source_then_delete(self):
+    # /b may have existed before: slaves must delete it
+    self.assertEqual(self.changes((UPDATE, '/a', True), (RENAME, '/a', '/b'), (DELETE, '/b')),
+      [(DELETE, '/b')])
+
+  def test_rename_over_deleted_destination_then_delete(self):
+    self.assertEqual(self.changes((DELETE, '/b'), (UPDATE, '/t', True), (RENAME, '/t', '/b'),
+      (DELETE, '/b')), [(DELETE, '/b')])
+
+  def test_rename_over_new_destination_then_delete(self):
+    # Neither /t nor /b existed before
+    self.assertEqual(self.changes((UPDATE, '/b', True), (UPDATE, '/t', True), (RENAME, '/t', '/b'),
+      (DELETE, '/b')), [])
+
+
+class EncodingTest(unittest.TestCase):
+
+  def test_varint(self):
+    for value in (0, 1, 127, 128, 300, 2 ** 32, 2 ** 63):
+      data = 'x' + encode_varint(value)
+      self.assertEqual(decode_varint(data, 1), (value, len(data)))
+
+  def test_records(self):
+    records = [(10 + count * 2, UPDATE, '/var/www/site/file%03d' % count) for count in range(150)]
+    data, index = encode_records(records, 9, 100)
+    decoded = list(decode_records(data, 0, 10))
+    self.assertEqual([record[:3] for record in decoded], records)
+    self.assertEqual(decoded[-1][3], len(data))
+
+    # An index entry every RESTART_INTERVAL records, decoding can start there
+    self.assertEqual(len(index), 3)
+    for entry in index:
+      seq, offset = INDEX_ENTRY.unpack(entry)
+      decoded = list(decode_records(data, offset - 100, seq))
+      self.assertEqual(decoded[0][:3], [record for record in records if record[0] == seq][0])
+      self.assertEqual(decoded[-1][:3], records[-1])
+
+  def test_truncated_record(self):
+    records = [(1, UPDATE, '/a'), (2, DELETE, '/b/long/path')]
+    data, index = encode_records(records, 0, 0)
+    for end in range(len(data) - 1, len(data) - 12, -1):
+      self.assertEqual([record[:3] for record in decode_records(data[:end], 0, 1)], records[:1])
+
+
+class JournalTest(unittest.TestCase):
+
+  def setUp(self):
+    self.data_dir = tempfile.mkdtemp(prefix='ackstorm-sync-test-')
+
+  def tearDown(self):
+    shutil.rmtree(self.data_dir, True)
+
+  def append(self, writer, count, prefix='/f'):
+    return writer.append([(UPDATE, '%s%d' % (prefix, i)) for i in range(count)])
+
+  def test_read_segment_after(self):
+    writer = JournalWriter(self.data_dir)
+    for count in range(10):
+      self.append(writer, 50)
+
+    reader = JournalReader(self.data_dir)
+    name = reader.segments()[0][0]
+    for after in (0, 1, 63, 64, 65, 200, 499, 500):
+      seqs = [record[0] for record in reader.read_segment(name, after)]
+      self.assertEqual(seqs, range(after + 1, 501))
+
+    seqs = [record[0] for record in reader.read_segment(name, 100, last=120)]
+    self.assertEqual(seqs, range(101, 121))
+
+  def test_segments_roll_over(self):
+    writer = JournalWriter(self.data_dir, segment_size=512)
+    for count in range(20):
+      self.append(writer, 10)
+
+    reader = JournalReader(self.data_dir)
+    head = reader.head()
+    self.assertTrue(len(head['segments']) > 1)
+    self.assertEqual((head['head'], head['tail']), (200, 1))
+    self.assertEqual([record[0] for name, records in reader.batches(0) for record in records],
+      range(1, 201))
+
+    # A new writer goes on from the head
+    writer = JournalWriter(self.data_dir, segment_size=512)
+    self.assertEqual(self.append(writer, 1), 201)
+
+  def test_recover_truncated_append(self):
+    writer = JournalWriter(self.data_dir)
+    self.append(writer, 10)
+    name = writer.active[0]
+    with open(os.path.join(self.data_dir, name), 'ab') as file:
+      file.write(encode_varint(1) + UPDATE + encode_varint(0) + encode_varint(100) + '/partial')
+
+    writer = JournalWriter(self.data_dir)
+    self.assertEqual(writer.seq, 10)
+    self.assertEqual(self.append(writer, 1, '/g'), 11)
+    reader = JournalReader(self.data_dir)
+    self.assertEqual([record[2] for record in reader.read_segment(name, 9)], ['/f9', '/g0'])
+
+  def cursor_read(self, cursor, reader):
+    return [record[0] for name, records in cursor.read(reader, [name for name, first in reader.segments()])
+      for record in records]
+
+  def test_cursor_resumes_at_offset(self):
+    writer = JournalWriter(self.data_dir)
+    reader = JournalReader(self.data_dir)
+    self.append(writer, 100)
+
+    cursor = Cursor(os.path.join(self.data_dir, 'cursor'))
+    cursor.reset(writer.id)
+    self.assertEqual(self.cursor_read(cursor, reader), range(1, 101))
+    self.assertEqual(cursor.offset, os.path.getsize(os.path.join(self.data_dir, cursor.segment)))
+    cursor.save()
+
+    self.append(writer, 20)
+    cursor = Cursor(os.path.join(self.data_dir, 'cursor'))
+    self.assertEqual((cursor.journal_id, cursor.seq), (writer.id, 100))
+    self.assertEqual(self.cursor_read(cursor, reader), range(101, 121))
+
+  def test_cursor_resumes_across_compaction(self):
+    writer = JournalWriter(self.data_dir, segment_size=256)
+    reader = JournalReader(self.data_dir)
+    for count in range(10):
+      self.append(writer, 10)
+
+    cursor = Cursor(os.path.join(self.data_dir, 'cursor'))
+    cursor.reset(writer.id, 35)
+    self.assertEqual(self.cursor_read(cursor, reader), range(36, 101))
+
+    # The same paths again: compaction keeps only their latest records,
+    # rewriting the segment the cursor points to
+    for count in range(10):
+      self.append(writer, 10)
+
+    segments = len(writer.segments)
+    writer.compact(0, 3600)
+    self.assertTrue(len(writer.segments) < segments)
+
+    compacted = [record[2] for record in reader.read_segment(writer.segments[0][0])]
+    self.assertEqual(len(set(compacted)), len(compacted))
+
+    left = [record[0] for name, records in reader.batches(100) for record in records]
+    self.assertTrue(left and left[-1] == 200)
+    self.assertEqual(self.cursor_read(cursor, reader), left)
+
+
+if __name__ == '__main__':
+  unittest.main()
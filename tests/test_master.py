@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import signal
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LIB = os.path.join(ROOT, 'bin', 'lib')
+sys.path.insert(0, LIB)
+
+from journal import JournalReader
+
+SLEEP = 5   # tick of the master (the shortest it accepts)
+
+RUNNER = """
+import os, sys
+sys.path.insert(0, %(lib)r)
+os.chdir(%(instance)r)
+import master
+master.SyncMaster().run('./var/master.pid')
+"""
+
+try:
+  import pyinotify
+except ImportError:
+  pyinotify = None
+
+
+class MasterTest(unittest.TestCase):
+  """A master running on a temporary tree with the native backend"""
+
+  backend = 'native'
+
+  def setUp(self):
+    self.instance = tempfile.mkdtemp(prefix='ackstorm-sync-test-')
+    self.tree = os.path.join(self.instance, 'tree')
+    for path in ('etc', 'var', 'var/log', 'data', 'tree/dir'):
+      os.makedirs(os.path.join(self.instance, path))
+
+    with open(os.path.join(self.instance, 'etc', 'master_conf.py'), 'w') as file:
+      file.write("\n".join([
+        "verbose = True",
+        "daemonize = False",
+        "sleep = %d" % SLEEP,
+        "inotify_backend = %r" % self.backend,
+        "watch_paths = [%r]" % self.tree,
+        "excludes = []",
+        "notify_address = None",
+        "metrics_address = None",
+        "actions = []",
+      ]) + "\n")
+
+    self.process = None
+
+  def tearDown(self):
+    self.stop()
+    shutil.rmtree(self.instance, True)
+
+  def start(self):
+    self.process = subprocess.Popen([sys.executable, '-c',
+      RUNNER % {'lib': LIB, 'instance': self.instance}])
+
+  def stop(self):
+    if self.process and self.process.poll() is None:
+      self.process.send_signal(signal.SIGTERM)
+      self.process.wait()
+
+    self.process = None
+
+  def last_run(self):
+    try:
+      with open(os.path.join(self.instance, 'var', '.version')) as file:
+        return float(file.read().strip() or 0)
+    except IOError:
+      return None
+
+  def wait_for(self, check, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+      result = check()
+      if result: return result
+      self.assertEqual(self.process.poll(), None, "master exited")
+      time.sleep(0.2)
+
+    self.fail("timeout")
+
+  def journaled(self):
+    reader = JournalReader(os.path.join(self.instance, 'data'))
+    return set(record[2] for name, records in reader.batches(0) for record in records)
+
+  def log(self):
+    with open(os.path.join(self.instance, 'var', 'log', 'ackstorm-sync-master.log')) as file:
+      return file.read()
+
+  def test_last_run_advances(self):
+    # The master ticks (catch up scan, last run, ...) with no events at all
+    self.start()
+    first = self.wait_for(self.last_run, SLEEP * 3)
+    self.wait_for(lambda: self.last_run() > first, SLEEP * 3)
+
+  def test_catch_up_after_restart(self):
+    self.start()
+    self.wait_for(self.last_run, SLEEP * 3)
+    self.stop()
+
+    # Changed while the master was down and nothing touches the tree later
+    time.sleep(1)
+    path = os.path.join(self.tree, 'dir', 'changed')
+    with open(path, 'w') as file:
+      file.write('changed\n')
+
+    self.start()
+    self.wait_for(lambda: path in self.journaled(), SLEEP * 3)
+
+  def test_directory_move(self):
+    self.start()
+    self.wait_for(self.last_run, SLEEP * 3)
+
+    # Events below a directory moved inside the tree come with its new path
+    os.rename(os.path.join(self.tree, 'dir'), os.path.join(self.tree, 'moved'))
+    time.sleep(1)
+    path = os.path.join(self.tree, 'moved', 'file')
+    with open(path, 'w') as file:
+      file.write('moved\n')
+
+    self.wait_for(lambda: path in self.journaled(), SLEEP * 3)
+    self.assertFalse(os.path.join(self.tree, 'dir', 'file') in self.journaled())
+    self.assertFalse('UNABLE TO WATCH' in self.log())
+
+
+@unittest.skipIf(pyinotify is None, "pyinotify is not installed")
+class PyinotifyMasterTest(MasterTest):
+  backend = 'pyinotify'
+
+
+if __name__ == '__main__':
+  unittest.main()